@@ -0,0 +1 @@
+"""Benchmarks of the main code paths, run with 'python -m benchmarks.run_benchmarks'."""
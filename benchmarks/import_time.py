@@ -0,0 +1,143 @@
+"""Measure import time of the package modules and check their dependencies.
+
+Every module is imported in a fresh interpreter, so the time includes all
+dependencies it pulls in. Modules of the core must not import heavy
+optional dependencies, violations (or import slower than '--max-seconds')
+are reported and the exit code is 1, so the script can guard the lightweight
+core in CI.
+
+Usage:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --max-seconds 0.5 --repeat 5
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence
+
+# Optional dependencies which are expensive to import
+HEAVY_MODULES = (
+    "pandas",
+    "pyarrow",
+    "scipy",
+    "shapely",
+    "geopandas",
+    "folium",
+    "matplotlib",
+    "osmnx",
+    "numba",
+    "numexpr",
+)
+
+# Modules are imported from the root of the repository
+_ROOT = Path(__file__).resolve().parents[1]
+
+# pandas imports its optional accelerators itself when they are installed
+PANDAS_STACK = ("pandas", "pyarrow", "numexpr")
+
+# Imported in the child interpreter, prints seconds and loaded heavy modules
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+class ImportCase(NamedTuple):
+    """Module and heavy dependencies it is allowed to import.
+
+    module - name of the imported module
+    allowed - heavy modules the module may import
+    """
+
+    module: str
+    allowed: Sequence[str]
+
+
+def all_cases() -> List[ImportCase]:
+    """Return modules of the lightweight core and of the extras."""
+    return [
+        # package and numpy-only core
+        ImportCase("src", ()),
+        ImportCase("src.np_tiles_converter", ()),
+        ImportCase("src.tile_keys", ()),
+        ImportCase("src.stencil", ()),
+        # pandas based modules, optional dependencies are lazy
+        ImportCase("src.nearby_tiles", PANDAS_STACK),
+        ImportCase("src.geometry_converter", PANDAS_STACK),
+        ImportCase("src.kernels", PANDAS_STACK),
+        # extras
+        ImportCase("src.map_utils", PANDAS_STACK + ("folium",)),
+    ]
+
+
+class ImportResult(NamedTuple):
+    """Result of the import.
+
+    seconds - minimum wall time of the import
+    heavy - heavy modules loaded by the import
+    """
+
+    seconds: float
+    heavy: List[str]
+
+
+def measure(case: ImportCase, repeat: int = 3) -> ImportResult:
+    """Import the module 'repeat' times, each in a new interpreter."""
+    script = _IMPORT_SCRIPT.format(module=case.module, heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=_ROOT,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    return ImportResult(min(run["seconds"] for run in runs), runs[0]["heavy"])
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Command line entry point, run with --help for arguments."""
+    parser = argparse.ArgumentParser(description="Measure import time of modules.")
+    parser.add_argument("--repeat", type=int, default=3, help="imports per module")
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        default=None,
+        help="fail if the import of a core module (no heavy modules allowed) is slower",
+    )
+    args = parser.parse_args(argv)
+
+    n_failures = 0
+    for case in all_cases():
+        res = measure(case, repeat=args.repeat)
+        unexpected = sorted(set(res.heavy) - set(case.allowed))
+        too_slow = (
+            args.max_seconds is not None
+            and not case.allowed
+            and res.seconds > args.max_seconds
+        )
+        status = "ok"
+        if unexpected:
+            status = "imports " + ",".join(unexpected)
+        elif too_slow:
+            status = "too slow"
+        n_failures += status != "ok"
+        print(f"{case.module:30s} {res.seconds:8.3f} s  {status}", flush=True)
+
+    if n_failures > 0:
+        print(f"Failures: {n_failures}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Measure wall time and peak memory of the main code paths.
+
+Results are saved to JSON and optionally compared with a baseline file
+produced by an earlier run, cases which became slower (or use more memory)
+than the threshold are reported and the exit code is 1.
+
+Usage:
+    python -m benchmarks.run_benchmarks --output results.json
+    python -m benchmarks.run_benchmarks --baseline results.json --quick
+"""
+import argparse
+import contextlib
+import functools
+import gc
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from src import geometry_converter, nearby_tiles, np_tiles_converter
+
+
+class Case(NamedTuple):
+    """Single benchmark case.
+
+    name - unique name, used to match results with the baseline
+    setup - returns arguments of 'run', not measured
+    run - measured function
+    items - number of processed items (points, tiles) for throughput
+    quick - if True, case is included into the quick run
+    """
+
+    name: str
+    setup: Callable[[], Sequence[Any]]
+    run: Callable[..., Any]
+    items: int
+    quick: bool
+
+
+def _coords_case(func_name: str, n_points: int, zoom: int, quick: bool) -> Case:
+    """Throughput of np_deg2idx or np_idx2deg."""
+    if func_name == "np_deg2idx":
+
+        def setup() -> Sequence[Any]:
+            df_points = synthetic.london_points(n_points)
+            return df_points["lat"].values, df_points["lon"].values, zoom
+
+        run: Callable[..., Any] = np_tiles_converter.np_deg2idx
+    else:
+
+        def setup() -> Sequence[Any]:
+            df_points = synthetic.london_points(n_points)
+            xtile, ytile = np_tiles_converter.np_deg2idx(
+                df_points["lat"].values, df_points["lon"].values, zoom
+            )
+            return xtile, ytile, zoom
+
+        run = np_tiles_converter.np_idx2deg
+
+    return Case(f"{func_name}[n={n_points},zoom={zoom}]", setup, run, n_points, quick)
+
+
+def _nearby_case(
+    n_points: int, zoom: int, radius: float, quick: bool, n_jobs: int = 1
+) -> Case:
+    """Time of get_nearby_tiles, serial or in a pool of 'n_jobs' processes."""
+
+    def setup() -> Sequence[Any]:
+        return synthetic.london_points(n_points), zoom, radius
+
+    jobs = f",n_jobs={n_jobs}" if n_jobs != 1 else ""
+    return Case(
+        f"get_nearby_tiles[n={n_points},zoom={zoom},radius={radius}{jobs}]",
+        setup,
+        functools.partial(nearby_tiles.get_nearby_tiles, n_jobs=n_jobs),
+        n_points,
+        quick,
+    )
+
+
+def _polygon_case(zoom: int, quick: bool) -> Case:
+    """Time of polygon_to_tiles for the London polygon."""
+
+    def setup() -> Sequence[Any]:
+        return synthetic.london_polygon(), zoom
+
+    # number of tiles inside the polygon, roughly 4 times more each zoom level
+    n_tiles = int(703483 / 4 ** (19 - zoom))
+    return Case(
+        f"polygon_to_tiles[zoom={zoom}]",
+        setup,
+        geometry_converter.polygon_to_tiles,
+        n_tiles,
+        quick,
+    )
+
+
+def all_cases() -> List[Case]:
+    """Return list of all benchmark cases."""
+    cases = []
+    for n_points in [100_000, 1_000_000, 10_000_000]:
+        for func_name in ["np_deg2idx", "np_idx2deg"]:
+            cases.append(_coords_case(func_name, n_points, 19, n_points <= 1_000_000))
+
+    # scaling over number of points, radius and zoom
+    for n_points in [1_000, 5_000, 20_000, 50_000]:
+        cases.append(_nearby_case(n_points, 18, 500, n_points <= 5_000))
+    for radius in [100, 300, 1000, 2000]:
+        cases.append(_nearby_case(2_000, 18, radius, radius <= 1000))
+    for zoom in [14, 16, 18, 20]:
+        cases.append(_nearby_case(2_000, zoom, 500, zoom <= 18))
+    # scaling over number of processes
+    for n_jobs in [2, 4, 8]:
+        cases.append(_nearby_case(50_000, 18, 500, False, n_jobs=n_jobs))
+
+    for zoom in [13, 15, 17, 19]:
+        cases.append(_polygon_case(zoom, zoom <= 17))
+    return cases
+
+
+def measure(case: Case, repeat: int = 3) -> Dict[str, float]:
+    """Measure wall time (minimum and median of 'repeat' runs) and peak memory.
+
+    Cases are measured after one warm-up run, which fills lazily built tables
+    and caches. Peak memory is the largest amount of memory traced by
+    'tracemalloc' (numpy and pandas buffers included) during a separate run,
+    so tracing does not slow down the timed runs.
+    """
+    args = case.setup()
+    with contextlib.redirect_stdout(io.StringIO()):
+        case.run(*args)
+
+    wall_times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        # functions may print progress, keep the report clean
+        with contextlib.redirect_stdout(io.StringIO()):
+            case.run(*args)
+        wall_times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            case.run(*args)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    wall_min = min(wall_times)
+    return {
+        "wall_s": wall_min,
+        "wall_median_s": statistics.median(wall_times),
+        "peak_mb": peak_bytes / 2**20,
+        "items": case.items,
+        "items_per_s": case.items / wall_min if wall_min > 0 else float("inf"),
+    }
+
+
+def run_benchmarks(
+    cases: Sequence[Case], repeat: int = 3, verbose: bool = True
+) -> Dict[str, Any]:
+    """Run cases and return results with the environment description."""
+    results = {}
+    for case in cases:
+        results[case.name] = measure(case, repeat=repeat)
+        if verbose:
+            res = results[case.name]
+            print(
+                f"{case.name:55s} {res['wall_s']:9.4f} s {res['peak_mb']:9.1f} MB",
+                flush=True,
+            )
+
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.2
+) -> pd.DataFrame:
+    """Compare results with the baseline.
+
+    Arguments:
+        results - output of 'run_benchmarks'
+        baseline - output of 'run_benchmarks' of the reference version
+        threshold - relative increase of wall time or peak memory
+            which counts as a regression, 0.2 = 20%
+
+    Returns:
+        DataFrame with one row per case present in both runs: columns "case",
+        "wall_ratio", "peak_ratio" (new / baseline) and "regression"
+    """
+    rows = []
+    for name, res in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        wall_ratio = res["wall_s"] / max(base["wall_s"], 1e-9)
+        peak_ratio = res["peak_mb"] / max(base["peak_mb"], 1e-9)
+        rows.append(
+            {
+                "case": name,
+                "wall_ratio": wall_ratio,
+                "peak_ratio": peak_ratio,
+                "regression": wall_ratio > 1 + threshold or peak_ratio > 1 + threshold,
+            }
+        )
+    return pd.DataFrame(
+        rows, columns=["case", "wall_ratio", "peak_ratio", "regression"]
+    )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Command line entry point, run with --help for arguments."""
+    parser = argparse.ArgumentParser(description="Run benchmarks of the library.")
+    parser.add_argument("--output", help="save results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results from this JSON file")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="regression threshold, 0.2 = 20%%"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--quick", action="store_true", help="run small cases only")
+    parser.add_argument("--filter", default="", help="run cases containing substring")
+    args = parser.parse_args(argv)
+
+    cases = [
+        case
+        for case in all_cases()
+        if (case.quick or not args.quick) and args.filter in case.name
+    ]
+    results = run_benchmarks(cases, repeat=args.repeat)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    df_compare = compare(results, baseline, threshold=args.threshold)
+    print(df_compare.to_string(index=False, float_format="{:.2f}".format))
+
+    n_regressions = int(df_compare["regression"].sum())
+    if n_regressions > 0:
+        print(f"Regressions: {n_regressions}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
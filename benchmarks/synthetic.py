@@ -0,0 +1,60 @@
+"""Synthetic datasets of any size seeded from the London samples in 'data'."""
+import functools
+import os
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+if TYPE_CHECKING:
+    from shapely.geometry.polygon import Polygon
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
+# Standard deviation of the noise added to sampled points, ~50 meters
+JITTER_DEG = 0.0005
+
+
+@functools.lru_cache(maxsize=None)
+def _load_parquet(name: str) -> pd.DataFrame:
+    """Read parquet file from the data directory (cached)."""
+    return pd.read_parquet(os.path.join(DATA_DIR, name))
+
+
+def _sample(df_seed: pd.DataFrame, n_points: int, seed: int) -> pd.DataFrame:
+    """Sample points with replacement and move them by random noise."""
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, df_seed.shape[0], n_points)
+    return pd.DataFrame(
+        {
+            "lat": df_seed["lat"].values[rows] + rng.normal(0, JITTER_DEG, n_points),
+            "lon": df_seed["lon"].values[rows] + rng.normal(0, JITTER_DEG, n_points),
+        }
+    )
+
+
+def london_points(n_points: int, seed: int = 0) -> pd.DataFrame:
+    """Return 'n_points' locations distributed like 'data/10k_london_coords.parquet'.
+
+    Returns:
+        DataFrame with columns "lat", "lon"
+    """
+    return _sample(_load_parquet("10k_london_coords.parquet"), n_points, seed)
+
+
+def london_pois(n_points: int, seed: int = 0) -> pd.DataFrame:
+    """Return 'n_points' POIs distributed like 'data/london_pubs.parquet'.
+
+    Returns:
+        DataFrame with columns "lat", "lon"
+    """
+    return _sample(_load_parquet("london_pubs.parquet"), n_points, seed)
+
+
+@functools.lru_cache(maxsize=None)
+def london_polygon() -> "Polygon":
+    """Return polygon of London from 'data/london_poly.geojson'."""
+    # pylint: disable=import-outside-toplevel
+    import geopandas as gpd
+
+    return gpd.read_file(os.path.join(DATA_DIR, "london_poly.geojson")).geometry[0]
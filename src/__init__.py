@@ -1 +1,96 @@
-"""Main module."""
+"""Main module.
+
+The core API (tile conversions and tile keys) needs only numpy and is
+available directly from the package, e.g. 'src.np_deg2idx'. Submodules
+and functions are imported on first access, so importing the package
+costs nothing and heavy optional dependencies are loaded only by the
+modules which need them:
+
+    geometry - 'geometry_converter' (shapely, geopandas)
+    plot - 'map_utils' (folium)
+    osm - 'osm_load.get_pub_data' (osmnx)
+    arrow - 'arrow_converter', Parquet output of 'nearby_tiles' (pyarrow)
+    sparse - sparse output of 'nearby_tiles' (scipy)
+"""
+import importlib
+from typing import TYPE_CHECKING, Any, List
+
+if TYPE_CHECKING:
+    from src.np_tiles_converter import (
+        np_deg2frac,
+        np_deg2idx,
+        np_haversin,
+        np_idx2deg,
+        np_tile_haversin,
+        tile_size_meters,
+        zoom_power,
+    )
+    from src.tile_keys import (
+        children_keys,
+        decode_tile_keys,
+        deg2key,
+        encode_tile_keys,
+        parent_keys,
+    )
+
+# name of the core function: module which defines it
+_CORE_API = {
+    "zoom_power": "np_tiles_converter",
+    "np_deg2idx": "np_tiles_converter",
+    "np_deg2frac": "np_tiles_converter",
+    "np_idx2deg": "np_tiles_converter",
+    "np_haversin": "np_tiles_converter",
+    "np_tile_haversin": "np_tiles_converter",
+    "tile_size_meters": "np_tiles_converter",
+    "encode_tile_keys": "tile_keys",
+    "decode_tile_keys": "tile_keys",
+    "deg2key": "tile_keys",
+    "parent_keys": "tile_keys",
+    "children_keys": "tile_keys",
+}
+
+_SUBMODULES = (
+    "anchor_locations",
+    "arrow_converter",
+    "geometry_converter",
+    "heatmap_tiles",
+    "instrumentation",
+    "kernels",
+    "map_utils",
+    "nearby_tiles",
+    "np_tiles_converter",
+    "osm_load",
+    "parquet_pipeline",
+    "plot_utils",
+    "poi_index",
+    "shared_arrays",
+    "single_tile_converter",
+    "stencil",
+    "tile_cover",
+    "tile_keys",
+    "tile_pyramid",
+    "tile_similarity",
+    "track_converter",
+)
+
+__all__ = list(_CORE_API)
+
+
+def __getattr__(name: str) -> Any:
+    """Import submodule or core function on first access."""
+    if name in _CORE_API:
+        module = importlib.import_module(f"{__name__}.{_CORE_API[name]}")
+        value = getattr(module, name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f"{__name__}.{name}")
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # next access does not call __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    """List core functions and submodules, including not imported ones."""
+    return sorted(set(globals()) | set(_CORE_API) | set(_SUBMODULES))
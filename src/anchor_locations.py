@@ -0,0 +1,273 @@
+"""Find anchor locations of customers: home (night) and work (day) tiles."""
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import tile_keys
+
+# Hours are local time of the pings, weekdays: Monday = 0, ..., Sunday = 6
+NIGHT_HOURS = (22, 23, 0, 1, 2, 3, 4, 5)
+DAY_HOURS = (9, 10, 11, 12, 13, 14, 15, 16, 17)
+WORK_DAYS = (0, 1, 2, 3, 4)
+
+# 1970-01-01 was Thursday
+_EPOCH_WEEKDAY = 3
+_HOURS_IN_WEEK = 7 * 24
+
+
+def hour_of_week(timestamps: np.ndarray) -> np.ndarray:
+    """Return hour of the week: weekday * 24 + hour, Monday 00:00 is 0."""
+    hours = timestamps.astype("datetime64[h]").astype(np.int64)
+    how: np.ndarray = (hours + _EPOCH_WEEKDAY * 24) % _HOURS_IN_WEEK
+    return how
+
+
+def _hours_mask(hours: Sequence[int], days: Sequence[int]) -> np.ndarray:
+    """Return boolean mask of the hours of the week."""
+    mask = np.zeros(_HOURS_IN_WEEK, dtype=bool)
+    for day in days:
+        mask[day * 24 + np.asarray(hours, dtype=np.int64)] = True
+    return mask
+
+
+def tile_hour_histogram(
+    customer_codes: np.ndarray, keys: np.ndarray, how: np.ndarray, zoom: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Count pings of every customer in every tile and hour of the week.
+
+    Histogram is sparse: only non-empty (customer, tile, hour) cells are kept.
+    Cells are found by sorting a single packed int64 key; if customer codes
+    do not fit into the key (e.g. millions of customers at high zoom),
+    customers and packed (tile, hour) keys are sorted as two columns.
+
+    Arguments:
+        customer_codes - integer codes of customers, from 0 to n_customers - 1
+        keys - tile keys (see 'tile_keys') at 'zoom'
+        how - hour of the week of every ping
+
+    Returns:
+        customer_codes, keys, how, counts - non-empty cells sorted by
+        customer, tile and hour
+    """
+    # packed key: customer | tile key | hour of the week (8 bits)
+    key_bits = 2 * zoom + 1
+    tile_hour = (keys.astype(np.int64) << 8) | how
+    if customer_codes.max(initial=0) < 2 ** (63 - key_bits - 8):
+        packed = (customer_codes.astype(np.int64) << (key_bits + 8)) | tile_hour
+        cells, counts = np.unique(packed, return_counts=True)
+        cell_customer = cells >> (key_bits + 8)
+        cell_tile_hour = cells & ((1 << (key_bits + 8)) - 1)
+    else:
+        order = np.lexsort((tile_hour, customer_codes))
+        sorted_customer = customer_codes[order].astype(np.int64)
+        sorted_tile_hour = tile_hour[order]
+        starts = np.flatnonzero(
+            (np.diff(sorted_customer, prepend=-1) != 0)
+            | (np.diff(sorted_tile_hour, prepend=-1) != 0)
+        )
+        counts = np.diff(np.append(starts, order.shape[0]))
+        cell_customer = sorted_customer[starts]
+        cell_tile_hour = sorted_tile_hour[starts]
+
+    return cell_customer, cell_tile_hour >> 8, cell_tile_hour & 0xFF, counts
+
+
+def detect_anchors(
+    df_pings: pd.DataFrame,
+    zoom: int = 17,
+    customer_col: str = "customer_id",
+    time_col: str = "timestamp",
+    top_n: int = 1,
+    smooth: bool = False,
+    n_partitions: int = 1,
+) -> pd.DataFrame:
+    """Find home and work tiles of every customer.
+
+    Pings are tiled and aggregated into sparse histograms over
+    (customer, tile, hour of the week). Night anchor (home) is the tile where
+    the customer is seen during NIGHT_HOURS the most, day anchor (work) is the
+    tile where the customer is seen during DAY_HOURS of WORK_DAYS the most.
+
+    Dwell score of a tile is the number of different hours of the week
+    in the time window when the customer had pings in the tile, so customers
+    with frequent pings do not outweigh regular presence.
+    With 'smooth' half of the scores of 8 adjacent tiles is added to the score,
+    it helps when pings of a single place are split between adjacent tiles.
+
+    Customers are split into 'n_partitions' groups which are processed one by one,
+    so temporary memory is limited by the size of a single partition.
+
+    Arguments:
+        df_pings - have columns customer id, timestamp (datetime, local time),
+            "lat" and "lon"
+        zoom - integer, zoom level of the tiles
+        customer_col - column with customer id
+        time_col - column with ping time
+        top_n - integer, number of anchors of each type per customer
+        smooth - if True, add scores of adjacent tiles
+        n_partitions - integer, number of customer partitions
+
+    Returns:
+        DataFrame with columns customer id, "anchor" ("home" or "work"),
+        "rank" (starting from 1), "tile_idx_x", "tile_idx_y",
+        "dwell_score", "n_pings"
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    assert customer_col in df_pings.columns
+    assert time_col in df_pings.columns
+    assert n_partitions >= 1
+
+    customer_codes, customer_ids = pd.factorize(df_pings[customer_col])
+    partition = customer_codes % n_partitions
+    # rows of every partition are a slice of the rows sorted by partition
+    partition_order = np.argsort(partition, kind="stable")
+    partition_ends = np.cumsum(np.bincount(partition, minlength=n_partitions))
+    anchors = [
+        ("home", _hours_mask(NIGHT_HOURS, range(7))),
+        ("work", _hours_mask(DAY_HOURS, WORK_DAYS)),
+    ]
+
+    results: List[pd.DataFrame] = []
+    for part, part_end in enumerate(partition_ends):
+        part_start = partition_ends[part - 1] if part > 0 else 0
+        rows = partition_order[part_start:part_end]
+        if rows.shape[0] == 0:
+            continue
+
+        part_codes = customer_codes[rows] // n_partitions
+        keys = tile_keys.deg2key(
+            df_pings["lat"].values[rows], df_pings["lon"].values[rows], zoom
+        )
+        how = hour_of_week(df_pings[time_col].values[rows])
+        cells = tile_hour_histogram(part_codes, keys, how, zoom)
+
+        for anchor, hours_mask in anchors:
+            df_anchor = _top_tiles(cells, hours_mask, zoom, top_n, smooth)
+            df_anchor.insert(
+                0,
+                customer_col,
+                customer_ids[df_anchor.pop("customer") * n_partitions + part],
+            )
+            df_anchor.insert(1, "anchor", anchor)
+            results.append(df_anchor)
+
+    if not results:
+        return pd.DataFrame(
+            columns=[customer_col, "anchor", "rank", "tile_idx_x", "tile_idx_y"]
+            + ["dwell_score", "n_pings"]
+        )
+
+    df_anchors = pd.concat(results, ignore_index=True)
+    return df_anchors.sort_values(
+        [customer_col, "anchor", "rank"], ignore_index=True, kind="stable"
+    )
+
+
+def _top_tiles(
+    cells: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    hours_mask: np.ndarray,
+    zoom: int,
+    top_n: int,
+    smooth: bool,
+) -> pd.DataFrame:
+    """Score (customer, tile) pairs within hours mask and keep the best ones."""
+    # pylint: disable=too-many-locals
+    cell_customer, cell_keys, cell_how, cell_counts = cells
+    filt = hours_mask[cell_how]
+
+    # cells are sorted by customer and tile: segment sums over (customer, tile)
+    customer = cell_customer[filt]
+    keys = cell_keys[filt]
+    starts = np.flatnonzero(
+        (np.diff(customer, prepend=-1) != 0) | (np.diff(keys, prepend=-1) != 0)
+    )
+    customer = customer[starts]
+    keys = keys[starts]
+    dwell_score = np.diff(np.append(starts, filt.sum())).astype(np.float64)
+    n_pings = np.add.reduceat(cell_counts[filt], starts) if starts.shape[0] else starts
+
+    xtile, ytile, _ = tile_keys.decode_tile_keys(keys)
+
+    if smooth and keys.shape[0] > 0:
+        smoothed = dwell_score.copy()
+        find_tiles = _tile_finder(customer, keys, zoom)
+        max_idx = (1 << zoom) - 1
+        for shift_x, shift_y in [
+            (-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)
+        ]:  # fmt: skip
+            nbr_x = np.clip(xtile + shift_x, 0, max_idx)
+            nbr_y = np.clip(ytile + shift_y, 0, max_idx)
+            pos, found = find_tiles(tile_keys.encode_tile_keys(nbr_x, nbr_y, zoom))
+            found &= (nbr_x != xtile) | (nbr_y != ytile)
+            smoothed[found] += 0.5 * dwell_score[pos[found]]
+        dwell_score = smoothed
+
+    # best tiles first inside every customer
+    order = np.lexsort((-n_pings, -dwell_score, customer))
+    customer = customer[order]
+    first = np.flatnonzero(np.diff(customer, prepend=-1))
+    rank = np.arange(customer.shape[0]) - np.repeat(
+        first, np.diff(np.append(first, customer.shape[0]))
+    )
+    keep = order[rank < top_n]
+
+    return pd.DataFrame(
+        {
+            "customer": customer[rank < top_n],
+            "rank": rank[rank < top_n] + 1,
+            "tile_idx_x": xtile[keep],
+            "tile_idx_y": ytile[keep],
+            "dwell_score": dwell_score[keep],
+            "n_pings": n_pings[keep],
+        }
+    )
+
+
+def _tile_finder(
+    customer: np.ndarray, keys: np.ndarray, zoom: int
+) -> Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """Return function finding tiles of the same customer.
+
+    Arguments:
+        customer, keys - (customer, tile key) pairs sorted by customer and key
+
+    Returns:
+        function of tile keys (one per pair) returning positions of pairs
+        (customer, key) and mask of the found ones
+    """
+    # tiles of every customer are a sorted segment of 'keys'
+    first = np.flatnonzero(np.diff(customer, prepend=-1))
+    lengths = np.diff(np.append(first, customer.shape[0]))
+    last = keys.shape[0] - 1
+
+    key_bits = 2 * zoom + 1
+    if first.shape[0] < 2 ** (63 - key_bits):
+        # packed key: rank of the customer | tile key
+        rank = np.repeat(np.arange(first.shape[0], dtype=np.int64), lengths)
+        packed = (rank << key_bits) | keys
+
+        def find_packed(query: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            query = (rank << key_bits) | query
+            pos = np.minimum(np.searchsorted(packed, query), last)
+            return pos, packed[pos] == query
+
+        return find_packed
+
+    # too many customers for packed keys: search the segment of the customer
+    start = np.repeat(first, lengths)
+    end = start + np.repeat(lengths, lengths)
+
+    def find_pairs(query: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        low, high = start.copy(), end.copy()
+        active = low < high
+        while active.any():
+            mid = (low + high) // 2
+            right = active & (keys[np.minimum(mid, last)] < query)
+            low = np.where(right, mid + 1, low)
+            high = np.where(active & ~right, mid, high)
+            active = low < high
+        pos = np.minimum(low, last)
+        return pos, (low < end) & (keys[pos] == query)
+
+    return find_pairs
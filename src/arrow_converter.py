@@ -0,0 +1,244 @@
+"""Tile converters working directly on Apache Arrow data.
+
+Same conversions as 'np_tiles_converter' and 'nearby_tiles', but inputs are
+pyarrow Array, ChunkedArray, RecordBatch or Table and outputs are Arrow
+arrays and tables. Every chunk is processed through numpy views of its
+value buffers, so float64/integer inputs are never copied. Nulls are kept
+in the validity bitmaps: values under null slots are converted as is
+and masked in the output.
+"""
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+from numpy.typing import DTypeLike
+
+from src import nearby_tiles, np_tiles_converter
+
+ArrowArray = Union[pa.Array, pa.ChunkedArray]
+ArrowBatch = Union[pa.RecordBatch, pa.Table]
+
+
+def _chunks(arr: ArrowArray) -> List[pa.Array]:
+    """Return list of chunks of Array or ChunkedArray."""
+    if isinstance(arr, pa.ChunkedArray):
+        return list(arr.chunks)
+    return [arr]
+
+
+def _aligned_chunks(
+    arr_a: ArrowArray, arr_b: ArrowArray
+) -> Tuple[List[pa.Array], List[pa.Array]]:
+    """Return chunks of two arrays, chunks with the same position have same rows.
+
+    Columns of RecordBatch and Table are always aligned, arrays with
+    different chunk layouts are combined into single chunks (copy).
+    """
+    assert len(arr_a) == len(arr_b)
+    chunks_a = _chunks(arr_a)
+    chunks_b = _chunks(arr_b)
+    if [len(chunk) for chunk in chunks_a] != [len(chunk) for chunk in chunks_b]:
+        chunks_a = [pa.concat_arrays(chunks_a)] if chunks_a else []
+        chunks_b = [pa.concat_arrays(chunks_b)] if chunks_b else []
+    return chunks_a, chunks_b
+
+
+def _values_view(chunk: pa.Array, dtype: DTypeLike) -> np.ndarray:
+    """Return numpy view of the values buffer of the chunk.
+
+    Chunks of other types are cast to 'dtype' (copy).
+    """
+    arrow_type = pa.from_numpy_dtype(dtype)
+    if chunk.type != arrow_type:
+        chunk = chunk.cast(arrow_type)
+    if len(chunk) == 0:
+        return np.array([], dtype=dtype)
+
+    buffer = chunk.buffers()[1]
+    values: np.ndarray = np.frombuffer(
+        buffer, dtype=dtype, count=chunk.offset + len(chunk)
+    )[chunk.offset :]
+    return values
+
+
+def _index_dtype(chunk: pa.Array) -> np.dtype:
+    """Return numpy dtype of integer chunk, int64 for other types."""
+    dtype = np.dtype(np.int64)
+    if pa.types.is_integer(chunk.type):
+        dtype = np.dtype(chunk.type.to_pandas_dtype())
+    return dtype
+
+
+def _validity(*chunks: pa.Array) -> Optional[np.ndarray]:
+    """Return boolean mask of rows valid in all chunks, None if there are no nulls."""
+    with_nulls = [chunk for chunk in chunks if chunk.null_count > 0]
+    if not with_nulls:
+        return None
+    valid: np.ndarray = np.logical_and.reduce(
+        [chunk.is_valid().to_numpy(zero_copy_only=False) for chunk in with_nulls]
+    )
+    return valid
+
+
+def _to_arrow(values: np.ndarray, valid: Optional[np.ndarray]) -> pa.Array:
+    """Wrap numpy array into Arrow array, rows not valid become nulls."""
+    if valid is None:
+        return pa.array(values)
+    return pa.array(values, mask=~valid)
+
+
+def _same_kind(arr: ArrowArray, chunks: List[pa.Array], arrow_type) -> ArrowArray:
+    """Return chunks as ChunkedArray if 'arr' is chunked, otherwise as Array."""
+    if isinstance(arr, pa.ChunkedArray):
+        return pa.chunked_array(chunks, type=arrow_type)
+    return chunks[0] if chunks else pa.array([], type=arrow_type)
+
+
+def arrow_deg2idx(
+    lat_deg: ArrowArray, lon_deg: ArrowArray, zoom: int
+) -> Tuple[ArrowArray, ArrowArray]:
+    """Convert degrees of latitude and longitude to x,y tile coordinates.
+
+    Arrow version of 'np_tiles_converter.np_deg2idx'.
+
+    Arguments:
+        lat_deg - pyarrow Array or ChunkedArray, degrees of latitude
+        lon_deg - pyarrow Array or ChunkedArray, degrees of longitude
+        zoom - integer, zoom level of the tiles
+
+    Returns:
+        xtile, ytile - int32 Arrow arrays of the same kind as 'lat_deg',
+        null if latitude or longitude is null
+    """
+    xtile_chunks = []
+    ytile_chunks = []
+    for lat_chunk, lon_chunk in zip(*_aligned_chunks(lat_deg, lon_deg)):
+        valid = _validity(lat_chunk, lon_chunk)
+        # undefined values under nulls may be NaN
+        with np.errstate(invalid="ignore"):
+            xtile, ytile = np_tiles_converter.np_deg2idx(
+                _values_view(lat_chunk, np.float64),
+                _values_view(lon_chunk, np.float64),
+                zoom,
+            )
+        xtile_chunks.append(_to_arrow(xtile, valid))
+        ytile_chunks.append(_to_arrow(ytile, valid))
+
+    return (
+        _same_kind(lat_deg, xtile_chunks, pa.int32()),
+        _same_kind(lat_deg, ytile_chunks, pa.int32()),
+    )
+
+
+def arrow_idx2deg(
+    xtile: ArrowArray, ytile: ArrowArray, zoom: int, offset: float = 0.5
+) -> Tuple[ArrowArray, ArrowArray]:
+    """Convert tile index back to latitude and longitude.
+
+    Arrow version of 'np_tiles_converter.np_idx2deg'.
+
+    Arguments:
+        xtile - pyarrow Array or ChunkedArray of integers, tile x coordinate
+        ytile - pyarrow Array or ChunkedArray of integers, tile y coordinate
+        zoom - integer, zoom level of the tiles
+        offset - which coordinate inside the tile to return, 0.5 - center
+
+    Returns:
+        lat_deg, lon_deg - float64 Arrow arrays of the same kind as 'xtile'
+    """
+    lat_chunks = []
+    lon_chunks = []
+    for x_chunk, y_chunk in zip(*_aligned_chunks(xtile, ytile)):
+        valid = _validity(x_chunk, y_chunk)
+        lat_deg, lon_deg = np_tiles_converter.np_idx2deg(
+            _values_view(x_chunk, _index_dtype(x_chunk)),
+            _values_view(y_chunk, _index_dtype(y_chunk)),
+            zoom,
+            offset=offset,
+        )
+        lat_chunks.append(_to_arrow(lat_deg, valid))
+        lon_chunks.append(_to_arrow(lon_deg, valid))
+
+    return (
+        _same_kind(xtile, lat_chunks, pa.float64()),
+        _same_kind(xtile, lon_chunks, pa.float64()),
+    )
+
+
+def arrow_add_tiles(
+    batch: ArrowBatch,
+    zoom: int,
+    lat_col: str = "lat",
+    lon_col: str = "lon",
+) -> ArrowBatch:
+    """Append columns "tile_idx_x" and "tile_idx_y" to RecordBatch or Table.
+
+    Input columns are not copied, result is of the same type as 'batch'.
+    """
+    xtile, ytile = arrow_deg2idx(batch.column(lat_col), batch.column(lon_col), zoom)
+    names = batch.schema.names + ["tile_idx_x", "tile_idx_y"]
+    columns = list(batch.columns) + [xtile, ytile]
+    if isinstance(batch, pa.RecordBatch):
+        return pa.RecordBatch.from_arrays(columns, names=names)
+    return pa.Table.from_arrays(columns, names=names)
+
+
+def arrow_nearby_tiles(
+    batch: ArrowBatch,
+    zoom: int,
+    radius: float = 500,
+    lat_col: str = "lat",
+    lon_col: str = "lon",
+) -> pa.Table:
+    """Output all tiles in given distance from points of RecordBatch or Table.
+
+    Arrow version of 'nearby_tiles.get_nearby_tiles', chunks are expanded
+    one by one. Points with null coordinates have no tiles.
+
+    Returns:
+        Table with columns "coord_id" (int64, row of the point in 'batch'),
+        "tile_idx_x", "tile_idx_y" (int32)
+    """
+    assert radius > 0
+    assert 1 <= zoom <= 23
+
+    tables = []
+    start = 0
+    for lat_chunk, lon_chunk in zip(
+        *_aligned_chunks(batch.column(lat_col), batch.column(lon_col))
+    ):
+        lat_deg = _values_view(lat_chunk, np.float64)
+        lon_deg = _values_view(lon_chunk, np.float64)
+        chunk_start = start
+        start += len(lat_chunk)
+        valid = _validity(lat_chunk, lon_chunk)
+        if valid is not None:
+            lat_deg, lon_deg = lat_deg[valid], lon_deg[valid]
+
+        nbr_id, nbr_x, nbr_y, _ = nearby_tiles.nearby_tile_arrays(
+            lat_deg, lon_deg, zoom, radius
+        )
+        # positions of the expanded points to rows of 'batch'
+        if valid is None:
+            nbr_id += chunk_start
+        else:
+            nbr_id = chunk_start + np.flatnonzero(valid)[nbr_id]
+        tables.append(
+            pa.table(
+                {
+                    "coord_id": _to_arrow(nbr_id, None),
+                    "tile_idx_x": _to_arrow(nbr_x, None),
+                    "tile_idx_y": _to_arrow(nbr_y, None),
+                }
+            )
+        )
+
+    if not tables:
+        return pa.table(
+            {
+                "coord_id": pa.array([], type=pa.int64()),
+                "tile_idx_x": pa.array([], type=pa.int32()),
+                "tile_idx_y": pa.array([], type=pa.int32()),
+            }
+        )
+    return pa.concat_tables(tables)
@@ -1,76 +1,308 @@
-"""Converting closed polygon to tiles."""
-import geopandas as gpd
+"""Converting closed polygon to tiles.
+
+Polygons are filled in tile space with numpy, shapely is imported only
+to read coordinates of the rings, so importing the module is cheap.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+
 import numpy as np
 import pandas as pd
-from shapely.geometry.polygon import Polygon
 
+from src import instrumentation
 from src import np_tiles_converter as tiles_converter
+from src import tile_cover
+
+if TYPE_CHECKING:
+    import geopandas as gpd
+    from shapely.geometry import MultiPolygon, Polygon
+
+# Number of tasks per worker in 'polygons_to_tiles', more tasks balance load better
+TASKS_PER_WORKER = 8
 
 
-def _xy_combinations(x_arr: np.ndarray, y_arr: np.ndarray) -> np.ndarray:
-    """Fast cartesian product of two arrays.
+def polygon_to_tiles(
+    geo_polygon: Union["Polygon", "MultiPolygon"], zoom: int = 19
+) -> pd.DataFrame:
+    """Return all tiles lat/lon coords that are inside given polygon.
 
-    Given two arrays returns all combinations of their members.
-    any x <-> any y
+    Tile is inside polygon if its center is inside polygon and not inside
+    any of its holes.
+
+    Arguments:
+        geo_polygon - shapely Polygon or MultiPolygon with lon/lat coordinates
+        zoom - integer, zoom level of the tiles
     """
-    return np.dstack(np.meshgrid(x_arr, y_arr)).reshape(-1, 2)
+    df_runs = polygon_to_tile_runs(geo_polygon, zoom=zoom)
 
+    with instrumentation.stage("expand runs") as stg:
+        x_tiles, y_tiles = _expand_runs(
+            df_runs["tile_idx_y"].values,
+            df_runs["x_start"].values,
+            df_runs["x_end"].values,
+        )
 
-def polygon_to_tiles(geo_polygon: Polygon) -> pd.DataFrame:
-    """Return all tiles lat/lon coords that are inside given polygon."""
-    # pylint: disable=too-many-locals
-    assert isinstance(geo_polygon, Polygon)
+        # coordinates of tiles centers
+        center_lats, center_lons = tiles_converter.np_idx2deg(
+            x_tiles, y_tiles, zoom=zoom
+        )
+        stg.count(
+            runs=df_runs.shape[0],
+            inner_points=center_lats.shape[0],
+            nbytes=center_lats.nbytes + center_lons.nbytes,
+        )
+
+    df_coords = pd.DataFrame({"lat": center_lats, "lon": center_lons})
+
+    return df_coords
+
+
+def polygon_to_tile_runs(
+    geo_polygon: Union["Polygon", "MultiPolygon"], zoom: int = 19
+) -> pd.DataFrame:
+    """Return tiles inside given polygon as runs of tiles in tile rows.
+
+    Polygon is filled with scanline algorithm directly in tile space:
+    every tile row is crossed by a horizontal line through tile centers,
+    and tiles between odd and even crossings of the polygon edges (even-odd rule)
+    are inside. Work is proportional to the number of edges and rows crossed
+    by them, not to the area of the polygon. Interior rings (holes) are
+    filled with the same rule, so they are subtracted automatically.
+
+    Arguments:
+        geo_polygon - shapely Polygon or MultiPolygon with lon/lat coordinates
+        zoom - integer, zoom level of the tiles
 
-    # coordinates of the polygon boundary
-    # is is two dimensional array. Second dimension is equal to two
-    # it should have shape = [:,2] and first column = lon, second = lat (!!)
-    polygon_bound_coords = np.array(geo_polygon.exterior.coords)
+    Returns:
+        DataFrame with columns "tile_idx_y", "x_start", "x_end",
+        tiles from x_start to x_end (inclusive) in the row are inside polygon
+    """
+    with instrumentation.stage("scanline fill") as stg:
+        rings = _polygon_rings(geo_polygon)
+        run_y, run_x_start, run_x_end = _scanline_runs(rings, zoom)
+        if stg:
+            stg.count(
+                edges=sum(ring.shape[0] - 1 for ring in rings), runs=run_y.shape[0]
+            )
 
-    x_tiles_arr, y_tiles_arr = tiles_converter.np_deg2idx(
-        polygon_bound_coords[:, 1], polygon_bound_coords[:, 0], zoom=19
+    return pd.DataFrame(
+        {"tile_idx_y": run_y, "x_start": run_x_start, "x_end": run_x_end}
     )
 
-    # for linter
-    x_tiles_np: np.ndarray = x_tiles_arr
-    y_tiles_np: np.ndarray = y_tiles_arr
 
-    # Now we create list of all candidate tiles that could be inside our Polygon
-    min_x, max_x = x_tiles_np.min(), x_tiles_np.max()
-    min_y, max_y = y_tiles_np.min(), y_tiles_np.max()
-    all_x = np.arange(min_x, max_x + 1)
-    all_y = np.arange(min_y, max_y + 1)
-    tiles_idx = _xy_combinations(all_x, all_y)
+def polygon_to_cover(
+    geo_polygon: Union["Polygon", "MultiPolygon"], zoom: int = 19, min_zoom: int = 0
+) -> np.ndarray:
+    """Return minimal mixed-zoom cover of the polygon.
+
+    Same tiles as 'polygon_to_tiles', but every group of four sibling tiles
+    inside the polygon is replaced by their parent (up to 'min_zoom'),
+    so only tiles along the boundary stay at 'zoom'. Membership of points
+    or tiles is checked with 'tile_cover.cover_contains_points' and
+    'tile_cover.cover_contains'.
+
+    Arguments:
+        geo_polygon - shapely Polygon or MultiPolygon with lon/lat coordinates
+        zoom - integer, zoom level of the boundary tiles
+        min_zoom - integer, the coarsest zoom level of the cover
+
+    Returns:
+        cover - sorted numpy array of tile keys (see 'tile_keys') of mixed zoom
+    """
+    run_y, run_x_start, run_x_end = _scanline_runs(_polygon_rings(geo_polygon), zoom)
+    return tile_cover.runs_to_cover(run_y, run_x_start, run_x_end, zoom, min_zoom)
+
+
+def polygons_to_tiles(
+    df_polygons: "gpd.GeoDataFrame",
+    zoom: int = 19,
+    id_col: Optional[str] = None,
+    n_jobs: Optional[int] = None,
+) -> pd.DataFrame:
+    """Return tiles inside every polygon of GeoDataFrame.
 
-    # coordinates of tiles centers
-    center_lats, center_lons = tiles_converter.np_idx2deg(
-        tiles_idx[:, 0], tiles_idx[:, 1], zoom=19
+    Polygons are converted in a pool of processes. Work is split into tasks
+    of similar size: polygons are ordered by estimated cost (area of bounding
+    box in tiles plus number of vertices), the largest ones go first
+    and small polygons are grouped together, so that one big polygon
+    does not leave the other workers idle at the end.
+
+    Arguments:
+        df_polygons - GeoDataFrame with Polygon or MultiPolygon geometries
+            in lon/lat coordinates, holes are supported
+        zoom - integer, zoom level of the tiles
+        id_col - column with polygon ids, index of 'df_polygons' by default
+        n_jobs - number of processes, all cores by default, 1 - no pool
+
+    Returns:
+        DataFrame with columns "polygon_id", "tile_idx_x", "tile_idx_y"
+    """
+    # pylint: disable=too-many-locals
+    polygon_ids = (
+        df_polygons[id_col].values if id_col is not None else df_polygons.index.values
     )
+    polygon_rings = [_polygon_rings(geom) for geom in df_polygons.geometry.values]
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
 
-    # cleaning memory
-    del tiles_idx
+    # cost estimate: tiles in the bounding box and number of vertices
+    bounds = np.nan_to_num(df_polygons.geometry.bounds.values)
+    x_min, y_max = tiles_converter.np_deg2frac(bounds[:, 1], bounds[:, 0], zoom)
+    x_max, y_min = tiles_converter.np_deg2frac(bounds[:, 3], bounds[:, 2], zoom)
+    n_vertices = np.array(
+        [sum(ring.shape[0] for ring in rings) for rings in polygon_rings]
+    )
+    cost = (x_max - x_min + 1) * (y_max - y_min + 1) + n_vertices
 
-    df_polygon = gpd.GeoDataFrame(data={"geometry": [geo_polygon]})
+    # biggest polygons first, small ones are grouped up to the target task cost
+    target_cost = cost.sum() / (n_jobs * TASKS_PER_WORKER)
+    tasks: List[List[Tuple[int, List[np.ndarray]]]] = []
+    task_cost = target_cost
+    for pos in np.argsort(-cost, kind="stable"):
+        if task_cost >= target_cost:
+            tasks.append([])
+            task_cost = 0
+        tasks[-1].append((pos, polygon_rings[pos]))
+        task_cost += cost[pos]
 
-    # all candidates who might be inside our Polygon boundaries
-    candidate_pts = gpd.GeoSeries.from_xy(x=center_lons, y=center_lats)
-    # candidate_pts.set_crs(crs=df_polygon.crs,inplace=True)
-    candidate_pts.name = "geometry"
-    candidate_pts = candidate_pts.to_frame()
-    n_candidates = candidate_pts.shape[0]
+    if n_jobs == 1 or len(tasks) <= 1:
+        results = [_polygons_tiles_task(task, zoom) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_polygons_tiles_task, tasks, [zoom] * len(tasks)))
 
-    # processing this lines will take quite a while
-    print("Checking which points are inside polygon boundary", flush=True)
-    print(f"Count candidate points: {n_candidates}", flush=True)
+    # restore order of the input polygons
+    parts = sorted(part for result in results for part in result)
+    positions = np.array([pos for pos, _, _ in parts], dtype=np.int64)
+    n_tiles = np.array([x_tiles.shape[0] for _, x_tiles, _ in parts], dtype=np.int64)
+    empty = np.array([], dtype=np.int32)
 
-    inner_pts = gpd.tools.sjoin(
-        candidate_pts, df_polygon, predicate="within", how="inner"
+    df_tiles = pd.DataFrame(
+        {
+            "polygon_id": np.repeat(polygon_ids[positions], n_tiles),
+            "tile_idx_x": np.concatenate(
+                [empty] + [x_tiles for _, x_tiles, _ in parts]
+            ),
+            "tile_idx_y": np.concatenate(
+                [empty] + [y_tiles for _, _, y_tiles in parts]
+            ),
+        }
     )
 
-    n_inner_pts = inner_pts.shape[0]
-    print(f"Count points inside polygon: {n_inner_pts}", flush=True)
+    return df_tiles
+
+
+def _polygons_tiles_task(
+    task: List[Tuple[int, List[np.ndarray]]], zoom: int
+) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+    """Convert group of polygons to tiles, runs in a worker process.
 
-    df_coords = pd.DataFrame(
-        {"lat": inner_pts["geometry"].y.values, "lon": inner_pts["geometry"].x.values}
+    Arguments:
+        task - list of (position of the polygon, polygon rings)
+
+    Returns:
+        list of (position of the polygon, tiles x indexes, tiles y indexes)
+    """
+    result = []
+    for pos, rings in task:
+        x_tiles, y_tiles = _expand_runs(*_scanline_runs(rings, zoom))
+        result.append((pos, x_tiles.astype(np.int32), y_tiles.astype(np.int32)))
+    return result
+
+
+def _polygon_rings(geo_polygon: Union["Polygon", "MultiPolygon"]) -> List[np.ndarray]:
+    """Return coordinates of all exterior and interior rings of the geometry.
+
+    Each ring is an array with shape = [:,2], first column = lon, second = lat (!!)
+    """
+    # pylint: disable=import-outside-toplevel,redefined-outer-name
+    from shapely.geometry import MultiPolygon, Polygon
+
+    if isinstance(geo_polygon, MultiPolygon):
+        return [ring for part in geo_polygon.geoms for ring in _polygon_rings(part)]
+
+    assert isinstance(geo_polygon, Polygon)
+    if geo_polygon.is_empty:
+        return []
+
+    rings = [geo_polygon.exterior] + list(geo_polygon.interiors)
+    return [np.array(ring.coords)[:, :2] for ring in rings]
+
+
+def _scanline_runs(
+    rings: List[np.ndarray], zoom: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fill closed rings with even-odd rule, return runs of inner tiles.
+
+    Arguments:
+        rings - list of arrays with shape = [:,2], columns lon, lat;
+            first and last points of each ring are the same
+
+    Returns:
+        run_y - tile row of the run
+        run_x_start - first tile of the run
+        run_x_end - last tile of the run (inclusive)
+    """
+    # pylint: disable=too-many-locals
+    zoom_mult = int(tiles_converter.zoom_power(zoom))
+    if not rings:
+        return (np.array([], dtype=np.int64),) * 3
+
+    # polygon edges: start and end vertexes of each edge
+    lon_a = np.concatenate([ring[:-1, 0] for ring in rings])
+    lat_a = np.concatenate([ring[:-1, 1] for ring in rings])
+    lon_b = np.concatenate([ring[1:, 0] for ring in rings])
+    lat_b = np.concatenate([ring[1:, 1] for ring in rings])
+
+    # fractional tile row of every vertex, rows go from north to south
+    _, frac_y_a = tiles_converter.np_deg2frac(lat_a, lon_a, zoom)
+    _, frac_y_b = tiles_converter.np_deg2frac(lat_b, lon_b, zoom)
+
+    # edge crosses row if center latitude of the row is in [lat_min, lat_max),
+    # i.e. if frac_y(lat_max) < row + 0.5 <= frac_y(lat_min)
+    first_row = np.floor(np.minimum(frac_y_a, frac_y_b) - 0.5).astype(np.int64) + 1
+    last_row = np.floor(np.maximum(frac_y_a, frac_y_b) - 0.5).astype(np.int64)
+    first_row = np.maximum(first_row, 0)
+    last_row = np.minimum(last_row, zoom_mult - 1)
+    n_rows = np.maximum(last_row - first_row + 1, 0)
+
+    # one crossing per (edge, row) pair
+    edge_id = np.repeat(np.arange(n_rows.shape[0]), n_rows)
+    cross_row = first_row[edge_id] + (
+        np.arange(edge_id.shape[0]) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
     )
 
-    return df_coords
+    center_lat, _ = tiles_converter.np_idx2deg(
+        np.zeros_like(cross_row), cross_row, zoom=zoom
+    )
+    share = (center_lat - lat_a[edge_id]) / (lat_b[edge_id] - lat_a[edge_id])
+    cross_lon = lon_a[edge_id] + share * (lon_b[edge_id] - lon_a[edge_id])
+    cross_x = (cross_lon + 180) / 360 * zoom_mult
+
+    # crossings in each row sorted left to right, pairs of them bound the runs
+    order = np.lexsort((cross_x, cross_row))
+    cross_row = cross_row[order]
+    cross_x = cross_x[order]
+
+    run_y = cross_row[0::2]
+    # tiles with centers (x + 0.5) in [x_in, x_out)
+    run_x_start = np.ceil(cross_x[0::2] - 0.5).astype(np.int64)
+    run_x_end = np.ceil(cross_x[1::2] - 0.5).astype(np.int64) - 1
+    run_x_start = np.maximum(run_x_start, 0)
+    run_x_end = np.minimum(run_x_end, zoom_mult - 1)
+
+    filt = run_x_start <= run_x_end
+    return run_y[filt], run_x_start[filt], run_x_end[filt]
+
+
+def _expand_runs(
+    run_y: np.ndarray, run_x_start: np.ndarray, run_x_end: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert runs of tiles to x,y indexes of every tile."""
+    run_length = run_x_end - run_x_start + 1
+    y_tiles = np.repeat(run_y, run_length)
+    x_tiles = np.arange(y_tiles.shape[0]) - np.repeat(
+        np.cumsum(run_length) - run_length - run_x_start, run_length
+    )
+    return x_tiles, y_tiles
@@ -0,0 +1,308 @@
+"""Render per-tile counts into slippy-map raster tiles "z/x/y.png".
+
+Counts at the base zoom are rolled up with 'tile_pyramid.build_pyramid',
+so a map tile of zoom z is painted from the pyramid level z + 8: every
+data tile is one pixel of the 256 x 256 image. Above the base zoom a data
+tile covers a square block of pixels. Only map tiles with data are written,
+missing tiles are transparent for the map client.
+
+The output directory can be served by any static file server or added
+to a folium map with 'map_utils.add_heatmap_tiles_to_map'.
+
+Example:
+    df_counts = tile_pyramid.tile_counts(df.lat.values, df.lon.values, 17)
+    heatmap_tiles.render_heatmap_tiles(df_counts, 17, "heatmap", max_zoom=14)
+"""
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import tile_keys, tile_pyramid
+
+# Side of the map tile in pixels, 2**TILE_BITS
+TILE_BITS = 8
+TILE_SIZE = 2**TILE_BITS
+
+# Number of tasks per worker, smaller tasks balance the load better
+TASKS_PER_WORKER = 8
+
+# Color stops of the default palette: position in [0, 1] and RGBA
+HEAT_STOPS = (
+    (0.0, (255, 255, 178, 96)),
+    (0.25, (254, 204, 92, 160)),
+    (0.5, (253, 141, 60, 192)),
+    (0.75, (240, 59, 32, 224)),
+    (1.0, (189, 0, 38, 255)),
+)
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def palette(
+    stops: Sequence[Tuple[float, Tuple[int, int, int, int]]] = HEAT_STOPS
+) -> np.ndarray:
+    """Return lookup table of 256 RGBA colors interpolated between color stops.
+
+    Color 0 is fully transparent and is used for the pixels without data.
+
+    Returns:
+        array of uint8, shape = [256,4]
+    """
+    positions = np.array([pos for pos, _ in stops], dtype=np.float64)
+    colors = np.array([color for _, color in stops], dtype=np.float64)
+    levels = np.linspace(0, 1, 255)
+
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for channel in range(4):
+        lut[1:, channel] = np.round(np.interp(levels, positions, colors[:, channel]))
+    return lut
+
+
+def encode_png(
+    image: np.ndarray, lut: Optional[np.ndarray] = None, compress_level: int = 6
+) -> bytes:
+    """Encode image to PNG bytes.
+
+    Arguments:
+        image - array of uint8, RGBA image of shape = [height,width,4] or
+            palette indexes of shape = [height,width] if 'lut' is given
+        lut - array of uint8, shape = [n_colors,4], RGBA palette of the
+            indexed image; indexed images are 4 times smaller before
+            compression, which is the most expensive part of encoding
+        compress_level - zlib compression level, 0-9
+
+    Returns:
+        bytes of PNG file
+    """
+    assert image.dtype == np.uint8
+    height, width = image.shape[:2]
+    if lut is None:
+        assert image.ndim == 3 and image.shape[2] == 4
+        header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+        palette_chunks = []
+    else:
+        assert image.ndim == 2
+        assert lut.dtype == np.uint8 and lut.shape[0] <= 256 and lut.shape[1] == 4
+        header = struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)
+        palette_chunks = [
+            _png_chunk(b"PLTE", lut[:, :3].tobytes()),
+            _png_chunk(b"tRNS", lut[:, 3].tobytes()),
+        ]
+
+    # every scanline starts with filter type 0 (no filter)
+    raw = np.zeros((height, image[0].size + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, -1)
+
+    return b"".join(
+        [_PNG_SIGNATURE, _png_chunk(b"IHDR", header)]
+        + palette_chunks
+        + [
+            _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), compress_level)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    """Return PNG chunk: length, type, data and CRC of type and data."""
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def render_heatmap_tiles(
+    df_tiles: pd.DataFrame,
+    zoom: int,
+    output_dir: str,
+    min_zoom: int = 0,
+    max_zoom: Optional[int] = None,
+    value_col: str = "count",
+    lut: Optional[np.ndarray] = None,
+    n_jobs: Optional[int] = None,
+) -> int:
+    """Render PNG map tiles "<output_dir>/z/x/y.png" from per-tile values.
+
+    Colors are scaled logarithmically from the smallest to the largest
+    non-zero pixel value of each zoom level, so every zoom uses the whole
+    palette.
+
+    Arguments:
+        df_tiles - have columns "tile_idx_x", "tile_idx_y" (tiles at 'zoom')
+            and 'value_col', e.g. output of 'tile_pyramid.tile_counts'
+        zoom - integer, zoom level of the tiles in 'df_tiles'
+        output_dir - directory of the rendered tiles
+        min_zoom - integer, the lowest rendered zoom
+        max_zoom - integer, the highest rendered zoom, by default 'zoom' - 4,
+            where each data tile is 16 x 16 pixels; map clients may scale
+            up tiles of the highest zoom
+        value_col - column with non-negative values to render
+        lut - array of uint8, shape = [256,4], RGBA palette, 'palette()' by
+            default, color 0 is used for the pixels without data
+        n_jobs - number of processes, all cores by default, 1 - no pool
+
+    Returns:
+        number of written tiles
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    if max_zoom is None:
+        max_zoom = max(min_zoom, zoom - 4)
+    assert 0 <= min_zoom <= max_zoom <= zoom
+    if lut is None:
+        lut = palette()
+    assert lut.shape == (256, 4)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    # pyramid levels which are painted as pixels
+    data_zooms = {
+        level: min(level + TILE_BITS, zoom) for level in range(min_zoom, max_zoom + 1)
+    }
+    pyramid = tile_pyramid.build_pyramid(
+        df_tiles[["tile_idx_x", "tile_idx_y", value_col]],
+        zoom,
+        min_zoom=min(data_zooms.values()),
+        value_cols=[value_col],
+    )
+
+    tasks = []
+    for level, data_zoom in data_zooms.items():
+        df_level = pyramid[data_zoom]
+        df_level = df_level.loc[df_level[value_col].values > 0]
+        level_tasks = _level_tasks(
+            df_level["tile_key"].values,
+            _color_index(df_level[value_col].values),
+            level,
+            data_zoom,
+            output_dir,
+            n_jobs,
+        )
+        tasks += [task + (lut,) for task in level_tasks]
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        results = [_render_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_render_task, *zip(*tasks)))
+
+    return sum(results)
+
+
+def _color_index(values: np.ndarray) -> np.ndarray:
+    """Scale positive values logarithmically to palette colors 1..255."""
+    if values.shape[0] == 0:
+        return np.array([], dtype=np.uint8)
+
+    log_values = np.log(values.astype(np.float64))
+    log_min = log_values.min()
+    log_range = log_values.max() - log_min
+    if log_range == 0:
+        return np.full(values.shape[0], 255, dtype=np.uint8)
+
+    color: np.ndarray = (1 + np.round((log_values - log_min) / log_range * 254)).astype(
+        np.uint8
+    )
+    return color
+
+
+def _level_tasks(
+    keys: np.ndarray,
+    color: np.ndarray,
+    zoom: int,
+    data_zoom: int,
+    output_dir: str,
+    n_jobs: int,
+) -> List[Tuple]:
+    """Split data tiles of one map zoom level into rendering tasks.
+
+    Keys are sorted, so data tiles of the same map tile form a continuous run:
+    the map tile is the ancestor 'data_zoom - zoom' levels up.
+
+    Returns:
+        list of tasks, arguments of '_render_task' except the palette
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    if keys.shape[0] == 0:
+        return []
+
+    levels = data_zoom - zoom
+    parents = tile_keys.parent_keys(keys, levels)
+    tile_x, tile_y, _ = tile_keys.decode_tile_keys(parents)
+    data_x, data_y, _ = tile_keys.decode_tile_keys(keys)
+    pixel_x = data_x - (tile_x.astype(np.int64) << levels)
+    pixel_y = data_y - (tile_y.astype(np.int64) << levels)
+
+    starts = np.flatnonzero(np.diff(parents, prepend=parents[0] - 1))
+    ends = np.append(starts[1:], keys.shape[0])
+
+    # runs are split into tasks with similar number of data tiles
+    n_tasks = max(1, min(starts.shape[0], n_jobs * TASKS_PER_WORKER))
+    bounds = np.searchsorted(
+        starts, np.linspace(0, keys.shape[0], n_tasks + 1)[1:-1], side="right"
+    )
+    tasks = []
+    for run_lo, run_hi in zip(np.append(0, bounds), np.append(bounds, starts.shape[0])):
+        if run_lo == run_hi:
+            continue
+        lo, hi = starts[run_lo], ends[run_hi - 1]
+        tasks.append(
+            (
+                output_dir,
+                zoom,
+                2**levels,
+                tile_x[starts[run_lo:run_hi]],
+                tile_y[starts[run_lo:run_hi]],
+                starts[run_lo:run_hi] - lo,
+                pixel_x[lo:hi],
+                pixel_y[lo:hi],
+                color[lo:hi],
+            )
+        )
+    return tasks
+
+
+def _render_task(
+    output_dir: str,
+    zoom: int,
+    n_cells: int,
+    tile_x: np.ndarray,
+    tile_y: np.ndarray,
+    starts: np.ndarray,
+    pixel_x: np.ndarray,
+    pixel_y: np.ndarray,
+    color: np.ndarray,
+    lut: np.ndarray,
+) -> int:
+    """Paint and write map tiles, runs in a worker process.
+
+    Arguments:
+        n_cells - number of data tiles along the side of the map tile
+        tile_x, tile_y - map tiles to render
+        starts - position of the first data tile of each map tile
+        pixel_x, pixel_y - position of the data tile inside its map tile
+        color - palette index of the data tile
+
+    Returns:
+        number of written tiles
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    block = max(1, TILE_SIZE // n_cells)
+    ends = np.append(starts[1:], pixel_x.shape[0])
+    cells = np.zeros((n_cells, n_cells), dtype=np.uint8)
+    for x_tile, y_tile, start, end in zip(
+        tile_x.tolist(), tile_y.tolist(), starts.tolist(), ends.tolist()
+    ):
+        cells[:] = 0
+        cells[pixel_y[start:end], pixel_x[start:end]] = color[start:end]
+        # above the base zoom data tiles are blocks of pixels
+        image = cells.repeat(block, axis=0).repeat(block, axis=1)
+
+        tile_dir = os.path.join(output_dir, str(zoom), str(x_tile))
+        os.makedirs(tile_dir, exist_ok=True)
+        with open(os.path.join(tile_dir, f"{y_tile}.png"), "wb") as file:
+            file.write(encode_png(image, lut))
+
+    return len(starts)
@@ -0,0 +1,186 @@
+"""Optional instrumentation of the library stages: timings, counts and sizes.
+
+Instrumented functions report stages (e.g. stencil build, haversine filter)
+to the collector active in the current context. Without active collector
+every stage is a shared no-op object, so instrumentation costs nothing
+but a context variable lookup.
+
+Example:
+    with instrumentation.collect() as collector:
+        nearby_tiles.get_nearby_tiles(df_coords, zoom=18, radius=500)
+    collector.log_summary(logging.getLogger("tiles"))
+    metrics = collector.as_dict()
+
+Stages executed in worker processes (e.g. 'get_nearby_tiles' with n_jobs > 1)
+are collected in the workers and added to the collector of the parent when
+the tasks return, so seconds of these stages are summed over all workers.
+"""
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Union
+
+
+class StageRecord(NamedTuple):
+    """Single execution of an instrumented stage.
+
+    stage - name of the stage
+    seconds - wall time of the stage
+    counts - numbers reported by the stage: candidates before and after
+        filters, sizes of arrays in bytes ("nbytes"), etc.
+    """
+
+    stage: str
+    seconds: float
+    counts: Dict[str, float]
+
+
+class Collector:
+    """Aggregates records of stages executed while the collector is active.
+
+    Arguments:
+        callback - optional function called with every StageRecord,
+            e.g. to forward metrics to a monitoring system
+    """
+
+    def __init__(self, callback: Optional[Callable[[StageRecord], Any]] = None):
+        """Create collector without records."""
+        self.callback = callback
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def add(self, record: StageRecord) -> None:
+        """Add record to the totals of its stage."""
+        totals = self.stages.setdefault(record.stage, {"calls": 0, "seconds": 0.0})
+        totals["calls"] += 1
+        totals["seconds"] += record.seconds
+        for name, value in record.counts.items():
+            totals[name] = totals.get(name, 0) + value
+
+        if self.callback is not None:
+            self.callback(record)
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """Return totals of every stage: number of calls, seconds and counts."""
+        return {name: dict(totals) for name, totals in self.stages.items()}
+
+    def log_summary(self, logger: logging.Logger, level: int = logging.INFO) -> None:
+        """Write one line with totals of every stage to the logger."""
+        for stage_name, totals in self.stages.items():
+            values = " ".join(f"{name}={value:.6g}" for name, value in totals.items())
+            logger.log(level, "%s: %s", stage_name, values)
+
+
+class _Stage:
+    """Active stage: measures time and collects counts until exit."""
+
+    __slots__ = ("collector", "name", "start", "counts")
+
+    def __init__(self, collector: Collector, name: str):
+        self.collector = collector
+        self.name = name
+        self.start = 0.0
+        self.counts: Dict[str, float] = {}
+
+    def __enter__(self) -> "_Stage":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        seconds = time.perf_counter() - self.start
+        self.collector.add(StageRecord(self.name, seconds, self.counts))
+
+    def __bool__(self) -> bool:
+        return True
+
+    def count(self, **counts: float) -> None:
+        """Add numbers to the counts of the stage."""
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+class _NullStage:
+    """Stage used when instrumentation is disabled, does nothing."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullStage":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+    def __bool__(self) -> bool:
+        return False
+
+    def count(self, **counts: float) -> None:
+        """Do nothing."""
+
+
+_NULL_STAGE = _NullStage()
+
+_COLLECTOR: contextvars.ContextVar[Optional[Collector]] = contextvars.ContextVar(
+    "geohashing_collector", default=None
+)
+
+
+@contextlib.contextmanager
+def collect(
+    callback: Optional[Callable[[StageRecord], Any]] = None
+) -> Iterator[Collector]:
+    """Activate new collector in the current context (thread or task).
+
+    Arguments:
+        callback - optional function called with every StageRecord
+    """
+    collector = Collector(callback)
+    token = _COLLECTOR.set(collector)
+    try:
+        yield collector
+    finally:
+        _COLLECTOR.reset(token)
+
+
+def stage(name: str) -> Union[_Stage, _NullStage]:
+    """Return context manager measuring the stage.
+
+    Stage object is false when instrumentation is disabled, so counts which
+    are expensive to compute are reported only when needed:
+
+        with instrumentation.stage("haversine filter") as stg:
+            ...
+            if stg:
+                stg.count(candidates=dist.shape[0], kept=int(filt.sum()))
+    """
+    collector = _COLLECTOR.get()
+    if collector is None:
+        return _NULL_STAGE
+    return _Stage(collector, name)
+
+
+def is_active() -> bool:
+    """Return True if a collector is active in the current context.
+
+    Pass the result to worker processes, which should collect their stages
+    only when the parent does (see 'add_records').
+    """
+    return _COLLECTOR.get() is not None
+
+
+def add_records(records: Iterable[StageRecord]) -> None:
+    """Add records collected elsewhere, e.g. in worker processes, to the collector.
+
+    Worker collects records of its stages in a list and returns it:
+
+        records = []
+        with instrumentation.collect(records.append):
+            ...
+        return result, records
+
+    Records are ignored if no collector is active.
+    """
+    collector = _COLLECTOR.get()
+    if collector is None:
+        return
+    for record in records:
+        collector.add(record)
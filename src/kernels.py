@@ -0,0 +1,548 @@
+"""Fused coordinate kernels with preallocated outputs and selectable backends.
+
+'np_tiles_converter' builds a new temporary array for every arithmetic step,
+on large batches most of the time is spent writing and reading these
+temporaries. Kernels here compute the same formulas block by block into
+reused scratch buffers (or in a single compiled loop) and write results
+into 'out' arrays provided by the caller.
+
+Backends:
+    numpy - in-place ufuncs on cache-sized blocks, always available
+    numexpr - expressions evaluated by numexpr (optional dependency)
+    numba - compiled parallel loops (optional dependency), unless configured
+        by NUMBA_THREADING_LAYER(_PRIORITY), fork-safe threading layers
+        are preferred, so process pools (e.g. 'get_nearby_tiles' with
+        n_jobs > 1) can be used after the kernels
+
+Backend is chosen by 'backend' argument, then by 'set_backend',
+then by GEOHASHING_KERNEL_BACKEND environment variable, "numpy" by default.
+
+With float64 all backends return the same tile indices and distances as
+'np_deg2idx' and 'np_haversin': optional backends may differ from numpy
+in the last bits of transcendental functions, so they mark values close to
+the rounding boundaries with NaN (inside the compiled loop or block by
+block) and only these values are recomputed with the numpy backend.
+With float32 intermediate values are rounded to single precision,
+results near tile boundaries may differ from float64. See 'check_parity'.
+"""
+import functools
+import math
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import np_tiles_converter
+
+BACKEND_ENV = "GEOHASHING_KERNEL_BACKEND"
+BACKENDS = ("numpy", "numexpr", "numba")
+
+# Elements per block of the numpy backend, scratch buffers stay in CPU cache
+BLOCK_SIZE = 2**15
+
+# Same limits as in np_tiles_converter.np_deg2frac
+MAX_LON = 179.999
+MAX_LAT = 85.05
+EARTH_RADIUS = 6371000
+
+# Values closer than this (relative) to rounding boundaries are recomputed
+_PARITY_TOLERANCE = 1e-12
+
+# Haversine distance in decimeters is below this, used for parity tolerance
+_MAX_DECIMETERS = 10 * math.pi * EARTH_RADIUS + 1
+
+_SELECTED_BACKEND: Optional[str] = None
+
+
+def available_backends() -> Tuple[str, ...]:
+    """Return names of backends which can be used in this environment."""
+    available = ["numpy"]
+    for name in BACKENDS[1:]:
+        try:
+            _load_backend(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return tuple(available)
+
+
+def set_backend(name: Optional[str]) -> None:
+    """Select default backend, None - use environment variable or numpy."""
+    if name is not None:
+        _load_backend(name)
+    global _SELECTED_BACKEND  # pylint: disable=global-statement
+    _SELECTED_BACKEND = name
+
+
+def get_backend(name: Optional[str] = None) -> str:
+    """Resolve backend name: argument, 'set_backend', environment, "numpy"."""
+    if name is None:
+        name = _SELECTED_BACKEND or os.environ.get(BACKEND_ENV) or "numpy"
+    assert name in BACKENDS, f"Unknown backend {name}, use one of {BACKENDS}"
+    return name
+
+
+@functools.lru_cache(maxsize=None)
+def _load_backend(name: str) -> Dict[str, Callable]:
+    """Import optional dependency of the backend and return its kernels."""
+    # pylint: disable=import-outside-toplevel
+    if name == "numpy":
+        return {"deg2frac": _numpy_deg2frac, "haversin": _numpy_haversin}
+
+    if name == "numexpr":
+        import numexpr
+
+        return {
+            "deg2frac": functools.partial(_numexpr_deg2frac, numexpr),
+            "haversin": functools.partial(_numexpr_haversin, numexpr),
+        }
+
+    assert name == "numba", f"Unknown backend {name}, use one of {BACKENDS}"
+    import numba
+
+    # process forked after the tbb layer started hangs on exit
+    configured = {"NUMBA_THREADING_LAYER", "NUMBA_THREADING_LAYER_PRIORITY"}
+    if not configured & set(os.environ):
+        layers = ["omp", "workqueue", "tbb"]
+        numba.config.THREADING_LAYER_PRIORITY = layers  # type: ignore[attr-defined]
+
+    return _numba_kernels(numba)
+
+
+def deg2idx(
+    lat_deg: np.ndarray,
+    lon_deg: np.ndarray,
+    zoom: int,
+    out: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    dtype: type = np.float64,
+    backend: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert degrees of latitude and longitude to x,y tile coordinates.
+
+    Same as 'np_tiles_converter.np_deg2idx'.
+
+    Arguments:
+        lat_deg - numpy array, degrees of latitude
+        lon_deg - numpy array, degrees of longitude
+        zoom - integer, zoom level of the tiles
+        out - (xtile, ytile) int32 arrays for the result, allocated if None
+        dtype - np.float64 or np.float32, precision of the intermediate values
+        backend - name of the backend, see 'get_backend'
+
+    Returns:
+        xtile, ytile - int32 numpy arrays ('out' if given)
+    """
+    # pylint: disable=too-many-arguments
+    frac_x, frac_y = deg2frac(lat_deg, lon_deg, zoom, dtype=dtype, backend=backend)
+    if out is None:
+        out = (
+            np.empty(frac_x.shape[0], dtype=np.int32),
+            np.empty(frac_y.shape[0], dtype=np.int32),
+        )
+    np.floor(frac_x, out=frac_x)
+    np.floor(frac_y, out=frac_y)
+    np.copyto(out[0], frac_x, casting="unsafe")
+    np.copyto(out[1], frac_y, casting="unsafe")
+    return out
+
+
+def deg2frac(
+    lat_deg: np.ndarray,
+    lon_deg: np.ndarray,
+    zoom: int,
+    out: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    dtype: type = np.float64,
+    backend: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert degrees of latitude and longitude to fractional tile coordinates.
+
+    Same as 'np_tiles_converter.np_deg2frac', arguments as in 'deg2idx',
+    'out' arrays must have type 'dtype'.
+    """
+    # pylint: disable=too-many-arguments
+    lat_deg = np.asarray(lat_deg)
+    lon_deg = np.asarray(lon_deg)
+    assert lat_deg.ndim == 1
+    assert lat_deg.shape == lon_deg.shape
+    assert dtype in (np.float32, np.float64)
+    if out is None:
+        out = (
+            np.empty(lat_deg.shape[0], dtype=dtype),
+            np.empty(lat_deg.shape[0], dtype=dtype),
+        )
+    assert out[0].dtype == dtype and out[1].dtype == dtype
+
+    name = get_backend(backend)
+    zoom_mult = np_tiles_converter.zoom_power(zoom)
+    # values next to tile boundaries are marked and recomputed with numpy
+    tol = _parity_tolerance(name, dtype, zoom_mult + 1)
+    _load_backend(name)["deg2frac"](lat_deg, lon_deg, zoom_mult, tol, out[0], out[1])
+
+    if tol > 0:
+        rows = np.flatnonzero(np.isnan(out[0]))
+        if rows.shape[0] > 0:
+            ref_x, ref_y = deg2frac(lat_deg[rows], lon_deg[rows], zoom, backend="numpy")
+            out[0][rows] = ref_x
+            out[1][rows] = ref_y
+
+    return out
+
+
+def haversin(
+    lat_deg1: np.ndarray,
+    lon_deg1: np.ndarray,
+    lat_deg2: np.ndarray,
+    lon_deg2: np.ndarray,
+    out: Optional[np.ndarray] = None,
+    dtype: type = np.float64,
+    backend: Optional[str] = None,
+) -> np.ndarray:
+    """Compute haversine distance between two points in meters.
+
+    Same as 'np_tiles_converter.np_haversin' (rounded to 0.1 meter).
+
+    Arguments:
+        lat_deg1, lon_deg1 - numpy arrays, degrees of the first point
+        lat_deg2, lon_deg2 - numpy arrays, degrees of the second point
+        out - array of 'dtype' for the result, allocated if None
+        dtype - np.float64 or np.float32, precision of the intermediate values
+        backend - name of the backend, see 'get_backend'
+    """
+    # pylint: disable=too-many-arguments
+    points = [np.asarray(arr) for arr in (lat_deg1, lon_deg1, lat_deg2, lon_deg2)]
+    assert all(arr.ndim == 1 and arr.shape == points[0].shape for arr in points)
+    assert dtype in (np.float32, np.float64)
+    if out is None:
+        out = np.empty(points[0].shape[0], dtype=dtype)
+    assert out.dtype == dtype
+
+    name = get_backend(backend)
+    # values next to half of decimeter are marked and recomputed with numpy
+    tol = _parity_tolerance(name, dtype, _MAX_DECIMETERS)
+    _load_backend(name)["haversin"](*points, tol, out)
+
+    if tol > 0:
+        rows = np.flatnonzero(np.isnan(out))
+        if rows.shape[0] > 0:
+            lat1, lon1, lat2, lon2 = (arr[rows] for arr in points)
+            out[rows] = haversin(lat1, lon1, lat2, lon2, backend="numpy")
+
+    np.multiply(out, 10, out=out)
+    np.rint(out, out=out)
+    np.divide(out, 10, out=out)
+    return out
+
+
+def _parity_tolerance(name: str, dtype: type, max_value: float) -> float:
+    """Return distance to an integer below which backend results are recomputed.
+
+    Arguments:
+        max_value - the largest checked value, last bits of the backend
+            may differ from numpy relative to it
+
+    Returns:
+        0 if results are not checked: numpy backend or float32
+    """
+    if name == "numpy" or dtype != np.float64:
+        return 0.0
+    return _PARITY_TOLERANCE * max_value
+
+
+def _mark_near_integer(
+    values: np.ndarray,
+    tol: float,
+    target: np.ndarray,
+    scale: float = 1.0,
+    offset: float = 0.0,
+) -> None:
+    """Set 'target' to NaN where values * scale + offset are near an integer.
+
+    Values are checked block by block in two reused scratch buffers.
+    """
+    # pylint: disable=too-many-arguments
+    size = min(BLOCK_SIZE, values.shape[0])
+    scaled, dist = (np.empty(size, dtype=values.dtype) for _ in range(2))
+    for start in range(0, values.shape[0], BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        n_block = values[block].shape[0]
+        scaled_buf, dist_buf = scaled[:n_block], dist[:n_block]
+
+        np.multiply(values[block], scale, out=scaled_buf)
+        np.add(scaled_buf, offset, out=scaled_buf)
+        np.rint(scaled_buf, out=dist_buf)
+        np.subtract(scaled_buf, dist_buf, out=dist_buf)
+        np.abs(dist_buf, out=dist_buf)
+        target[block][dist_buf < tol] = np.nan
+
+
+def _numpy_deg2frac(
+    lat_deg: np.ndarray,
+    lon_deg: np.ndarray,
+    zoom_mult: float,
+    tol: float,
+    frac_x: np.ndarray,
+    frac_y: np.ndarray,
+) -> None:
+    """Numpy backend of 'deg2frac': in-place ufuncs, one block at a time.
+
+    Results are the reference, 'tol' is not used.
+    """
+    # pylint: disable=too-many-arguments,unused-argument
+    for start in range(0, lat_deg.shape[0], BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        x_buf = frac_x[block]
+        y_buf = frac_y[block]
+
+        np.clip(lon_deg[block], -MAX_LON, MAX_LON, out=x_buf)
+        np.radians(x_buf, out=x_buf)
+        np.add(x_buf, np.pi, out=x_buf)
+        np.divide(x_buf, 2 * np.pi, out=x_buf)
+        np.multiply(x_buf, zoom_mult, out=x_buf)
+
+        np.clip(lat_deg[block], -MAX_LAT, MAX_LAT, out=y_buf)
+        np.radians(y_buf, out=y_buf)
+        np.divide(y_buf, 2, out=y_buf)
+        np.add(y_buf, np.pi / 4, out=y_buf)
+        np.tan(y_buf, out=y_buf)
+        np.log(y_buf, out=y_buf)
+        np.subtract(np.pi, y_buf, out=y_buf)
+        np.divide(y_buf, 2 * np.pi, out=y_buf)
+        np.multiply(y_buf, zoom_mult, out=y_buf)
+
+
+def _numpy_haversin(
+    lat_deg1: np.ndarray,
+    lon_deg1: np.ndarray,
+    lat_deg2: np.ndarray,
+    lon_deg2: np.ndarray,
+    tol: float,
+    out: np.ndarray,
+) -> None:
+    """Numpy backend of 'haversin' without rounding, one block at a time.
+
+    Results are the reference, 'tol' is not used.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals,unused-argument
+    size = min(BLOCK_SIZE, out.shape[0])
+    lat_rad1, lat_rad2, sin_lon = (np.empty(size, dtype=out.dtype) for _ in range(3))
+
+    for start in range(0, out.shape[0], BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        buf = out[block]
+        n_block = buf.shape[0]
+        rad1, rad2, sin_buf = lat_rad1[:n_block], lat_rad2[:n_block], sin_lon[:n_block]
+
+        np.radians(lat_deg1[block], out=rad1)
+        np.radians(lat_deg2[block], out=rad2)
+
+        np.radians(lon_deg2[block], out=sin_buf)
+        np.radians(lon_deg1[block], out=buf)
+        np.subtract(sin_buf, buf, out=sin_buf)
+        np.divide(sin_buf, 2, out=sin_buf)
+        np.sin(sin_buf, out=sin_buf)
+
+        # sin_rad * sin_rad + cos(lat_rad2) * cos(lat_rad1) * sin_lon * sin_lon
+        np.subtract(rad2, rad1, out=buf)
+        np.divide(buf, 2, out=buf)
+        np.sin(buf, out=buf)
+        np.multiply(buf, buf, out=buf)
+        np.cos(rad2, out=rad2)
+        np.cos(rad1, out=rad1)
+        np.multiply(rad2, rad1, out=rad2)
+        np.multiply(rad2, sin_buf, out=rad2)
+        np.multiply(rad2, sin_buf, out=rad2)
+        np.add(buf, rad2, out=buf)
+
+        np.power(buf, 0.5, out=buf)
+        np.arcsin(buf, out=buf)
+        np.multiply(buf, 2, out=buf)
+        np.multiply(buf, EARTH_RADIUS, out=buf)
+
+
+def _numexpr_deg2frac(
+    numexpr,
+    lat_deg: np.ndarray,
+    lon_deg: np.ndarray,
+    zoom_mult: float,
+    tol: float,
+    frac_x: np.ndarray,
+    frac_y: np.ndarray,
+) -> None:
+    """Numexpr backend of 'deg2frac', values near tile boundaries are NaN."""
+    # pylint: disable=too-many-arguments
+    consts = {
+        name: frac_x.dtype.type(value)
+        for name, value in [
+            ("max_lon", MAX_LON),
+            ("max_lat", MAX_LAT),
+            ("deg2rad", np.pi / 180),
+            ("pi", np.pi),
+            ("two_pi", 2 * np.pi),
+            ("quarter_pi", np.pi / 4),
+            ("zoom_mult", zoom_mult),
+        ]
+    }
+    numexpr.evaluate(
+        "((where(lon > max_lon, max_lon, where(lon < -max_lon, -max_lon, lon))"
+        " * deg2rad + pi) / two_pi) * zoom_mult",
+        local_dict={"lon": lon_deg, **consts},
+        out=frac_x,
+        casting="same_kind",
+    )
+    numexpr.evaluate(
+        "((pi - log(tan("
+        "where(lat > max_lat, max_lat, where(lat < -max_lat, -max_lat, lat))"
+        " * deg2rad / 2 + quarter_pi))) / two_pi) * zoom_mult",
+        local_dict={"lat": lat_deg, **consts},
+        out=frac_y,
+        casting="same_kind",
+    )
+    if tol > 0:
+        _mark_near_integer(frac_y, tol, frac_x)
+        _mark_near_integer(frac_x, tol, frac_x)
+
+
+def _numexpr_haversin(
+    numexpr,
+    lat_deg1: np.ndarray,
+    lon_deg1: np.ndarray,
+    lat_deg2: np.ndarray,
+    lon_deg2: np.ndarray,
+    tol: float,
+    out: np.ndarray,
+) -> None:
+    """Numexpr backend of 'haversin' without rounding.
+
+    Distances near half of decimeter are NaN.
+    """
+    # pylint: disable=too-many-arguments
+    consts = {
+        "deg2rad": out.dtype.type(np.pi / 180),
+        "earth_radius": out.dtype.type(EARTH_RADIUS),
+    }
+    numexpr.evaluate(
+        "2 * arcsin(sqrt("
+        "sin((lat2 * deg2rad - lat1 * deg2rad) / 2) ** 2"
+        " + cos(lat2 * deg2rad) * cos(lat1 * deg2rad)"
+        " * sin((lon2 * deg2rad - lon1 * deg2rad) / 2) ** 2"
+        ")) * earth_radius",
+        local_dict={
+            "lat1": lat_deg1,
+            "lon1": lon_deg1,
+            "lat2": lat_deg2,
+            "lon2": lon_deg2,
+            **consts,
+        },
+        out=out,
+        casting="same_kind",
+    )
+    if tol > 0:
+        _mark_near_integer(out, tol, out, scale=10, offset=0.5)
+
+
+def _numba_kernels(numba) -> Dict[str, Callable]:
+    """Compile loops of 'deg2frac' and 'haversin' (without rounding) with numba.
+
+    Values near rounding boundaries are set to NaN inside the loops.
+    """
+    prange = numba.prange
+
+    @numba.njit(parallel=True)
+    def loop_deg2frac(lat_deg, lon_deg, zoom_mult, tol, frac_x, frac_y):
+        # pylint: disable=too-many-arguments
+        for i in prange(lat_deg.shape[0]):  # pylint: disable=not-an-iterable
+            lon = min(max(lon_deg[i], -MAX_LON), MAX_LON)
+            val_x = (math.radians(lon) + math.pi) / (2 * math.pi) * zoom_mult
+            lat = min(max(lat_deg[i], -MAX_LAT), MAX_LAT)
+            interm = math.radians(lat) / 2 + math.pi / 4
+            val_y = (math.pi - math.log(math.tan(interm))) / (2 * math.pi) * zoom_mult
+            if abs(val_x - round(val_x)) < tol or abs(val_y - round(val_y)) < tol:
+                val_x = math.nan
+            frac_x[i] = val_x
+            frac_y[i] = val_y
+
+    @numba.njit(parallel=True)
+    def loop_haversin(lat_deg1, lon_deg1, lat_deg2, lon_deg2, tol, out):
+        # pylint: disable=too-many-arguments
+        for i in prange(out.shape[0]):  # pylint: disable=not-an-iterable
+            lat_rad1 = math.radians(lat_deg1[i])
+            lat_rad2 = math.radians(lat_deg2[i])
+            sin_rad = math.sin((lat_rad2 - lat_rad1) / 2)
+            sin_lon = math.sin(
+                (math.radians(lon_deg2[i]) - math.radians(lon_deg1[i])) / 2
+            )
+            interm = (
+                sin_rad * sin_rad
+                + math.cos(lat_rad2) * math.cos(lat_rad1) * sin_lon * sin_lon
+            )
+            dist = 2 * math.asin(math.sqrt(interm)) * EARTH_RADIUS
+            decimeters = dist * 10 + 0.5
+            if abs(decimeters - round(decimeters)) < tol:
+                dist = math.nan
+            out[i] = dist
+
+    return {"deg2frac": loop_deg2frac, "haversin": loop_haversin}
+
+
+def check_parity(
+    n_points: int = 1_000_000,
+    zooms: Tuple[int, ...] = (1, 12, 17, 19, 22),
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Compare every available backend with 'np_tiles_converter' on random points.
+
+    Points are spread over the whole map, including values exactly
+    at tile boundaries and outside of the valid range.
+
+    Returns:
+        DataFrame with columns "backend", "dtype", "zoom",
+        "tile_mismatches", "distance_mismatches" (number of differing results)
+    """
+    # pylint: disable=too-many-locals
+    rng = np.random.default_rng(seed)
+    lat_deg = rng.uniform(-90, 90, n_points)
+    lon_deg = rng.uniform(-180, 180, n_points)
+
+    rows = []
+    for zoom in zooms:
+        # tile corners are the hardest case for rounding
+        n_corners = n_points // 10
+        corner_x = rng.integers(0, 2**zoom, n_corners)
+        corner_y = rng.integers(0, 2**zoom, n_corners)
+        corner_lat, corner_lon = np_tiles_converter.np_idx2deg(
+            corner_x, corner_y, zoom, offset=0
+        )
+        lat_zoom = np.concatenate([lat_deg, corner_lat])
+        lon_zoom = np.concatenate([lon_deg, corner_lon])
+        ref_x, ref_y = np_tiles_converter.np_deg2idx(lat_zoom, lon_zoom, zoom)
+        ref_dist = np_tiles_converter.np_haversin(
+            lat_zoom[1:], lon_zoom[1:], lat_zoom[:-1], lon_zoom[:-1]
+        )
+
+        for name in available_backends():
+            for dtype in (np.float64, np.float32):
+                xtile, ytile = deg2idx(
+                    lat_zoom, lon_zoom, zoom, dtype=dtype, backend=name
+                )
+                dist = haversin(
+                    lat_zoom[1:],
+                    lon_zoom[1:],
+                    lat_zoom[:-1],
+                    lon_zoom[:-1],
+                    dtype=dtype,
+                    backend=name,
+                )
+                rows.append(
+                    {
+                        "backend": name,
+                        "dtype": np.dtype(dtype).name,
+                        "zoom": zoom,
+                        "tile_mismatches": int(
+                            ((xtile != ref_x) | (ytile != ref_y)).sum()
+                        ),
+                        "distance_mismatches": int((dist != ref_dist).sum()),
+                    }
+                )
+
+    return pd.DataFrame(rows)
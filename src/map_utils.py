@@ -1,10 +1,22 @@
-"""Funcitons for plotting points and geometries on a map."""
+"""Funcitons for plotting points and geometries on a map.
+
+Points and tiles are added as a single GeoJSON layer, so the map stays
+responsive with hundreds of thousands of objects.
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
 import folium
 import numpy as np
 from folium.features import DivIcon
 
 from src import plot_utils
 
+LOGGER = logging.getLogger(__name__)
+
+# Decimals of the coordinates written to GeoJSON, 1e-7 degree is about 1 cm
+COORD_DECIMALS = 7
+
 
 def add_points_to_map(
     map_obj: folium.Map,
@@ -13,16 +25,106 @@ def add_points_to_map(
     color: str = "blue",
     radius: float = 10,
 ):
-    """Add points to the map object."""
-    n_points = len(lon_arr)
-    for i in range(n_points):
-        folium.CircleMarker(
-            location=[lat_arr[i], lon_arr[i]], radius=radius, color=color
-        ).add_to(map_obj)
+    """Add points to the map object as a single GeoJSON layer of circle markers."""
+    coords = np.stack(
+        [np.asarray(lon_arr, dtype=np.float64), np.asarray(lat_arr, dtype=np.float64)],
+        axis=1,
+    )
+    data = _feature_collection(
+        [
+            {
+                "type": "Feature",
+                "properties": {},
+                "geometry": {
+                    "type": "MultiPoint",
+                    "coordinates": np.round(coords, COORD_DECIMALS).tolist(),
+                },
+            }
+        ]
+    )
+    folium.GeoJson(data, marker=folium.CircleMarker(radius=radius, color=color)).add_to(
+        map_obj
+    )
 
     return map_obj
 
 
+def add_tiles_to_map(
+    map_obj: folium.Map,
+    x_idx_tile: np.ndarray,
+    y_idx_tile: np.ndarray,
+    zoom: int,
+    color: str = "blue",
+    merge: bool = False,
+    max_tiles: Optional[int] = 20_000,
+):  # pylint: disable=too-many-arguments
+    """Plot boxes of many tiles as a single GeoJSON layer.
+
+    Arguments:
+        map_obj - folium map
+        x_idx_tile - array of integers, x index of the tiles
+        y_idx_tile - array of integers, y index of the tiles
+        zoom - zoom level of the tiles
+        color - color of the boxes
+        merge - if True, adjacent tiles are merged and only outlines
+            of the covered areas are plotted
+        max_tiles - render budget, if there are more unique tiles, they are
+            replaced with parent tiles of lower zoom until they fit,
+            None - plot all tiles
+    """
+    if max_tiles is not None:
+        n_tiles = len(x_idx_tile)
+        x_idx_tile, y_idx_tile, plot_zoom = plot_utils.decimate_tiles(
+            x_idx_tile, y_idx_tile, zoom, max_tiles
+        )
+        if plot_zoom != zoom:
+            LOGGER.info(
+                "%d tiles exceed budget of %d tiles, plotting %d tiles of zoom %d",
+                n_tiles,
+                max_tiles,
+                len(x_idx_tile),
+                plot_zoom,
+            )
+        zoom = plot_zoom
+
+    features = []
+    if merge:
+        for ring in plot_utils.get_tiles_outlines(x_idx_tile, y_idx_tile, zoom):
+            features.append(_line_feature(ring, {}))
+    else:
+        boxes = plot_utils.get_tile_boxes_coords(x_idx_tile, y_idx_tile, zoom)
+        for x_tile, y_tile, box in zip(
+            np.asarray(x_idx_tile).tolist(), np.asarray(y_idx_tile).tolist(), boxes
+        ):
+            features.append(
+                _line_feature(box, {"tile_idx_x": x_tile, "tile_idx_y": y_tile})
+            )
+
+    folium.GeoJson(
+        _feature_collection(features),
+        style_function=lambda _: {"color": color, "weight": 2},
+    ).add_to(map_obj)
+
+    return map_obj
+
+
+def _line_feature(coords: np.ndarray, properties: Dict[str, Any]) -> Dict[str, Any]:
+    """Return GeoJSON LineString feature from array of (lat, lon) points."""
+    return {
+        "type": "Feature",
+        "properties": properties,
+        "geometry": {
+            "type": "LineString",
+            "coordinates": np.round(coords[:, ::-1], COORD_DECIMALS).tolist(),
+        },
+    }
+
+
+def _feature_collection(features: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return GeoJSON FeatureCollection of features."""
+    return {"type": "FeatureCollection", "features": features}
+
+
 def add_tile_to_map(
     tile_x_idx: int,
     tile_y_idx: int,
@@ -73,3 +175,37 @@ def add_box_to_map(
     folium.PolyLine(locations=locations, radius=radius, color=color).add_to(map_obj)
 
     return map_obj
+
+
+def add_heatmap_tiles_to_map(
+    map_obj: folium.Map,
+    tiles_url: str,
+    max_zoom: int,
+    name: str = "heatmap",
+    opacity: float = 0.8,
+):
+    """Add raster tiles rendered by 'heatmap_tiles.render_heatmap_tiles'.
+
+    Arguments:
+        map_obj - folium map
+        tiles_url - URL of the output directory of the renderer, e.g.
+            "http://localhost:8000" when it is served by a static file server,
+            or path relative to the saved HTML file of the map
+        max_zoom - the highest rendered zoom, tiles of this zoom are scaled up
+            when the map is zoomed in further
+        name - name of the layer in the layer control
+        opacity - opacity of the layer
+    """
+    # pylint: disable=too-many-arguments
+    folium.TileLayer(
+        tiles=tiles_url.rstrip("/") + "/{z}/{x}/{y}.png",
+        attr=name,
+        name=name,
+        overlay=True,
+        opacity=opacity,
+        max_native_zoom=max_zoom,
+        # layer is hidden above its max zoom, 18 is the max zoom of base maps
+        max_zoom=max(max_zoom, 18),
+    ).add_to(map_obj)
+
+    return map_obj
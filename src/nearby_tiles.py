@@ -1,24 +1,49 @@
 """Search all tiles in given radius from given point."""
-from typing import Tuple
+# pylint: disable=too-many-lines
+import contextlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pandas as pd
 
-from src import np_tiles_converter
+from src import instrumentation, np_tiles_converter, shared_arrays, stencil
 
+LOGGER = logging.getLogger(__name__)
 
-def _xy_combinations(x_arr: np.ndarray, y_arr: np.ndarray) -> np.ndarray:
-    """Fast cartesian product of two arrays.
+# Approximate peak bytes used per neighbour tile while expanding the circle:
+# repeated point coordinates, shifts, four quarters and the output DataFrame.
+NEIGHBOUR_BYTES = 160
 
-    Given two arrays returns all combinations of their members.
-    any x <-> any y
+# Number of tasks per worker in the parallel mode, more tasks balance load better
+TASKS_PER_WORKER = 8
+
+
+class NeighbourMatrix(NamedTuple):
+    """Sparse relation between locations and their neighbour tiles.
+
+    matrix - scipy.sparse CSR matrix of int32 ones, shape = [locations, tiles],
+        matrix[i, j] = 1 if tile j is a neighbour of location i
+    tile_idx_x, tile_idx_y - int32 coordinates of the tile of every column,
+        columns are sorted by row-major tile key (y, x)
+    zoom - zoom level of the tiles
     """
-    return np.dstack(np.meshgrid(x_arr, y_arr)).reshape(-1, 2)
+
+    matrix: Any
+    tile_idx_x: np.ndarray
+    tile_idx_y: np.ndarray
+    zoom: int
 
 
 def get_nearby_tiles(
-    df_coords: pd.DataFrame, zoom: int, radius: float = 500
-) -> pd.DataFrame:
+    df_coords: pd.DataFrame,
+    zoom: int,
+    radius: Union[float, Sequence[float]] = 500,
+    output: str = "frame",
+    n_jobs: Optional[int] = 1,
+) -> Union[pd.DataFrame, NeighbourMatrix]:
     """Output all tiles in given distance from provided coordinates.
 
     For example if you have 100 locations and for each point you want to list
@@ -26,181 +51,1196 @@ def get_nearby_tiles(
 
     Arguments:
         df_coords - have two columns "lon" and "lat" which store coordinates in degrees
-        radius - radius in meters
-
+        radius - radius in meters or list of radii; with several radii tiles
+            within the largest one are returned with extra column "ring"
+            (int8): position of the smallest radius in sorted radii the tile
+            is within, tiles within radii[k] are rows with "ring" <= k;
+            distances are computed once, cost is close to the cost
+            of the largest radius alone
+        output - "frame" returns DataFrame with columns "coord_id" (int64),
+            "tile_idx_x", "tile_idx_y" (int32); "sparse" returns NeighbourMatrix
+            with one row per location and one column per unique tile, which
+            can be aggregated with 'aggregate_pois' (requires scipy, single
+            radius only)
+        n_jobs - number of processes, None - all cores, 1 - no pool (default);
+            points are split between processes by bands of tile rows, inputs
+            and outputs are passed through shared memory, the result
+            is identical to the serial one
     """
-    # pylint: disable=too-many-locals
     assert "lon" in df_coords.columns
     assert "lat" in df_coords.columns
-    assert radius > 0
     assert 1 <= zoom <= 23
+    assert output in ("frame", "sparse")
 
-    # we will need to add ids to all coordinates:
     n_coords = df_coords.shape[0]
 
     if n_coords > 30000:
-        print("Too many points in dataset, calculations may take a while")
+        LOGGER.info(
+            "%d points in dataset, calculations may take a while. "
+            "Use iter_nearby_tiles to process points in chunks",
+            n_coords,
+        )
+
+    if isinstance(radius, (Sequence, np.ndarray)):
+        radii = _sorted_radii(radius)
+        assert output == "frame", "Sparse output supports single radius only"
+        return _nearby_tiles(
+            df_coords["lat"].values,
+            df_coords["lon"].values,
+            zoom,
+            radii[-1],
+            radii,
+            n_jobs=n_jobs,
+        )
+
+    assert radius > 0
+    if output == "sparse":
+        return _neighbour_matrix(
+            df_coords["lat"].values, df_coords["lon"].values, zoom, radius, n_jobs
+        )
+    return _nearby_tiles(
+        df_coords["lat"].values, df_coords["lon"].values, zoom, radius, n_jobs=n_jobs
+    )
 
-    coord_lat = df_coords["lat"].values
-    coord_lon = df_coords["lon"].values
-    coord_id = np.arange(0, n_coords)  ## simply indexing [0,1,2,3,4,...]
 
-    # for each input coordinate
-    # 1. get it's tile X,Y indexes
-    # 2. tile center lat/lot coordinates
-    idx_x_cent, idx_y_cent = np_tiles_converter.np_deg2idx(
-        coord_lat, coord_lon, zoom=zoom
+def aggregate_pois(
+    neighbours: NeighbourMatrix,
+    df_pois: pd.DataFrame,
+    value_cols: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Count and sum POI attributes over neighbour tiles of every location.
+
+    POIs are aggregated per tile into a dense [tiles, attributes] matrix,
+    then all locations are aggregated with one sparse matrix product.
+    Counts are the same as 'count_pois_in_radius' gives.
+
+    Arguments:
+        neighbours - output of 'get_nearby_tiles' with output="sparse"
+        df_pois - have two columns "lon" and "lat" with POI coordinates
+            in degrees and numeric 'value_cols'
+        value_cols - columns of 'df_pois' to sum, none by default
+
+    Returns:
+        DataFrame with one row per location and columns "coord_id",
+        "poi_count" and sums of 'value_cols'
+    """
+    # pylint: disable=too-many-locals
+    assert "lon" in df_pois.columns
+    assert "lat" in df_pois.columns
+    value_cols = value_cols or []
+
+    poi_x, poi_y = np_tiles_converter.np_deg2idx(
+        df_pois["lat"].values, df_pois["lon"].values, zoom=neighbours.zoom
     )
-    center_lat, center_lon = np_tiles_converter.np_idx2deg(
-        idx_x_cent, idx_y_cent, zoom=zoom
+    n_tiles = int(np_tiles_converter.zoom_power(neighbours.zoom))
+    column_keys = (
+        neighbours.tile_idx_y.astype(np.int64) * n_tiles + neighbours.tile_idx_x
     )
+    poi_keys = poi_y.astype(np.int64) * n_tiles + poi_x
+    n_columns = column_keys.shape[0]
+
+    # column of the POI tile, POIs in tiles without locations are dropped
+    column = np.searchsorted(column_keys, poi_keys)
+    found = column < n_columns
+    found[found] = column_keys[column[found]] == poi_keys[found]
 
-    # distance in meters to the closest adjacent tile
-    lat_adj, lon_adj = np_tiles_converter.np_idx2deg(
-        idx_x_cent + 1, idx_y_cent, zoom=zoom
+    tile_values = np.empty((n_columns, len(value_cols) + 1))
+    tile_values[:, 0] = np.bincount(column[found], minlength=n_columns)
+    for pos, col in enumerate(value_cols, start=1):
+        tile_values[:, pos] = np.bincount(
+            column[found], weights=df_pois[col].values[found], minlength=n_columns
+        )
+
+    sums = neighbours.matrix @ tile_values
+    df_agg = pd.DataFrame(
+        {
+            "coord_id": np.arange(neighbours.matrix.shape[0]),
+            "poi_count": sums[:, 0].astype(np.int64),
+        }
     )
-    x_tile_dist = np_tiles_converter.np_haversin(
-        center_lat, center_lon, lat_adj, lon_adj
+    for pos, col in enumerate(value_cols, start=1):
+        df_agg[col] = sums[:, pos]
+    return df_agg
+
+
+def iter_nearby_tiles(
+    df_coords: pd.DataFrame,
+    zoom: int,
+    radius: float = 500,
+    memory_budget: int = 256 * 2**20,
+) -> Iterator[pd.DataFrame]:
+    """Output tiles in given distance from provided coordinates in batches.
+
+    Streaming version of 'get_nearby_tiles'. Input points are processed
+    in chunks sized so that expanding a chunk takes about 'memory_budget'
+    bytes, so peak memory does not grow with the number of input points.
+    Column "coord_id" is a position of the point in 'df_coords',
+    same as in 'get_nearby_tiles'.
+
+    Arguments:
+        df_coords - have two columns "lon" and "lat" which store coordinates in degrees
+        radius - radius in meters
+        memory_budget - approximate memory limit for single batch in bytes
+
+    Yields:
+        DataFrame with columns "coord_id", "tile_idx_x", "tile_idx_y"
+    """
+    assert "lon" in df_coords.columns
+    assert "lat" in df_coords.columns
+    assert radius > 0
+    assert 1 <= zoom <= 23
+    assert memory_budget > 0
+
+    coord_lat = df_coords["lat"].values
+    coord_lon = df_coords["lon"].values
+    chunk_size = _chunk_size(coord_lat, coord_lon, zoom, radius, memory_budget)
+
+    for start in range(0, df_coords.shape[0], chunk_size):
+        end = start + chunk_size
+        nearby_tiles = _nearby_tiles(
+            coord_lat[start:end], coord_lon[start:end], zoom, radius
+        )
+        nearby_tiles["coord_id"] += start
+        yield nearby_tiles
+
+
+def nearby_tiles_to_parquet(
+    df_coords: pd.DataFrame,
+    path: str,
+    zoom: int,
+    radius: float = 500,
+    memory_budget: int = 256 * 2**20,
+) -> int:
+    """Write tiles in given distance from provided coordinates to Parquet file.
+
+    Batches from 'iter_nearby_tiles' are written to the file one by one
+    (one row group per batch) and never kept in memory together.
+
+    Arguments:
+        df_coords - have two columns "lon" and "lat" which store coordinates in degrees
+        path - output Parquet file
+        radius - radius in meters
+        memory_budget - approximate memory limit for single batch in bytes
+
+    Returns:
+        number of written rows
+    """
+    # pylint: disable=import-outside-toplevel
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    n_rows = 0
+    try:
+        for batch in iter_nearby_tiles(df_coords, zoom, radius, memory_budget):
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            n_rows += table.num_rows
+
+        if writer is None:
+            # no input points, still create file with proper columns
+            empty = _nearby_tiles(np.array([]), np.array([]), zoom, radius)
+            pq.write_table(pa.Table.from_pandas(empty, preserve_index=False), path)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
+
+
+def _sorted_radii(radii: Union[Sequence[float], np.ndarray]) -> Tuple[float, ...]:
+    """Return unique positive radii sorted ascending."""
+    sorted_radii = tuple(sorted({float(radius) for radius in radii}))
+    assert len(sorted_radii) > 0
+    assert sorted_radii[0] > 0
+    return sorted_radii
+
+
+def _chunk_size(
+    coord_lat: np.ndarray,
+    coord_lon: np.ndarray,
+    zoom: int,
+    radius: float,
+    memory_budget: int,
+) -> int:
+    """Return number of points which can be expanded within memory budget."""
+    _, idx_y = np_tiles_converter.np_deg2idx(coord_lat, coord_lon, zoom=zoom)
+    if idx_y.shape[0] == 0:
+        return 1
+
+    # stencils grow with latitude, the largest one is in one of the extreme bands
+    bands = stencil.tile_band(np.array([idx_y.min(), idx_y.max()]), zoom)
+    n_q1_shifts = max(
+        sum(shifts.shape[0] for shifts in stencil.band_stencil(int(band), zoom, radius))
+        for band in bands
     )
+    point_bytes = 4 * n_q1_shifts * NEIGHBOUR_BYTES
+    return max(1, int(memory_budget // point_bytes))
+
+
+def _nearby_tiles(
+    coord_lat: np.ndarray,
+    coord_lon: np.ndarray,
+    zoom: int,
+    radius: float,
+    radii: Optional[Tuple[float, ...]] = None,
+    n_jobs: Optional[int] = 1,
+) -> pd.DataFrame:
+    """Output all tiles in given distance from provided coordinates.
 
-    lat_adj, lon_adj = np_tiles_converter.np_idx2deg(
-        idx_x_cent, idx_y_cent + 1, zoom=zoom
+    If 'radii' are given, 'radius' is ignored and column "ring" is added.
+    """
+    # pylint: disable=too-many-arguments
+    nbr_id, nbr_x, nbr_y, nbr_ring = nearby_tile_arrays(
+        coord_lat, coord_lon, zoom, radius, radii, n_jobs
     )
-    y_tile_dist = np_tiles_converter.np_haversin(
-        center_lat, center_lon, lat_adj, lon_adj
+    nearby_tiles = pd.DataFrame(
+        {
+            "coord_id": nbr_id,
+            "tile_idx_x": nbr_x,
+            "tile_idx_y": nbr_y,
+        }
     )
+    if nbr_ring is not None:
+        nearby_tiles["ring"] = nbr_ring
 
-    # let's calculate how far we should searh for good tiles
-    # left, right, down and up from given points
-    # we will include all tiles in 'lim' from current tile
-    # adding small number to prevent division on zero
-    x_tiles_lim = np.ceil(radius / x_tile_dist + 0.0001) + 1
-    y_tiles_lim = np.ceil(radius / (y_tile_dist + 0.0001)) + 1
+    return nearby_tiles
+
+
+def nearby_tile_arrays(
+    coord_lat: np.ndarray,
+    coord_lon: np.ndarray,
+    zoom: int,
+    radius: float,
+    radii: Optional[Tuple[float, ...]] = None,
+    n_jobs: Optional[int] = 1,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """Output all tiles in given distance from provided coordinates as arrays.
+
+    Array version of 'get_nearby_tiles' without pandas: outputs are used
+    as they are, e.g. wrapped into Arrow arrays without a copy.
+
+    Arguments:
+        coord_lat, coord_lon - numpy arrays, degrees of the points
+        zoom - integer, zoom level of the tiles
+        radius - distance in meters
+        radii - sorted radii of the rings, the largest one is used as 'radius'
+        n_jobs - number of processes, None - all cores, 1 - no pool
+
+    Returns:
+        coord_id - int64 position of the point in the input arrays
+        tile_idx_x, tile_idx_y - int32 tile coordinates of the neighbour
+        ring - int8 position of the smallest radius the neighbour is within,
+            None if 'radii' are not given
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    n_coords = coord_lat.shape[0]
+    coord_id = np.arange(0, n_coords, dtype=np.int64)  ## simply indexing [0,1,2,...]
+    ring_radii = radii if radii is not None else (float(radius),)
+    with_ring = radii is not None
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
 
-    max_x_lim = x_tiles_lim.max()
-    max_y_lim = y_tiles_lim.max()
+    # for each input coordinate get it's tile X,Y indexes
+    with instrumentation.stage("tile centers") as stg:
+        idx_x_cent, idx_y_cent = np_tiles_converter.np_deg2idx(
+            coord_lat, coord_lon, zoom=zoom
+        )
+        idx_x_cent = idx_x_cent.astype(np.int32)
+        idx_y_cent = idx_y_cent.astype(np.int32)
+        stg.count(points=n_coords)
 
     # To get full circle in given radius we need to check all nearby tiles:
     # by applying negative shifts (moving left/up) and positive shifts (moving right/down)
     # Because search is symmetric, let's only search one quarter of the circle
-    # by checking only positive shifts
+    # by checking only positive shifts.
+    #
+    # Valid shifts depend only on the tile row, so points are grouped by bands of
+    # rows and every band uses cached stencil (see stencil.band_ring_stencil).
+    # With several radii distances are checked once for the largest radius
+    # and only near the boundaries of the rings.
+    bands = stencil.tile_band(idx_y_cent, zoom)
+    band_order = coord_id[np.argsort(bands, kind="stable")]
+    uniq_bands, band_counts = np.unique(bands[band_order], return_counts=True)
+    band_ends = np.cumsum(band_counts)
+
+    if n_jobs > 1:
+        return _parallel_tile_arrays(
+            idx_x_cent,
+            idx_y_cent,
+            band_order,
+            list(zip(uniq_bands.tolist(), band_ends.tolist(), band_counts.tolist())),
+            zoom,
+            ring_radii,
+            with_ring,
+            n_jobs,
+        )
+
+    parts: List[Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]] = []
+    for band, band_end, band_count in zip(uniq_bands, band_ends, band_counts):
+        parts += _band_neighbours(
+            band_order[band_end - band_count : band_end],
+            idx_x_cent,
+            idx_y_cent,
+            int(band),
+            zoom,
+            ring_radii,
+            with_ring,
+        )
+
+    point_id = np.concatenate([coord_id[:0]] + [part[0] for part in parts])
+    shifts_x = np.concatenate([idx_x_cent[:0]] + [part[1] for part in parts])
+    shifts_y = np.concatenate([idx_y_cent[:0]] + [part[2] for part in parts])
+    values = [point_id]
+    if with_ring:
+        values.append(
+            np.concatenate(
+                [np.array([], dtype=np.int8)] + [part[3] for part in parts]  # type: ignore
+            )
+        )
+
+    with instrumentation.stage("quadrant mirroring") as stg:
+        nbr_x, nbr_y, nbr_values = _cover_full_circle(
+            idx_x_cent[point_id], idx_y_cent[point_id], shifts_x, shifts_y, values
+        )
+        if stg:
+            stg.count(
+                q1_tiles=shifts_x.shape[0],
+                tiles=nbr_x.shape[0],
+                nbytes=sum(arr.nbytes for arr in [nbr_x, nbr_y] + nbr_values),
+            )
 
-    shifts_xy = _xy_combinations(
-        np.arange(0, max_x_lim + 1),
-        np.arange(0, max_y_lim + 1),
+    nbr_ring = nbr_values[1] if with_ring else None
+    return nbr_values[0], nbr_x, nbr_y, nbr_ring
+
+
+def _band_neighbours(
+    band_id: np.ndarray,
+    idx_x_cent: np.ndarray,
+    idx_y_cent: np.ndarray,
+    band: int,
+    zoom: int,
+    ring_radii: Tuple[float, ...],
+    with_ring: bool,
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]]:
+    """Return Q1 neighbours of points of one band of tile rows.
+
+    Arguments:
+        band_id - positions of the points of the band
+        idx_x_cent, idx_y_cent - tiles of all points
+        ring_radii - sorted radii, the largest one is the search radius
+
+    Returns:
+        two parts, shifts valid for all points of the band and measured shifts
+        near the circle boundary: point id, shift x, shift y and ring
+        (None if 'with_ring' is False)
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    band_count = band_id.shape[0]
+    with instrumentation.stage("stencil build") as stg:
+        (
+            certain,
+            certain_ring,
+            uncertain,
+            uncertain_status,
+        ) = stencil.band_ring_stencil(band, zoom, ring_radii)
+        stg.count(bands=1)
+
+    # shifts valid for all points in the band: integer adds only
+    with instrumentation.stage("rough filter") as stg:
+        certain_part = (
+            np.repeat(band_id, certain.shape[0]),
+            np.tile(certain[:, 0], band_count),
+            np.tile(certain[:, 1], band_count),
+            np.tile(certain_ring, band_count) if with_ring else None,
+        )
+        if stg:
+            stg.count(
+                points=band_count,
+                certain=certain.shape[0] * band_count,
+                uncertain=uncertain.shape[0] * band_count,
+                nbytes=sum(arr.nbytes for arr in certain_part if arr is not None),
+            )
+
+    # shifts near the circle boundary: calculate haversine distance and filter
+    with instrumentation.stage("haversine filter") as stg:
+        point_id = np.repeat(band_id, uncertain.shape[0])
+        shifts_x = np.tile(uncertain[:, 0], band_count)
+        shifts_y = np.tile(uncertain[:, 1], band_count)
+
+        center_x = idx_x_cent[point_id].astype(np.int64)
+        center_y = idx_y_cent[point_id].astype(np.int64)
+        dist = np_tiles_converter.np_tile_haversin(
+            center_x, center_y, center_x + shifts_x, center_y + shifts_y, zoom
+        )
+
+        uncertain_ring = None
+        if not with_ring:
+            filt_dist = dist <= ring_radii[-1]
+        else:
+            # ring is the first radius the shift is certainly or measured within
+            status = np.tile(uncertain_status, (band_count, 1))
+            within = (status == 2) | (status == 1) & (
+                dist[:, None] <= np.array(ring_radii)
+            )
+            filt_dist = within.any(axis=1)
+            uncertain_ring = within[filt_dist].argmax(axis=1).astype(np.int8)
+        uncertain_part = (
+            point_id[filt_dist],
+            shifts_x[filt_dist],
+            shifts_y[filt_dist],
+            uncertain_ring,
+        )
+        if stg:
+            stg.count(
+                candidates=dist.shape[0],
+                kept=uncertain_part[1].shape[0],
+                nbytes=sum(
+                    arr.nbytes
+                    for arr in (point_id, shifts_x, shifts_y, center_x, center_y, dist)
+                ),
+            )
+
+    return [certain_part, uncertain_part]
+
+
+def _parallel_tile_arrays(
+    idx_x_cent: np.ndarray,
+    idx_y_cent: np.ndarray,
+    band_order: np.ndarray,
+    band_runs: List[Tuple[int, int, int]],
+    zoom: int,
+    ring_radii: Tuple[float, ...],
+    with_ring: bool,
+    n_jobs: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """Expand points in a pool of processes, output is the same as serial one.
+
+    Points sorted by bands are split into tasks of similar size, every task
+    is a run of points of a single band, so workers reuse one cached stencil
+    and nearby tiles. Pool runs two passes: the first one writes Q1
+    neighbours of every task into a shared scratch buffer sized by the number
+    of stencil shifts, the second one mirrors them into quarters at their
+    offsets in the serial output, known from the counts of the first pass.
+
+    Arguments:
+        band_order - positions of the points sorted by band
+        band_runs - (band, end of its points in 'band_order', number of points)
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    # stencils are built before the pool starts, forked workers inherit the cache
+    stencil_rows = []
+    for band, _, band_count in band_runs:
+        certain, _, uncertain, _ = stencil.band_ring_stencil(band, zoom, ring_radii)
+        stencil_rows.append((certain.shape[0], uncertain.shape[0]))
+    total_rows = sum(
+        (n_certain + n_uncertain) * band_count
+        for (n_certain, n_uncertain), (_, _, band_count) in zip(stencil_rows, band_runs)
     )
-    shifts_xy = shifts_xy.astype(np.int32)
-    n_shifts = shifts_xy.shape[0]
+    target_rows = max(1, total_rows // (n_jobs * TASKS_PER_WORKER))
+
+    # task: band, first and last position in 'band_order', offset in scratch
+    tasks = []
+    scratch_size = 0
+    for (band, band_end, band_count), (n_certain, n_uncertain) in zip(
+        band_runs, stencil_rows
+    ):
+        point_rows = n_certain + n_uncertain
+        chunk_points = max(1, target_rows // max(1, point_rows))
+        for start in range(band_end - band_count, band_end, chunk_points):
+            end = min(start + chunk_points, band_end)
+            tasks.append((band, start, end, scratch_size))
+            scratch_size += (end - start) * point_rows
 
-    # five columns: id, lat, lon, idx_x, idx_y
-    center_coords = np.concatenate(
+    n_coords = idx_x_cent.shape[0]
+    n_ring = scratch_size if with_ring else 0
+    with shared_arrays.allocate(
         [
-            coord_id.reshape([-1, 1]),
-            center_lat.reshape([-1, 1]),
-            center_lon.reshape([-1, 1]),
-            idx_x_cent.reshape([-1, 1]),
-            idx_y_cent.reshape([-1, 1]),
-        ],
-        axis=1,
+            ((n_coords,), np.int32),
+            ((n_coords,), np.int32),
+            ((n_coords,), np.int64),
+            ((scratch_size,), np.int64),
+            ((scratch_size,), np.int32),
+            ((scratch_size,), np.int32),
+            ((n_ring,), np.int8),
+        ]
+    ) as specs, ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        _fill_shared(specs[:3], [idx_x_cent, idx_y_cent, band_order])
+
+        with instrumentation.stage("parallel filter") as stg:
+            results = list(
+                pool.map(
+                    _q1_task,
+                    [specs] * len(tasks),
+                    *zip(*tasks),
+                    [zoom] * len(tasks),
+                    [ring_radii] * len(tasks),
+                    [with_ring] * len(tasks),
+                    [instrumentation.is_active()] * len(tasks),
+                )
+            )
+            counts = [sizes for sizes, _ in results]
+            # stages of the bands measured in the workers
+            instrumentation.add_records(
+                record for _, records in results for record in records
+            )
+            stg.count(
+                tasks=len(tasks), points=n_coords, nbytes=shared_arrays.nbytes(specs)
+            )
+
+        # pieces in the order of the serial output: band, part, task
+        pieces = []
+        sizes = []
+        task_pos = 0
+        for band, _, _ in band_runs:
+            band_tasks = []
+            while task_pos < len(tasks) and tasks[task_pos][0] == band:
+                band_tasks.append(task_pos)
+                task_pos += 1
+            for part in range(2):
+                for pos in band_tasks:
+                    # certain part is written first, measured part after it
+                    offset = tasks[pos][3] + (counts[pos][0][0] if part else 0)
+                    pieces.append((pos, offset, counts[pos][part][0]))
+                    sizes.append(counts[pos][part])
+
+        # offsets of every piece in each of four quarters
+        sizes_arr = np.array(sizes, dtype=np.int64).reshape(-1, 4)
+        quarter_starts = np.cumsum(sizes_arr.sum(axis=0)) - sizes_arr.sum(axis=0)
+        piece_starts = quarter_starts + np.cumsum(sizes_arr, axis=0) - sizes_arr
+        n_total = int(sizes_arr.sum())
+
+        mirror_tasks: List[List[Tuple[int, int, Tuple[int, ...]]]] = [[] for _ in tasks]
+        for (pos, offset, n_rows), starts in zip(pieces, piece_starts.tolist()):
+            mirror_tasks[pos].append((offset, n_rows, tuple(starts)))
+
+        with shared_arrays.allocate(
+            [
+                ((n_total,), np.int32),
+                ((n_total,), np.int32),
+                ((n_total,), np.int64),
+                ((n_total if with_ring else 0,), np.int8),
+            ]
+        ) as out_specs:
+            with instrumentation.stage("quadrant mirroring") as stg:
+                list(
+                    pool.map(
+                        _mirror_task,
+                        [specs] * len(tasks),
+                        [out_specs] * len(tasks),
+                        mirror_tasks,
+                        [with_ring] * len(tasks),
+                    )
+                )
+                stg.count(
+                    tasks=len(tasks),
+                    tiles=n_total,
+                    nbytes=shared_arrays.nbytes(out_specs),
+                )
+            nbr_x, nbr_y, nbr_id, nbr_ring = _copy_shared(out_specs)
+
+    return nbr_id, nbr_x, nbr_y, nbr_ring if with_ring else None
+
+
+def _fill_shared(
+    specs: Sequence[shared_arrays.SharedArray], values: Sequence[np.ndarray]
+) -> None:
+    """Copy arrays into shared memory."""
+    with shared_arrays.attach(specs) as arrays:
+        for pos, value in enumerate(values):
+            arrays[pos][:] = value
+
+
+def _copy_shared(specs: Sequence[shared_arrays.SharedArray]) -> List[np.ndarray]:
+    """Copy arrays out of shared memory."""
+    with shared_arrays.attach(specs) as arrays:
+        return [arr.copy() for arr in arrays]
+
+
+def _q1_task(
+    specs: Sequence[shared_arrays.SharedArray],
+    band: int,
+    start: int,
+    end: int,
+    offset: int,
+    zoom: int,
+    ring_radii: Tuple[float, ...],
+    with_ring: bool,
+    instrument: bool,
+) -> Tuple[List[Tuple[int, int, int, int]], List[instrumentation.StageRecord]]:
+    """Write Q1 neighbours of a run of points to the scratch buffer.
+
+    Runs in a worker process. Neighbours are written from 'offset': shifts
+    valid for all points first, then measured shifts.
+
+    Arguments:
+        instrument - if True, stages of the task are collected
+
+    Returns:
+        sizes of the quarters (see '_quarters') of both parts and
+        records of the stages for 'instrumentation.add_records'
+    """
+    # pylint: disable=too-many-arguments
+    records: List[instrumentation.StageRecord] = []
+    with contextlib.ExitStack() as stack:
+        if instrument:
+            stack.enter_context(instrumentation.collect(records.append))
+        with shared_arrays.attach(specs) as arrays:
+            sizes = _q1_chunk(
+                arrays, band, start, end, offset, zoom, ring_radii, with_ring
+            )
+    return sizes, records
+
+
+def _q1_chunk(
+    arrays: List[np.ndarray],
+    band: int,
+    start: int,
+    end: int,
+    offset: int,
+    zoom: int,
+    ring_radii: Tuple[float, ...],
+    with_ring: bool,
+) -> List[Tuple[int, int, int, int]]:
+    """Compute and write Q1 neighbours, see '_q1_task'."""
+    # pylint: disable=too-many-arguments,too-many-locals
+    idx_x_cent, idx_y_cent, band_order, point_id, shift_x, shift_y, ring = arrays
+    parts = _band_neighbours(
+        band_order[start:end],
+        idx_x_cent,
+        idx_y_cent,
+        band,
+        zoom,
+        ring_radii,
+        with_ring,
     )
 
-    coords = np.repeat(center_coords, n_shifts, axis=0)
+    sizes = []
+    for part_id, part_x, part_y, part_ring in parts:
+        rows = slice(offset, offset + len(part_x))
+        point_id[rows] = part_id
+        shift_x[rows] = part_x
+        shift_y[rows] = part_y
+        if part_ring is not None:
+            ring[rows] = part_ring
+        sizes.append(tuple(size for _, _, _, size in _quarters(part_x, part_y)))
+        offset = rows.stop
+    return sizes  # type: ignore
 
-    # print (coords.shape)
 
-    # same as np.repeat, but work a bit different
-    shifts_x = np.tile(shifts_xy[:, 0], n_coords)
-    shifts_y = np.tile(shifts_xy[:, 1], n_coords)
+def _mirror_task(
+    specs: Sequence[shared_arrays.SharedArray],
+    out_specs: Sequence[shared_arrays.SharedArray],
+    pieces: List[Tuple[int, int, Tuple[int, ...]]],
+    with_ring: bool,
+) -> None:
+    """Mirror Q1 neighbours from the scratch buffer into the output.
 
-    # rough filter by delta tiles, given diagonal in the triangle
-    #
-    filter_rough = shifts_x + shifts_y <= max(max_x_lim, max_y_lim) * np.sqrt(2)
-    coords = coords[filter_rough]
-    shifts_x = shifts_x[filter_rough]
-    shifts_y = shifts_y[filter_rough]
+    Runs in a worker process.
 
-    # print (coords.shape)
+    Arguments:
+        pieces - (offset in scratch, number of rows, start of every quarter
+            in the output)
+    """
+    with shared_arrays.attach(list(specs) + list(out_specs)) as arrays:
+        _mirror_pieces(arrays, pieces, with_ring)
 
-    # all tiles candidates in required distance from given tile
-    #
-    inner_lat, inner_lon = np_tiles_converter.np_idx2deg(
-        coords[:, 3] + shifts_x, coords[:, 4] + shifts_y, zoom=zoom
+
+def _mirror_pieces(
+    arrays: List[np.ndarray],
+    pieces: List[Tuple[int, int, Tuple[int, ...]]],
+    with_ring: bool,
+) -> None:
+    """Mirror Q1 neighbours, see '_mirror_task'."""
+    # pylint: disable=too-many-locals
+    idx_x_cent, idx_y_cent, _, point_id, shift_x, shift_y, ring = arrays[:7]
+    nbr_x, nbr_y, nbr_id, nbr_ring = arrays[7:]
+    for offset, n_rows, starts in pieces:
+        rows = slice(offset, offset + n_rows)
+        values = [point_id[rows]]
+        outputs = [nbr_x, nbr_y, nbr_id]
+        if with_ring:
+            values.append(ring[rows])
+            outputs.append(nbr_ring)
+        _mirror_quarters(
+            idx_x_cent[values[0]],
+            idx_y_cent[values[0]],
+            shift_x[rows],
+            shift_y[rows],
+            values,
+            outputs,
+            starts,
+        )
+
+
+def _neighbour_matrix(
+    coord_lat: np.ndarray,
+    coord_lon: np.ndarray,
+    zoom: int,
+    radius: float,
+    n_jobs: Optional[int] = 1,
+) -> NeighbourMatrix:
+    """Build sparse matrix of locations and compact tile ids."""
+    # pylint: disable=import-outside-toplevel
+    from scipy import sparse
+
+    nbr_id, nbr_x, nbr_y, _ = nearby_tile_arrays(
+        coord_lat, coord_lon, zoom, radius, n_jobs=n_jobs
+    )
+
+    # compact tile ids: position of the tile key among unique keys
+    n_tiles = int(np_tiles_converter.zoom_power(zoom))
+    column_keys, column = np.unique(
+        nbr_y.astype(np.int64) * n_tiles + nbr_x, return_inverse=True
+    )
+    matrix = sparse.csr_matrix(
+        (np.ones(nbr_id.shape[0], dtype=np.int32), (nbr_id, column.ravel())),
+        shape=(coord_lat.shape[0], column_keys.shape[0]),
     )
 
-    # calculate haversine distance and filter based on distance
-    dist = np_tiles_converter.np_haversin(
-        coords[:, 1], coords[:, 2], inner_lat, inner_lon
+    return NeighbourMatrix(
+        matrix,
+        (column_keys % n_tiles).astype(np.int32),
+        (column_keys // n_tiles).astype(np.int32),
+        zoom,
     )
 
-    filt_dist = dist <= radius
-    coords = coords[filt_dist]
-    shifts_x = shifts_x[filt_dist]
-    shifts_y = shifts_y[filt_dist]
 
-    # print (coords.shape)
+def _cover_full_circle(
+    center_x: np.ndarray,
+    center_y: np.ndarray,
+    shifts_x: np.ndarray,
+    shifts_y: np.ndarray,
+    values: List[np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray, List[np.ndarray]]:
+    """Extrapolating shifts from circle Q1 to other quarters.
 
-    nbr_id, nbr_x, nbr_y = _cover_full_circle(coords, shifts_x, shifts_y)
+    Output arrays are allocated once and every quarter is written
+    into its own slice: Q1 (+x,+y), Q3 (-x,-y) without [0,0] shift,
+    Q2 (-x,+y) and Q4 (+x,-y) without shifts on the axes.
 
-    nearby_tiles = pd.DataFrame(
+    Arguments:
+        values - arrays with a value per Q1 shift (e.g. point id),
+            copied to the mirrored shifts
+
+    Returns:
+        nbr_x - int32 x tile coord of a neigbour
+        nbr_y - int32 y tile coord of a neigbour
+        nbr_values - 'values' of every neighbour
+    """
+    quarters = _quarters(shifts_x, shifts_y)
+    n_total = sum(size for _, _, _, size in quarters)
+
+    nbr_x = np.empty(n_total, dtype=np.int32)
+    nbr_y = np.empty(n_total, dtype=np.int32)
+    nbr_values = [np.empty(n_total, dtype=val.dtype) for val in values]
+    starts = np.cumsum([0] + [size for _, _, _, size in quarters[:-1]]).tolist()
+    _mirror_quarters(
+        center_x,
+        center_y,
+        shifts_x,
+        shifts_y,
+        values,
+        [nbr_x, nbr_y] + nbr_values,
+        starts,
+        quarters,
+    )
+
+    return nbr_x, nbr_y, nbr_values
+
+
+def _quarters(
+    shifts_x: np.ndarray, shifts_y: np.ndarray
+) -> List[Tuple[Union[slice, np.ndarray], int, int, int]]:
+    """Return filter of Q1 shifts, signs of x and y and size of every quarter."""
+    # to prevent duplication [0,0] is mirrored once, [0,*] and [*,0] twice
+    not_center = (shifts_x != 0) | (shifts_y != 0)
+    off_axis = (shifts_x != 0) & (shifts_y != 0)
+    n_off_axis = int(off_axis.sum())
+    return [
+        (slice(None), 1, 1, shifts_x.shape[0]),
+        (not_center, -1, -1, int(not_center.sum())),
+        (off_axis, -1, 1, n_off_axis),
+        (off_axis, 1, -1, n_off_axis),
+    ]
+
+
+def _mirror_quarters(
+    center_x: np.ndarray,
+    center_y: np.ndarray,
+    shifts_x: np.ndarray,
+    shifts_y: np.ndarray,
+    values: List[np.ndarray],
+    outputs: List[np.ndarray],
+    starts: Sequence[int],
+    quarters: Optional[List[Tuple[Union[slice, np.ndarray], int, int, int]]] = None,
+) -> None:
+    """Write Q1 shifts mirrored to all quarters into output arrays.
+
+    Arguments:
+        outputs - x, y and values of the neighbours
+        starts - position of every quarter in the outputs
+        quarters - output of '_quarters', computed if not given
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    if quarters is None:
+        quarters = _quarters(shifts_x, shifts_y)
+    nbr_x, nbr_y = outputs[:2]
+    for (filt, sign_x, sign_y, size), start in zip(quarters, starts):
+        end = start + size
+        nbr_x[start:end] = center_x[filt] + sign_x * shifts_x[filt]
+        nbr_y[start:end] = center_y[filt] + sign_y * shifts_y[filt]
+        for val, nbr_val in zip(values, outputs[2:]):
+            nbr_val[start:end] = val[filt]
+
+
+def count_pois_in_radius(
+    df_coords: pd.DataFrame,
+    df_pois: pd.DataFrame,
+    zoom: int,
+    radius: Union[float, Sequence[float]] = 500,
+) -> pd.DataFrame:
+    """Count POIs in tiles within given distance from provided coordinates.
+
+    Gives the same counts as 'get_nearby_tiles' merged with POI tiles and
+    grouped by 'coord_id', but never builds the table of neighbour tiles.
+    POI tiles are hashed into a sorted count table once, and for each location
+    counts are summed over the rows of the precomputed radius stencil.
+    Memory is proportional to the number of locations and POIs.
+
+    Arguments:
+        df_coords - have two columns "lon" and "lat" which store coordinates in degrees
+        df_pois - have two columns "lon" and "lat" with POI coordinates in degrees
+        zoom - integer, zoom level of the tiles
+        radius - radius in meters or list of radii, rows of the stencils are
+            scanned once for all radii
+
+    Returns:
+        DataFrame with one row per location and columns "coord_id", "poi_count";
+        with list of radii there is a column "poi_count_<radius>" per radius
+        instead of "poi_count", counts are cumulative (POIs within radius)
+    """
+    # pylint: disable=too-many-locals
+    assert "lon" in df_coords.columns
+    assert "lat" in df_coords.columns
+    assert "lon" in df_pois.columns
+    assert "lat" in df_pois.columns
+    assert 1 <= zoom <= 23
+
+    multi_radius = isinstance(radius, (Sequence, np.ndarray))
+    if isinstance(radius, (Sequence, np.ndarray)):
+        radii = _sorted_radii(radius)
+    else:
+        radii = (float(radius),)
+    assert radii[0] > 0
+
+    n_coords = df_coords.shape[0]
+    n_tiles = int(np_tiles_converter.zoom_power(zoom))
+
+    # count table: sorted row-major keys of POI tiles with cumulative counts
+    poi_x, poi_y = np_tiles_converter.np_deg2idx(
+        df_pois["lat"].values, df_pois["lon"].values, zoom=zoom
+    )
+    poi_keys = poi_y.astype(np.int64) * n_tiles + poi_x
+    poi_keys, poi_counts = np.unique(poi_keys, return_counts=True)
+    cum_counts = np.concatenate([[0], np.cumsum(poi_counts)])
+
+    idx_x, idx_y = np_tiles_converter.np_deg2idx(
+        df_coords["lat"].values, df_coords["lon"].values, zoom=zoom
+    )
+    idx_x = idx_x.astype(np.int64)
+    idx_y = idx_y.astype(np.int64)
+
+    # one stencil per tile row and radius, stored as run widths:
+    # widths[radius, row, abs(dy)]
+    uniq_rows, row_inv = np.unique(idx_y, return_inverse=True)
+    row_widths = [
+        [
+            stencil.stencil_row_widths(
+                stencil.quarter_stencil(int(row), zoom, ring_radius)
+            )
+            for row in uniq_rows
+        ]
+        for ring_radius in radii
+    ]
+    max_dy = max((widths.shape[0] for widths in row_widths[-1]), default=0)
+    widths_table = np.full((len(radii), uniq_rows.shape[0], max_dy), -1, dtype=np.int64)
+    for ring, ring_widths in enumerate(row_widths):
+        for i, widths in enumerate(ring_widths):
+            widths_table[ring, i, : widths.shape[0]] = widths
+
+    poi_count = np.zeros((len(radii), n_coords), dtype=np.int64)
+    for shift_y in range(-max_dy + 1, max_dy):
+        row = idx_y + shift_y
+        row_start = row * n_tiles
+        for ring in range(len(radii)):
+            width = widths_table[ring, row_inv, abs(shift_y)]
+            valid = (width >= 0) & (row >= 0) & (row < n_tiles)
+            if not valid.any():
+                continue
+
+            # run [x - width, x + width] in the row is a range of row-major keys
+            key_lo = row_start[valid] + np.maximum(idx_x[valid] - width[valid], 0)
+            key_hi = row_start[valid] + np.minimum(
+                idx_x[valid] + width[valid], n_tiles - 1
+            )
+            pos_lo = np.searchsorted(poi_keys, key_lo, side="left")
+            pos_hi = np.searchsorted(poi_keys, key_hi, side="right")
+            poi_count[ring, valid] += cum_counts[pos_hi] - cum_counts[pos_lo]
+
+    df_counts = pd.DataFrame({"coord_id": np.arange(0, n_coords)})
+    if multi_radius:
+        for ring, ring_radius in enumerate(radii):
+            df_counts[f"poi_count_{ring_radius:g}"] = poi_count[ring]
+    else:
+        df_counts["poi_count"] = poi_count[0]
+    return df_counts
+
+
+def knn_pois(
+    df_coords: pd.DataFrame, df_pois: pd.DataFrame, k: int, zoom: int
+) -> pd.DataFrame:
+    """Find k nearest POIs of every location.
+
+    POIs are hashed into a table sorted by row-major tile key. Around the tile
+    of every location square rings of tiles are explored: each step grows
+    the explored block of tiles [x - size, x + size], [y - size, y + size]
+    to size 0, 1, 3, 7, ..., so distant neighbours take a logarithmic number
+    of steps. Location is finished when its k-th nearest candidate is closer
+    than any point outside of the explored block: distance to the nearest
+    edge of the block (parallels and meridians) is a lower bound for all
+    unexplored POIs. All locations are processed together, each step
+    handles only unfinished locations.
+
+    Zoom should make the k-th neighbour a few tiles away, with too high zoom
+    many empty tiles are scanned, with too low zoom tiles have too many POIs.
+
+    Arguments:
+        df_coords - have two columns "lon" and "lat" which store coordinates in degrees
+        df_pois - have two columns "lon" and "lat" with POI coordinates in degrees
+        k - integer, number of neighbours
+        zoom - integer, zoom level of the tiles
+
+    Returns:
+        DataFrame with columns "coord_id", "rank" (starting from 1), "poi_id"
+        (index of 'df_pois'), "distance" in meters sorted by "coord_id" and
+        "rank"; locations have fewer than k rows only if there are fewer POIs
+    """
+    # pylint: disable=too-many-locals
+    assert "lon" in df_coords.columns
+    assert "lat" in df_coords.columns
+    assert "lon" in df_pois.columns
+    assert "lat" in df_pois.columns
+    assert k >= 1
+    assert 1 <= zoom <= 23
+
+    n_coords = df_coords.shape[0]
+    n_tiles = int(np_tiles_converter.zoom_power(zoom))
+    coord_lat = df_coords["lat"].values.astype(np.float64)
+    coord_lon = df_coords["lon"].values.astype(np.float64)
+    poi_lat = df_pois["lat"].values.astype(np.float64)
+    poi_lon = df_pois["lon"].values.astype(np.float64)
+
+    # tile-keyed POI table: POI positions sorted by row-major tile key
+    poi_x, poi_y = np_tiles_converter.np_deg2idx(poi_lat, poi_lon, zoom=zoom)
+    poi_keys = poi_y.astype(np.int64) * n_tiles + poi_x
+    poi_order = np.argsort(poi_keys, kind="stable")
+    poi_keys = poi_keys[poi_order]
+
+    idx_x, idx_y = np_tiles_converter.np_deg2idx(coord_lat, coord_lon, zoom=zoom)
+    idx_x = idx_x.astype(np.int64)
+    idx_y = idx_y.astype(np.int64)
+
+    # k best candidates of every location, sorted by distance
+    best_dist = np.full((n_coords, k), np.inf)
+    best_poi = np.full((n_coords, k), -1, dtype=np.int64)
+
+    active = np.arange(n_coords)
+    inner = -1
+    while active.shape[0] > 0 and inner < n_tiles:
+        outer = max(2 * inner + 1, 0)
+
+        # POIs in the new ring of tiles between the blocks
+        range_loc, key_lo, key_hi = _ring_key_ranges(
+            idx_x[active], idx_y[active], inner, outer, n_tiles
+        )
+        pos_lo = np.searchsorted(poi_keys, key_lo, side="left")
+        pos_hi = np.searchsorted(poi_keys, key_hi, side="right")
+        n_found = pos_hi - pos_lo
+        run_start = np.cumsum(n_found) - n_found
+        rows = np.arange(n_found.sum()) - np.repeat(run_start - pos_lo, n_found)
+        cand_loc = active[np.repeat(range_loc, n_found)]
+        cand_poi = poi_order[rows]
+        cand_dist = np_tiles_converter.np_haversin(
+            coord_lat[cand_loc],
+            coord_lon[cand_loc],
+            poi_lat[cand_poi],
+            poi_lon[cand_poi],
+        )
+        _merge_best(best_dist, best_poi, active, cand_loc, cand_poi, cand_dist)
+
+        # haversine is rounded to 0.1 m, bound is lowered accordingly
+        bound = _explored_bound(
+            coord_lat[active],
+            coord_lon[active],
+            idx_x[active],
+            idx_y[active],
+            outer,
+            zoom,
+        )
+        active = active[~(best_dist[active, k - 1] < bound - 0.1)]
+        inner = outer
+
+    found = best_poi >= 0
+    return pd.DataFrame(
         {
-            "coord_id": nbr_id,
-            "tile_idx_x": nbr_x,
-            "tile_idx_y": nbr_y,
+            "coord_id": np.repeat(np.arange(n_coords), found.sum(axis=1)),
+            "rank": np.tile(np.arange(1, k + 1), n_coords)[found.ravel()],
+            "poi_id": df_pois.index.values[best_poi[found]],
+            "distance": best_dist[found],
         }
     )
 
-    return nearby_tiles
-
 
-def _cover_full_circle(
-    coords: np.ndarray, shifts_x: np.ndarray, shifts_y: np.ndarray
+def _ring_key_ranges(
+    idx_x: np.ndarray, idx_y: np.ndarray, inner: int, outer: int, n_tiles: int
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Extrapolating shifts from circle Q1 to other quarters.
+    """Return ranges of row-major tile keys of the ring between two blocks.
+
+    Ring contains tiles of the block [x - outer, x + outer], [y - outer, y + outer]
+    which are not in the block of size 'inner' (-1 - empty block). Rows above
+    and below the inner block are runs of tiles, rows of the inner block add
+    runs on its left and right side. Runs wrap around the antimeridian,
+    rows outside of the map are skipped.
 
     Returns:
-        point_id - id of initial point,
-        nbr_x - x tile coord of a neigbour
-        nbr_y - y tile coord of a neigbour
-    """
-    # neighbours in given distance
-    point_id = np.array([])
-    nbr_x = np.array([])
-    nbr_y = np.array([])
-
-    near_x = coords[:, 3] + 1 * shifts_x
-    near_y = coords[:, 4] + 1 * shifts_y
-    point_id = np.concatenate([point_id, coords[:, 0]])
-    nbr_x = np.concatenate([nbr_x, near_x])
-    nbr_y = np.concatenate([nbr_y, near_y])
-
-    # to prevent duplication remove [0,0]
-    filt = (shifts_x == 0) & (shifts_y == 0)
-    shifts_x = shifts_x[~filt]
-    shifts_y = shifts_y[~filt]
-    coords = coords[~filt]
-
-    near_x = coords[:, 3] + -1 * shifts_x
-    near_y = coords[:, 4] + -1 * shifts_y
-    point_id = np.concatenate([point_id, coords[:, 0]])
-    nbr_x = np.concatenate([nbr_x, near_x])
-    nbr_y = np.concatenate([nbr_y, near_y])
-
-    # to prevent duplication remove [0,*] and [*,0]
-    filt = (shifts_x == 0) | (shifts_y == 0)
-    shifts_x = shifts_x[~filt]
-    shifts_y = shifts_y[~filt]
-    coords = coords[~filt]
-
-    near_x = coords[:, 3] + -1 * shifts_x
-    near_y = coords[:, 4] + 1 * shifts_y
-    point_id = np.concatenate([point_id, coords[:, 0]])
-    nbr_x = np.concatenate([nbr_x, near_x])
-    nbr_y = np.concatenate([nbr_y, near_y])
-
-    near_x = coords[:, 3] + 1 * shifts_x
-    near_y = coords[:, 4] + -1 * shifts_y
-    point_id = np.concatenate([point_id, coords[:, 0]])
-    nbr_x = np.concatenate([nbr_x, near_x])
-    nbr_y = np.concatenate([nbr_y, near_y])
-
-    return point_id, nbr_x, nbr_y
+        loc - position of the tile in the input arrays
+        key_lo, key_hi - first and last key of the range (inclusive)
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    loc = np.arange(idx_x.shape[0])
+    width = min(2 * outer + 1, n_tiles)
+    inner_width = min(2 * inner + 1, n_tiles)
+
+    # (first row shift, number of rows, first column, number of columns)
+    runs = []
+    start_x = idx_x - outer if width < n_tiles else np.zeros_like(idx_x)
+    runs.append((-outer, outer - inner, start_x, width))
+    # without inner block the row of the tile is the last row of the upper run
+    bottom = max(inner + 1, 1)
+    runs.append((bottom, outer - bottom + 1, start_x, width))
+    if inner >= 0 and inner_width < n_tiles:
+        if width < n_tiles:
+            runs.append((-inner, inner_width, idx_x - outer, outer - inner))
+            runs.append((-inner, inner_width, idx_x + inner + 1, outer - inner))
+        else:
+            runs.append((-inner, inner_width, idx_x + inner + 1, n_tiles - inner_width))
+
+    parts_loc = []
+    parts_lo = []
+    parts_hi = []
+    for shift_y, n_rows, first_x, n_columns in runs:
+        row = idx_y[:, None] + np.arange(shift_y, shift_y + n_rows)
+        valid = (row >= 0) & (row < n_tiles)
+        run_loc = np.broadcast_to(loc[:, None], row.shape)[valid]
+        row_start = row[valid] * n_tiles
+
+        # run crossing the antimeridian is split in two
+        lo_x = np.broadcast_to((first_x % n_tiles)[:, None], row.shape)[valid]
+        hi_x = lo_x + n_columns - 1
+        wraps = hi_x >= n_tiles
+        parts_loc += [run_loc, run_loc[wraps]]
+        parts_lo += [row_start + lo_x, row_start[wraps]]
+        parts_hi += [
+            row_start + np.minimum(hi_x, n_tiles - 1),
+            row_start[wraps] + hi_x[wraps] - n_tiles,
+        ]
+
+    return np.concatenate(parts_loc), np.concatenate(parts_lo), np.concatenate(parts_hi)
+
+
+def _explored_bound(
+    lat_deg: np.ndarray,
+    lon_deg: np.ndarray,
+    idx_x: np.ndarray,
+    idx_y: np.ndarray,
+    size: int,
+    zoom: int,
+) -> np.ndarray:
+    """Return lower bound of distance from locations to unexplored tiles.
+
+    Unexplored tiles are outside of the block of tiles [x - size, x + size],
+    [y - size, y + size]: beyond its northern or southern parallel or beyond
+    one of its meridians. Sides at the map edge (or wrapping the whole
+    globe) have no tiles beyond them.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    earth_radius = 6371000
+    n_tiles = int(np_tiles_converter.zoom_power(zoom))
+    lat_rad = np.radians(lat_deg)
+    bound = np.full(lat_deg.shape[0], np.inf)
+
+    # parallels: distance along the meridian
+    north = idx_y - size
+    south = idx_y + size + 1
+    edge_lat, _ = np_tiles_converter.np_idx2deg(
+        np.concatenate([idx_x, idx_x]),
+        np.clip(np.concatenate([north, south]), 0, n_tiles),
+        zoom,
+        offset=0,
+    )
+    edge_rad = np.radians(edge_lat)
+    north_lat, south_lat = edge_rad[: idx_x.shape[0]], edge_rad[idx_x.shape[0] :]
+    bound = np.where(
+        north > 0, np.minimum(bound, (north_lat - lat_rad) * earth_radius), bound
+    )
+    bound = np.where(
+        south < n_tiles, np.minimum(bound, (lat_rad - south_lat) * earth_radius), bound
+    )
+
+    # meridians: distance to a half great circle, the nearest pole if it is behind
+    if 2 * size + 1 < n_tiles:
+        west_lon = (idx_x - size) / n_tiles * 360.0 - 180.0
+        east_lon = (idx_x + size + 1) / n_tiles * 360.0 - 180.0
+        to_pole = np.pi / 2 - np.abs(lat_rad)
+        for delta_deg in [lon_deg - west_lon, east_lon - lon_deg]:
+            delta_deg = np.abs(delta_deg)
+            delta_rad = np.radians(np.minimum(delta_deg, 360 - delta_deg))
+            to_meridian = np.arcsin(
+                np.minimum(
+                    np.cos(lat_rad) * np.sin(np.minimum(delta_rad, np.pi / 2)), 1
+                )
+            )
+            dist = np.where(delta_rad <= np.pi / 2, to_meridian, to_pole)
+            bound = np.minimum(bound, dist * earth_radius)
+
+    return bound
+
+
+def _merge_best(
+    best_dist: np.ndarray,
+    best_poi: np.ndarray,
+    active: np.ndarray,
+    cand_loc: np.ndarray,
+    cand_poi: np.ndarray,
+    cand_dist: np.ndarray,
+) -> None:
+    """Merge candidates into k best POIs of active locations (in place)."""
+    # pylint: disable=too-many-arguments
+    k = best_dist.shape[1]
+    loc = np.concatenate([np.repeat(active, k), cand_loc])
+    poi = np.concatenate([best_poi[active].ravel(), cand_poi])
+    dist = np.concatenate([best_dist[active].ravel(), cand_dist])
+
+    # order by location, distance and POI, then keep first k of each location
+    order = np.lexsort((poi, dist, loc))
+    loc, poi, dist = loc[order], poi[order], dist[order]
+    group_start = np.flatnonzero(np.diff(loc, prepend=-1))
+    group_size = np.diff(np.append(group_start, loc.shape[0]))
+    rank = np.arange(loc.shape[0]) - np.repeat(group_start, group_size)
+    keep = rank < k
+
+    best_dist[loc[keep], rank[keep]] = dist[keep]
+    best_poi[loc[keep], rank[keep]] = poi[keep]
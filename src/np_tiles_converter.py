@@ -1,8 +1,31 @@
 """Methods for converting point gps coordinates to tile coordinates."""
-from typing import Dict, Tuple, Union
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple, Union
 
 import numpy as np
 
+# Row tables of recently used zoom levels are cached up to this size in bytes,
+# zoom levels with larger tables are always computed directly. A table takes
+# 24 bytes per row, so with 128 MiB tables of all zoom levels up to 22 fit.
+ROW_TABLE_MAX_BYTES = 128 * 2**20
+
+
+class RowTable(NamedTuple):
+    """Values which depend only on the tile row (ytile) at one zoom level.
+
+    edge_lat - latitude of the top edge of every row, last value is
+        the bottom edge of the last row, shape = [n_rows + 1]
+    center_lat - latitude of the row center
+    cos_lat - cosine of the center latitude
+    """
+
+    edge_lat: np.ndarray
+    center_lat: np.ndarray
+    cos_lat: np.ndarray
+
+
+_ROW_TABLES: "OrderedDict[int, RowTable]" = OrderedDict()
+
 
 def _check_if_float(val: Union[np.ndarray, float]) -> bool:
     """Check if value is array or float.
@@ -58,6 +81,28 @@ def np_deg2idx(
     Sources:
         -- https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
     """
+    xtile, ytile = np_deg2frac(lat_deg, lon_deg, zoom)
+
+    ## x_tile/y_tile are rounded down 255.99 -> 255
+    xtile = np.floor(xtile).astype(np.int32)
+    ytile = np.floor(ytile).astype(np.int32)
+
+    return (xtile, ytile)
+
+
+def np_deg2frac(
+    lat_deg: Union[np.ndarray, float], lon_deg: Union[np.ndarray, float], zoom: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert degrees of longitude and latitude to fractional x,y tile coordinates.
+
+    Same as 'np_deg2idx' but without rounding down: integer part is the tile
+    index and fractional part is the position inside the tile,
+    e.g. 255.5 is the center of the tile 255.
+
+    Returns:
+        xtile - numpy array of floats, tile x coordinate
+        ytile - numpy array of floats, tile y coordinate
+    """
     if isinstance(lat_deg, float) or _check_if_float(lat_deg):
         lat_deg = np.array([lat_deg])
 
@@ -78,14 +123,10 @@ def np_deg2idx(
     lat_rad = np.radians(lat_deg)
     zoom_mult = zoom_power(zoom)
 
-    ## x_tile/y_tile are rounded down 255.99 -> 255
-    xtile = np.floor((lon_rad + np.pi) / (2 * np.pi) * zoom_mult)
+    xtile = (lon_rad + np.pi) / (2 * np.pi) * zoom_mult
 
     interm = lat_rad / 2 + np.pi / 4
-    ytile = np.floor((np.pi - np.log(np.tan(interm))) / (2 * np.pi) * zoom_mult)
-
-    xtile = xtile.astype(np.int32)
-    ytile = ytile.astype(np.int32)
+    ytile = (np.pi - np.log(np.tan(interm))) / (2 * np.pi) * zoom_mult
 
     return (xtile, ytile)
 
@@ -120,6 +161,11 @@ def np_idx2deg(
     offset = np.clip(offset, 0, 1)
     zoom_mult = zoom_power(zoom)
 
+    # integer rows are looked up in the row table for common offsets
+    table = None
+    if offset in (0, 0.5, 1) and np.issubdtype(ytile.dtype, np.integer):
+        table = _row_table_for(zoom, ytile.shape[0])
+
     # cliping any wrong values
     xtile = np.clip(xtile, 0, zoom_mult - 1)
     ytile = np.clip(ytile, 0, zoom_mult - 1)
@@ -130,12 +176,74 @@ def np_idx2deg(
     lon_deg = lon_rad / np.pi * 180
 
     # converting ytile coordinates
-    interm = np.pi - (ytile + offset) * (2 * np.pi) / zoom_mult
+    if table is None:
+        lat_deg = _row_lat(ytile + offset, zoom_mult)
+    elif offset == 0.5:
+        lat_deg = table.center_lat[np.asarray(ytile, dtype=np.int64)]
+    else:
+        lat_deg = table.edge_lat[np.asarray(ytile, dtype=np.int64) + int(offset)]
+
+    return (lat_deg, lon_deg)
+
+
+def _row_lat(ytile: np.ndarray, zoom_mult: float) -> np.ndarray:
+    """Convert fractional tile y coordinate to degrees of latitude."""
+    interm = np.pi - ytile * (2 * np.pi) / zoom_mult
     interm = np.arctan(np.exp(interm))
     lat_rad = 2 * (interm - np.pi / 4)
-    lat_deg = lat_rad / np.pi * 180
+    lat_deg: np.ndarray = lat_rad / np.pi * 180
+    return lat_deg
 
-    return (lat_deg, lon_deg)
+
+def _row_table_for(zoom: int, n_values: int) -> Optional[RowTable]:
+    """Return row table to look up 'n_values' rows, None to compute them directly.
+
+    Building the table costs about as much as computing one value per row,
+    so small inputs use the table only if it is already cached.
+    """
+    if zoom in _ROW_TABLES or n_values >= zoom_power(zoom):
+        return row_table(zoom)
+    return None
+
+
+def row_table(zoom: int) -> Optional[RowTable]:
+    """Return table of latitudes of every tile row at zoom level.
+
+    Tables are built on the first use and cached (LRU) while their total size
+    is below ROW_TABLE_MAX_BYTES. Values are the same as computed by 'np_idx2deg'
+    and 'np_haversin' for tile centers, so lookups give identical results.
+
+    Returns:
+        RowTable with read-only arrays, None if the table of this zoom
+        does not fit into ROW_TABLE_MAX_BYTES
+    """
+    if zoom in _ROW_TABLES:
+        _ROW_TABLES.move_to_end(zoom)
+        return _ROW_TABLES[zoom]
+
+    zoom_mult = zoom_power(zoom)
+    n_rows = int(zoom_mult)
+    if 8 * (3 * n_rows + 1) > ROW_TABLE_MAX_BYTES:
+        return None
+
+    rows = np.arange(n_rows + 1, dtype=np.float64)
+    edge_lat = _row_lat(rows + 0, zoom_mult)
+    center_lat = _row_lat(rows[:-1] + 0.5, zoom_mult)
+    table = RowTable(
+        edge_lat=edge_lat,
+        center_lat=center_lat,
+        cos_lat=np.cos(np.radians(center_lat)),
+    )
+    for arr in table:
+        arr.setflags(write=False)
+
+    _ROW_TABLES[zoom] = table
+    while sum(arr.nbytes for tab in _ROW_TABLES.values() for arr in tab) > (
+        ROW_TABLE_MAX_BYTES
+    ):
+        _ROW_TABLES.popitem(last=False)
+
+    return table
 
 
 def np_haversin(
@@ -157,16 +265,74 @@ def np_haversin(
     Sources:
     -- https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
     """
-    earth_radius = 6371000
-    lon_rad1 = np.radians(lon_deg1)
     lat_rad1 = np.radians(lat_deg1)
-    lon_rad2 = np.radians(lon_deg2)
     lat_rad2 = np.radians(lat_deg2)
 
+    return _haversin(
+        lat_rad1,
+        np.radians(lon_deg1),
+        lat_rad2,
+        np.radians(lon_deg2),
+        np.cos(lat_rad1),
+        np.cos(lat_rad2),
+    )
+
+
+def np_tile_haversin(
+    xtile1: np.ndarray,
+    ytile1: np.ndarray,
+    xtile2: np.ndarray,
+    ytile2: np.ndarray,
+    zoom: int,
+) -> np.ndarray:
+    """Compute haversine distance between centers of two tiles.
+
+    Same as 'np_haversin' of tile centers from 'np_idx2deg', but for large
+    inputs latitudes and their cosines are taken from the row table
+    (see 'row_table'), so only the longitude difference needs trigonometry.
+
+    Returns distance in meters
+    """
+    table = _row_table_for(zoom, 2 * np.shape(ytile1)[0])
+    if table is None:
+        lat_deg1, lon_deg1 = np_idx2deg(xtile1, ytile1, zoom=zoom)
+        lat_deg2, lon_deg2 = np_idx2deg(xtile2, ytile2, zoom=zoom)
+        return np_haversin(lat_deg1, lon_deg1, lat_deg2, lon_deg2)
+
+    # same clipping and longitude of tile center as in np_idx2deg
+    zoom_mult = float(table.center_lat.shape[0])
+    max_idx = table.center_lat.shape[0] - 1
+    ytile1 = np.clip(ytile1, 0, max_idx)
+    ytile2 = np.clip(ytile2, 0, max_idx)
+    lon_rad1 = (np.clip(xtile1, 0, max_idx) + 0.5) * (2 * np.pi) / zoom_mult - np.pi
+    lon_rad2 = (np.clip(xtile2, 0, max_idx) + 0.5) * (2 * np.pi) / zoom_mult - np.pi
+
+    return _haversin(
+        np.radians(table.center_lat[ytile1]),
+        lon_rad1,
+        np.radians(table.center_lat[ytile2]),
+        lon_rad2,
+        table.cos_lat[ytile1],
+        table.cos_lat[ytile2],
+    )
+
+
+def _haversin(
+    lat_rad1: np.ndarray,
+    lon_rad1: np.ndarray,
+    lat_rad2: np.ndarray,
+    lon_rad2: np.ndarray,
+    cos_lat1: np.ndarray,
+    cos_lat2: np.ndarray,
+) -> np.ndarray:
+    """Haversine distance in meters between points given in radians."""
+    # pylint: disable=too-many-arguments
+    earth_radius = 6371000
+
     sin_rad = np.sin((lat_rad2 - lat_rad1) / 2)
     sin_lon = np.sin((lon_rad2 - lon_rad1) / 2)
 
-    interm = sin_rad * sin_rad + np.cos(lat_rad2) * np.cos(lat_rad1) * sin_lon * sin_lon
+    interm = sin_rad * sin_rad + cos_lat2 * cos_lat1 * sin_lon * sin_lon
 
     dist = 2 * np.arcsin(np.power(interm, 0.5))
     dist_meters: np.ndarray = np.round(dist * earth_radius, 1)
@@ -181,27 +347,23 @@ def tile_size_meters(
 
     This is a proxy, because tile size will be different in different parts of the world.
     """
-    # pylint: disable=too-many-locals
     zoom_mult = zoom_power(zoom)
 
     if lat is not None and lon is not None:
         idx_x_arr, idx_y_arr = np_deg2idx(lat, lon, zoom=zoom)
-        idx_x, idx_y = idx_x_arr[0], idx_y_arr[0]
+        idx_x, idx_y = int(idx_x_arr[0]), int(idx_y_arr[0])
     else:
-        idx_x = zoom_mult // 2
-        idx_y = zoom_mult // 2
-
-    arr_xtile = np.array([idx_x, idx_x + 1, idx_x, idx_x + 1])
-    arr_ytile = np.array([idx_y, idx_y, idx_y + 1, idx_y + 1])
-
-    lat_deg, lon_deg = np_idx2deg(arr_xtile, arr_ytile, zoom=zoom)
-
-    lon1 = np.array([lon_deg[0], lon_deg[0], lon_deg[0]])
-    lat1 = np.array([lat_deg[0], lat_deg[0], lat_deg[0]])
-    lon2 = np.array([lon_deg[1], lon_deg[2], lon_deg[3]])
-    lat2 = np.array([lat_deg[1], lat_deg[2], lat_deg[3]])
-
-    dist_meters = np_haversin(lat1, lon1, lat2, lon2)
+        idx_x = int(zoom_mult // 2)
+        idx_y = int(zoom_mult // 2)
+
+    # from the tile to its right, bottom and diagonal neighbours
+    dist_meters = np_tile_haversin(
+        np.full(3, idx_x),
+        np.full(3, idx_y),
+        np.array([idx_x + 1, idx_x, idx_x + 1]),
+        np.array([idx_y, idx_y + 1, idx_y + 1]),
+        zoom,
+    )
 
     dist = {
         "zoom": zoom,
@@ -1,6 +1,9 @@
-"""Methods for extracting data from Openstreetmap."""
-import geopandas as gpd
-import osmnx as ox
+"""Methods for extracting data from Openstreetmap.
+
+osmnx is imported only when the data is downloaded.
+"""
+import numpy as np
+import pandas as pd
 
 
 def get_london_pubs():
@@ -8,6 +11,9 @@ def get_london_pubs():
 
     You will need internet connection to run this function.
     """
+    # pylint: disable=import-outside-toplevel
+    import osmnx as ox
+
     # Get place boundary related to the place name as a geodataframe
     tags = {"amenity": "pub"}
 
@@ -17,7 +23,7 @@ def get_london_pubs():
 
     x_arr = []
     y_arr = []
-    for i, row in pubs.iterrows():
+    for _, row in pubs.iterrows():
         if hasattr(row.geometry, "x"):
             # if node
             x = row.geometry.x
@@ -0,0 +1,262 @@
+"""Tile large Parquet files of coordinates row group by row group.
+
+Reading, tiling and writing run in three threads connected with bounded
+queues. Parquet decoding, numpy math and file writing release the GIL,
+so the stages overlap and throughput is limited by the disk. At most
+'queue_size' row groups wait in each queue, memory is limited by the size
+of the row group.
+
+Output is a hive-partitioned dataset: rows are split by their parent tile
+at 'partition_zoom' into directories "partition_x=<x>/partition_y=<y>",
+which can be read back with 'pyarrow.dataset' or 'pandas.read_parquet'.
+
+Usage:
+    tile-parquet input.parquet output_dir --zooms 17 19 --partition-zoom 8
+"""
+import argparse
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Sequence
+
+import numpy as np
+
+from src import np_tiles_converter
+
+# Marks the end of the stream in queues between stages
+_END = None
+
+
+def tile_parquet(
+    input_path: str,
+    output_dir: str,
+    zooms: Sequence[int],
+    partition_zoom: int = 8,
+    lat_col: str = "lat",
+    lon_col: str = "lon",
+    queue_size: int = 4,
+    max_open_files: int = 256,
+) -> int:
+    """Add tile coordinates to every row of Parquet file.
+
+    For each zoom in 'zooms' columns "tile_idx_x_<zoom>" and "tile_idx_y_<zoom>"
+    (int32) are added to the input columns. Rows with missing coordinates are
+    dropped.
+
+    Arguments:
+        input_path - path to the input Parquet file
+        output_dir - directory of the output dataset
+        zooms - zoom levels of the tiles
+        partition_zoom - integer, zoom level of the partitioning tiles,
+            low zoom gives a few large files, high zoom - many small ones
+        lat_col - column with latitude
+        lon_col - column with longitude
+        queue_size - integer, number of row groups buffered between stages
+        max_open_files - integer, maximal number of partition files open
+            at once, the least recently used file is closed when the limit
+            is reached and a new file is started for its partition
+
+    Returns:
+        number of written rows
+    """
+    # pylint: disable=too-many-arguments,too-many-locals,import-outside-toplevel
+    import pyarrow.parquet as pq
+
+    assert len(zooms) > 0
+    parquet_file = pq.ParquetFile(input_path)
+    read_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    write_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    errors: List[BaseException] = []
+
+    def read() -> None:
+        for group in range(parquet_file.num_row_groups):
+            read_queue.put(parquet_file.read_row_group(group))
+
+    def transform() -> None:
+        while (table := read_queue.get()) is not _END:
+            write_queue.put(_tile_table(table, zooms, partition_zoom, lat_col, lon_col))
+
+    threads = [
+        _start_stage(read, read_queue, errors),
+        _start_stage(transform, write_queue, errors, read_queue),
+    ]
+
+    n_rows = 0
+    os.makedirs(output_dir, exist_ok=True)
+    writers = _PartitionWriters(output_dir, max_open_files)
+    finished = False
+    try:
+        while (parts := write_queue.get()) is not _END:
+            for partition, part in parts:
+                writers.write(partition, part)
+                n_rows += part.num_rows
+        finished = True
+    finally:
+        writers.close()
+        if not finished:
+            _drain(write_queue)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return n_rows
+
+
+def _start_stage(
+    target: Callable[[], None],
+    out_queue: queue.Queue,
+    errors: List[BaseException],
+    in_queue: Optional[queue.Queue] = None,
+) -> threading.Thread:
+    """Run pipeline stage in a thread, end of the stream is always sent.
+
+    On error the exception is saved and the input queue is drained,
+    so the previous stage is not blocked on the full queue.
+    """
+
+    def run() -> None:
+        try:
+            target()
+        except BaseException as error:  # pylint: disable=broad-exception-caught
+            errors.append(error)
+            if in_queue is not None:
+                _drain(in_queue)
+        finally:
+            out_queue.put(_END)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def _drain(in_queue: queue.Queue) -> None:
+    """Read queue until the end of the stream."""
+    while in_queue.get() is not _END:
+        pass
+
+
+def _tile_table(
+    table: Any, zooms: Sequence[int], partition_zoom: int, lat_col: str, lon_col: str
+) -> List[Any]:
+    """Add tile columns to pyarrow Table and split it by partitions.
+
+    Returns:
+        list of ((partition_x, partition_y), pyarrow Table)
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    lat = table.column(lat_col).to_numpy(zero_copy_only=False).astype(np.float64)
+    lon = table.column(lon_col).to_numpy(zero_copy_only=False).astype(np.float64)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    if not valid.all():
+        table = table.filter(valid)
+        lat = lat[valid]
+        lon = lon[valid]
+    if table.num_rows == 0:
+        return []
+
+    for zoom in zooms:
+        xtile, ytile = np_tiles_converter.np_deg2idx(lat, lon, zoom)
+        table = table.append_column(f"tile_idx_x_{zoom}", [xtile])
+        table = table.append_column(f"tile_idx_y_{zoom}", [ytile])
+
+    # rows of the same partition are taken together
+    part_x, part_y = np_tiles_converter.np_deg2idx(lat, lon, partition_zoom)
+    part_key = part_x.astype(np.int64) << 32 | part_y.astype(np.int64)
+    order = np.argsort(part_key, kind="stable")
+    part_key = part_key[order]
+    table = table.take(order)
+
+    starts = np.flatnonzero(np.diff(part_key, prepend=-1))
+    ends = np.append(starts[1:], part_key.shape[0])
+    return [
+        (
+            (int(part_key[start] >> 32), int(part_key[start] & 0xFFFFFFFF)),
+            table.slice(start, end - start),
+        )
+        for start, end in zip(starts, ends)
+    ]
+
+
+class _PartitionWriters:
+    """Open Parquet writers of partitions, least recently used are closed."""
+
+    def __init__(self, output_dir: str, max_open_files: int):
+        assert max_open_files >= 1
+        self.output_dir = output_dir
+        self.max_open_files = max_open_files
+        self.writers: OrderedDict = OrderedDict()
+        self.n_files: dict = {}
+
+    def write(self, partition: Any, table: Any) -> None:
+        """Append table to the file of the partition."""
+        # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq
+
+        if partition in self.writers:
+            self.writers.move_to_end(partition)
+        else:
+            if len(self.writers) >= self.max_open_files:
+                _, oldest = self.writers.popitem(last=False)
+                oldest.close()
+
+            part_dir = os.path.join(
+                self.output_dir,
+                f"partition_x={partition[0]}",
+                f"partition_y={partition[1]}",
+            )
+            os.makedirs(part_dir, exist_ok=True)
+            file_idx = self.n_files.get(partition, 0)
+            self.n_files[partition] = file_idx + 1
+            self.writers[partition] = pq.ParquetWriter(
+                os.path.join(part_dir, f"part-{file_idx}.parquet"), table.schema
+            )
+
+        self.writers[partition].write_table(table)
+
+    def close(self) -> None:
+        """Close all open files."""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Command line entry point, run with --help for arguments."""
+    parser = argparse.ArgumentParser(
+        description="Add tile coordinates to Parquet file of lat/lon points."
+    )
+    parser.add_argument("input_path", help="input Parquet file")
+    parser.add_argument("output_dir", help="directory of the partitioned output")
+    parser.add_argument(
+        "--zooms", type=int, nargs="+", default=[19], help="zoom levels of the tiles"
+    )
+    parser.add_argument(
+        "--partition-zoom", type=int, default=8, help="zoom of the partition tiles"
+    )
+    parser.add_argument("--lat-col", default="lat", help="column with latitude")
+    parser.add_argument("--lon-col", default="lon", help="column with longitude")
+    parser.add_argument(
+        "--queue-size", type=int, default=4, help="row groups buffered between stages"
+    )
+    parser.add_argument(
+        "--max-open-files", type=int, default=256, help="open partition files limit"
+    )
+    args = parser.parse_args(argv)
+
+    n_rows = tile_parquet(
+        args.input_path,
+        args.output_dir,
+        args.zooms,
+        partition_zoom=args.partition_zoom,
+        lat_col=args.lat_col,
+        lon_col=args.lon_col,
+        queue_size=args.queue_size,
+        max_open_files=args.max_open_files,
+    )
+    print(f"Written rows: {n_rows}")
+
+
+if __name__ == "__main__":
+    main()
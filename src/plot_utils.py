@@ -1,10 +1,13 @@
 """Helper function for plotting tiles."""
-from typing import Tuple
+from typing import List, Tuple
 
 import numpy as np
 
 from src import np_tiles_converter
 
+# Bits of y in the packed tile corner, leaves two bits for the edge direction
+_VERTEX_BITS = 30
+
 
 def get_tile_center_coords(
     tile_x_idx: int, tile_y_idx: int, zoom: int
@@ -54,3 +57,147 @@ def get_tile_box_coords(x_idx_tile: int, y_idx_tile: int, zoom: int) -> np.ndarr
     )
 
     return tile_box_coord
+
+
+def get_tile_boxes_coords(
+    x_idx_tile: np.ndarray, y_idx_tile: np.ndarray, zoom: int
+) -> np.ndarray:
+    """Return coordinates of the boxes of many tiles.
+
+    Vectorized version of 'get_tile_box_coords', all corners are computed
+    with a single 'np_idx2deg' call.
+
+    Arguments:
+        x_idx_tile - array of integers
+        y_idx_tile - array of integers
+
+    Returns:
+        tile_coord: array of floats, shape = [N,5,2], 5 points (lat, lon) per tile
+    """
+    x_tile = np.asarray(x_idx_tile, dtype=np.int64).ravel()
+    y_tile = np.asarray(y_idx_tile, dtype=np.int64).ravel()
+    n_tiles = x_tile.shape[0]
+
+    # top-left and bottom-right corners, other corners share their lat/lon
+    corner_lat, corner_lon = np_tiles_converter.np_idx2deg(
+        np.concatenate([x_tile, x_tile + 1]),
+        np.concatenate([y_tile, y_tile + 1]),
+        zoom=zoom,
+        offset=0,
+    )
+    lat_top, lat_bottom = corner_lat[:n_tiles], corner_lat[n_tiles:]
+    lon_left, lon_right = corner_lon[:n_tiles], corner_lon[n_tiles:]
+
+    tile_coord = np.empty((n_tiles, 5, 2), dtype=np.float64)
+    tile_coord[:, :, 0] = np.stack(
+        [lat_top, lat_bottom, lat_bottom, lat_top, lat_top], axis=1
+    )
+    tile_coord[:, :, 1] = np.stack(
+        [lon_left, lon_left, lon_right, lon_right, lon_left], axis=1
+    )
+    return tile_coord
+
+
+def decimate_tiles(
+    x_idx_tile: np.ndarray, y_idx_tile: np.ndarray, zoom: int, max_tiles: int
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Replace tiles with their parents until there are at most 'max_tiles'.
+
+    Arguments:
+        x_idx_tile - array of integers
+        y_idx_tile - array of integers
+        zoom - zoom level of the tiles
+        max_tiles - integer, budget of the unique tiles
+
+    Returns:
+        x_idx_tile, y_idx_tile - unique tiles at the returned zoom
+        zoom - zoom level of the returned tiles, never below 0
+    """
+    assert max_tiles >= 1
+    tile_key = np.unique(
+        np.asarray(x_idx_tile, dtype=np.int64) << 32
+        | np.asarray(y_idx_tile, dtype=np.int64)
+    )
+    while tile_key.shape[0] > max_tiles and zoom > 0:
+        tile_key = np.unique(tile_key >> 33 << 32 | (tile_key & 0xFFFFFFFF) >> 1)
+        zoom -= 1
+    return tile_key >> 32, tile_key & 0xFFFFFFFF, zoom
+
+
+def get_tiles_outlines(
+    x_idx_tile: np.ndarray, y_idx_tile: np.ndarray, zoom: int
+) -> List[np.ndarray]:
+    """Return outlines of the areas covered by tiles.
+
+    Edges shared by two adjacent tiles cancel out, the remaining boundary
+    edges are chained into closed rings and vertices in the middle
+    of straight sides are dropped. Holes in the covered area become
+    separate rings.
+
+    Arguments:
+        x_idx_tile - array of integers
+        y_idx_tile - array of integers
+
+    Returns:
+        list of arrays of floats, shape = [M,2], closed rings of (lat, lon) points
+    """
+    # pylint: disable=too-many-locals
+    tile_key = np.unique(
+        np.asarray(x_idx_tile, dtype=np.int64) << 32
+        | np.asarray(y_idx_tile, dtype=np.int64)
+    )
+    x_tile, y_tile = tile_key >> 32, tile_key & 0xFFFFFFFF
+
+    # directed edges of every tile (down, right, up, left), all tiles are
+    # traversed in the same direction, so an edge shared with a neighbour
+    # appears in both directions
+    corners_x = np.stack([x_tile, x_tile, x_tile + 1, x_tile + 1], axis=1)
+    corners_y = np.stack([y_tile, y_tile + 1, y_tile + 1, y_tile], axis=1)
+    start = (corners_x << _VERTEX_BITS | corners_y).ravel()
+    end = np.roll(corners_x << _VERTEX_BITS | corners_y, -1, axis=1).ravel()
+    direction = np.tile(np.arange(4, dtype=np.int64), x_tile.shape[0])
+
+    # opposite direction is direction ^ 2
+    boundary = ~np.isin(start << 2 | direction, end << 2 | direction ^ 2)
+    start, end = start[boundary], end[boundary]
+    if start.shape[0] == 0:
+        return []
+
+    # every boundary vertex has as many incoming edges as outgoing ones,
+    # pairing them by rank gives a permutation of edges made of closed rings
+    next_edge = np.empty(start.shape[0], dtype=np.int64)
+    next_edge[np.argsort(end, kind="stable")] = np.argsort(start, kind="stable")
+
+    rings = []
+    visited = np.zeros(start.shape[0], dtype=bool)
+    next_list = next_edge.tolist()
+    for first in range(start.shape[0]):
+        if visited[first]:
+            continue
+        ring = [first]
+        edge = next_list[first]
+        while edge != first:
+            ring.append(edge)
+            edge = next_list[edge]
+        visited[ring] = True
+        rings.append(_ring_coords(start[ring], zoom))
+
+    return rings
+
+
+def _ring_coords(vertex_key: np.ndarray, zoom: int) -> np.ndarray:
+    """Convert ring of packed tile corners to closed ring of (lat, lon) points."""
+    vert_x = vertex_key >> _VERTEX_BITS
+    vert_y = vertex_key & (1 << _VERTEX_BITS) - 1
+
+    # keep only corners where the direction of the ring changes
+    prev_x, prev_y = np.roll(vert_x, 1), np.roll(vert_y, 1)
+    next_x, next_y = np.roll(vert_x, -1), np.roll(vert_y, -1)
+    turn = (vert_x - prev_x) * (next_y - vert_y) != (vert_y - prev_y) * (
+        next_x - vert_x
+    )
+    vert_x = np.append(vert_x[turn], vert_x[turn][:1])
+    vert_y = np.append(vert_y[turn], vert_y[turn][:1])
+
+    lat_deg, lon_deg = np_tiles_converter.np_idx2deg(vert_x, vert_y, zoom, offset=0)
+    return np.stack([lat_deg, lon_deg], axis=1)
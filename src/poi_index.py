@@ -0,0 +1,391 @@
+"""Persistent POI index: POIs sorted by tile key in memory-mapped arrays.
+
+Index is a directory of segments. Every segment stores POIs sorted by
+their tile key ('tile_keys', Z-order) as flat .npy arrays, which are opened
+with 'np.load(mmap_mode="r")': opening is instant and processes opening
+the same index share its pages through the page cache. Queries are binary
+searches of key ranges, descendants of a tile form one continuous range.
+
+New POIs are appended as new small segments (append log), 'compact'
+merges all segments into one. List of segments is stored in "meta.json",
+which is replaced atomically, so readers always see a consistent index.
+Pass the path, not the opened index, to worker processes and open it there.
+
+Example:
+    poi_index.build_index(df_pubs, "pubs_index", zoom=17)
+    index = poi_index.open_index("pubs_index")
+    df_near = poi_index.query_radius(index, df_coords.lat, df_coords.lon, 500)
+"""
+import json
+import os
+import shutil
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from src import np_tiles_converter, tile_keys
+
+META_FILE = "meta.json"
+SEGMENT_COLUMNS = ("keys", "lat", "lon", "poi_id")
+
+# Appending more segments triggers compaction
+MAX_SEGMENTS = 8
+
+# Bounding box is covered with at most this number of tiles (key ranges)
+MAX_BBOX_TILES = 16
+
+EARTH_CIRCUMFERENCE = 2 * np.pi * 6371000
+
+
+class Segment(NamedTuple):
+    """Sorted POI arrays of one segment, memory-mapped when opened from disk.
+
+    keys - int64 tile keys of the POIs at zoom of the index, sorted
+    lat, lon - float64 POI coordinates in degrees
+    poi_id - int64 POI ids
+    """
+
+    keys: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    poi_id: np.ndarray
+
+
+class PoiIndex(NamedTuple):
+    """Opened POI index.
+
+    path - directory of the index
+    zoom - zoom level of the POI tile keys
+    segments - list of Segment
+    """
+
+    path: str
+    zoom: int
+    segments: List[Segment]
+
+
+def build_index(
+    df_pois: pd.DataFrame, path: str, zoom: int = 17, id_col: Optional[str] = None
+) -> PoiIndex:
+    """Create new index in an empty or missing directory.
+
+    Arguments:
+        df_pois - have columns "lat" and "lon" with POI coordinates in degrees
+        path - directory of the index
+        zoom - integer, zoom level of the tiles, higher zoom makes small
+            radius queries more selective
+        id_col - column with integer POI ids, index of 'df_pois' by default
+
+    Returns:
+        opened index
+    """
+    assert 1 <= zoom <= tile_keys.MAX_KEY_ZOOM
+    os.makedirs(path, exist_ok=True)
+    assert not os.listdir(path), f"Directory {path} is not empty"
+
+    name = _write_segment(path, 0, _sorted_segment(df_pois, zoom, id_col))
+    _write_meta(path, {"zoom": zoom, "segments": [name], "next_segment": 1})
+    return open_index(path)
+
+
+def open_index(path: str) -> PoiIndex:
+    """Open index, arrays are memory-mapped read-only."""
+    meta = _read_meta(path)
+    segments = [
+        Segment(
+            *[
+                np.load(os.path.join(path, name, f"{col}.npy"), mmap_mode="r")
+                for col in SEGMENT_COLUMNS
+            ]
+        )
+        for name in meta["segments"]
+    ]
+    return PoiIndex(path, meta["zoom"], segments)
+
+
+def append_pois(
+    path: str,
+    df_pois: pd.DataFrame,
+    id_col: Optional[str] = None,
+    max_segments: int = MAX_SEGMENTS,
+) -> PoiIndex:
+    """Append POIs to the index as a new segment.
+
+    Arguments:
+        path - directory of the index
+        df_pois - have columns "lat" and "lon" with POI coordinates in degrees
+        id_col - column with integer POI ids, index of 'df_pois' by default
+        max_segments - index is compacted when it has more segments
+
+    Returns:
+        opened index with the new POIs
+    """
+    meta = _read_meta(path)
+    segment = _sorted_segment(df_pois, meta["zoom"], id_col)
+    meta["segments"].append(_write_segment(path, meta["next_segment"], segment))
+    meta["next_segment"] += 1
+    _write_meta(path, meta)
+
+    if len(meta["segments"]) > max_segments:
+        return compact(path)
+    return open_index(path)
+
+
+def compact(path: str) -> PoiIndex:
+    """Merge all segments of the index into one.
+
+    Files of the old segments are deleted: on POSIX systems indexes opened
+    before compaction stay readable until they are closed.
+
+    Returns:
+        opened compacted index
+    """
+    index = open_index(path)
+    if len(index.segments) <= 1:
+        return index
+
+    keys = np.concatenate([segment.keys for segment in index.segments])
+    order = np.argsort(keys, kind="stable")
+    merged = Segment(
+        *[
+            np.concatenate([segment[col] for segment in index.segments])[order]
+            for col in range(len(SEGMENT_COLUMNS))
+        ]
+    )
+
+    meta = _read_meta(path)
+    old_segments = meta["segments"]
+    meta["segments"] = [_write_segment(path, meta["next_segment"], merged)]
+    meta["next_segment"] += 1
+    _write_meta(path, meta)
+
+    for name in old_segments:
+        shutil.rmtree(os.path.join(path, name))
+    return open_index(path)
+
+
+def query_tiles(
+    index: PoiIndex,
+    xtile: Union[np.ndarray, int],
+    ytile: Union[np.ndarray, int],
+    zoom: Optional[int] = None,
+) -> pd.DataFrame:
+    """Return POIs inside the tiles.
+
+    Arguments:
+        index - opened index
+        xtile - integer or numpy array of integers, tile x coordinate
+        ytile - integer or numpy array of integers, tile y coordinate
+        zoom - integer, zoom level of the tiles, not higher than zoom
+            of the index, zoom of the index by default
+
+    Returns:
+        DataFrame with columns "query_id" (position of the tile in the
+        input arrays), "poi_id", "lat", "lon"
+    """
+    if zoom is None:
+        zoom = index.zoom
+    assert zoom <= index.zoom
+
+    lower, upper = tile_keys.descendant_range(
+        tile_keys.encode_tile_keys(xtile, ytile, zoom), index.zoom
+    )
+    return _query_ranges(index, lower, upper)
+
+
+def query_bbox(
+    index: PoiIndex, lat_min: float, lon_min: float, lat_max: float, lon_max: float
+) -> pd.DataFrame:
+    """Return POIs inside the bounding box.
+
+    Box is covered with at most MAX_BBOX_TILES tiles of the largest zoom
+    which allows it, POIs of the tiles are filtered by coordinates.
+
+    Returns:
+        DataFrame with columns "poi_id", "lat", "lon"
+    """
+    # pylint: disable=too-many-locals
+    assert lat_min <= lat_max
+    assert lon_min <= lon_max
+
+    corner_x, corner_y = np_tiles_converter.np_deg2idx(
+        np.array([lat_max, lat_min]), np.array([lon_min, lon_max]), index.zoom
+    )
+    x_min, x_max = int(corner_x[0]), int(corner_x[1])
+    y_min, y_max = int(corner_y[0]), int(corner_y[1])
+
+    levels = 0
+    while ((x_max >> levels) - (x_min >> levels) + 1) * (
+        (y_max >> levels) - (y_min >> levels) + 1
+    ) > MAX_BBOX_TILES:
+        levels += 1
+
+    grid_x, grid_y = np.meshgrid(
+        np.arange(x_min >> levels, (x_max >> levels) + 1),
+        np.arange(y_min >> levels, (y_max >> levels) + 1),
+    )
+    df_pois = query_tiles(
+        index, grid_x.ravel(), grid_y.ravel(), zoom=index.zoom - levels
+    )
+
+    lat = df_pois["lat"].values
+    lon = df_pois["lon"].values
+    filt = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+    return df_pois.loc[filt, ["poi_id", "lat", "lon"]].reset_index(drop=True)
+
+
+def query_radius(
+    index: PoiIndex,
+    lat_deg: Union[np.ndarray, float],
+    lon_deg: Union[np.ndarray, float],
+    radius: float,
+) -> pd.DataFrame:
+    """Return POIs within 'radius' meters from every location.
+
+    Each location is covered with 3 x 3 tiles of the largest zoom whose tiles
+    are at least 'radius' wide around the location, candidates from
+    these tiles are filtered by haversine distance.
+
+    Arguments:
+        index - opened index
+        lat_deg - float or numpy array of floats, latitude of the locations
+        lon_deg - float or numpy array of floats, longitude of the locations
+        radius - radius in meters
+
+    Returns:
+        DataFrame with columns "query_id" (position of the location in the
+        input arrays), "poi_id", "lat", "lon", "distance" sorted by "query_id"
+    """
+    # pylint: disable=too-many-locals
+    assert radius > 0
+    lat_deg = np.atleast_1d(np.asarray(lat_deg, dtype=np.float64))
+    lon_deg = np.atleast_1d(np.asarray(lon_deg, dtype=np.float64))
+    n_queries = lat_deg.shape[0]
+
+    # tile width shrinks towards the poles, take it at the farthest latitude
+    lat_edge = np.minimum(np.abs(lat_deg) + np.degrees(radius / 6371000), 89.9)
+    width_ratio = EARTH_CIRCUMFERENCE * np.cos(np.radians(lat_edge)) / radius
+    cover_zoom = np.clip(
+        np.floor(np.log2(np.maximum(width_ratio, 1))), 0, index.zoom
+    ).astype(np.int64)
+
+    xtile, ytile = np_tiles_converter.np_deg2idx(lat_deg, lon_deg, index.zoom)
+    xtile = xtile.astype(np.int64) >> (index.zoom - cover_zoom)
+    ytile = ytile.astype(np.int64) >> (index.zoom - cover_zoom)
+
+    # 3 x 3 tiles around the location, x wraps around the antimeridian
+    shift_x, shift_y = np.meshgrid(np.arange(-1, 2), np.arange(-1, 2))
+    n_tiles = (np.int64(1) << cover_zoom)[:, None]
+    nbr_x = (xtile[:, None] + shift_x.ravel()) % n_tiles
+    nbr_y = ytile[:, None] + shift_y.ravel()
+    valid = (nbr_y >= 0) & (nbr_y < n_tiles)
+    nbr_keys = np.full(nbr_x.shape, -1, dtype=np.int64)
+    nbr_keys[valid] = tile_keys.encode_tile_keys(
+        nbr_x[valid],
+        nbr_y[valid],
+        np.broadcast_to(cover_zoom[:, None], valid.shape)[valid],
+    )
+
+    # at low zoom neighbours may repeat after wrapping
+    nbr_keys.sort(axis=1)
+    valid = nbr_keys >= 0
+    valid[:, 1:] &= nbr_keys[:, 1:] != nbr_keys[:, :-1]
+
+    lower, upper = tile_keys.descendant_range(nbr_keys[valid], index.zoom)
+    df_pois = _query_ranges(index, lower, upper)
+    query_id = np.repeat(np.arange(n_queries), valid.sum(axis=1))[
+        df_pois["query_id"].values
+    ]
+
+    distance = np_tiles_converter.np_haversin(
+        lat_deg[query_id],
+        lon_deg[query_id],
+        df_pois["lat"].values,
+        df_pois["lon"].values,
+    )
+    filt = distance <= radius
+    df_pois["query_id"] = query_id
+    df_pois["distance"] = distance
+    df_pois = df_pois.loc[filt]
+    return df_pois.iloc[
+        np.argsort(df_pois["query_id"].values, kind="stable")
+    ].reset_index(drop=True)
+
+
+def _query_ranges(
+    index: PoiIndex, lower: np.ndarray, upper: np.ndarray
+) -> pd.DataFrame:
+    """Return POIs with keys in ranges [lower, upper) of every segment.
+
+    Returns:
+        DataFrame with columns "query_id" (position of the range), "poi_id",
+        "lat", "lon"
+    """
+    parts: Dict[str, List[np.ndarray]] = {
+        col: [] for col in ["query_id", "poi_id", "lat", "lon"]
+    }
+    for segment in index.segments:
+        pos_lower = np.searchsorted(segment.keys, lower, side="left")
+        pos_upper = np.searchsorted(segment.keys, upper, side="left")
+
+        # expand [pos_lower, pos_upper) ranges into positions of the rows
+        n_rows = pos_upper - pos_lower
+        run_start = np.cumsum(n_rows) - n_rows
+        rows = np.arange(n_rows.sum()) - np.repeat(run_start - pos_lower, n_rows)
+
+        parts["query_id"].append(np.repeat(np.arange(lower.shape[0]), n_rows))
+        parts["poi_id"].append(segment.poi_id[rows])
+        parts["lat"].append(segment.lat[rows])
+        parts["lon"].append(segment.lon[rows])
+
+    empty = {
+        "query_id": np.array([], dtype=np.int64),
+        "poi_id": np.array([], dtype=np.int64),
+        "lat": np.array([], dtype=np.float64),
+        "lon": np.array([], dtype=np.float64),
+    }
+    return pd.DataFrame(
+        {col: np.concatenate([empty[col]] + values) for col, values in parts.items()}
+    )
+
+
+def _sorted_segment(df_pois: pd.DataFrame, zoom: int, id_col: Optional[str]) -> Segment:
+    """Compute tile keys of POIs and sort all arrays by keys."""
+    assert "lat" in df_pois.columns
+    assert "lon" in df_pois.columns
+
+    lat = df_pois["lat"].values.astype(np.float64)
+    lon = df_pois["lon"].values.astype(np.float64)
+    poi_id = df_pois[id_col].values if id_col is not None else df_pois.index.values
+    assert np.issubdtype(poi_id.dtype, np.integer), "POI ids must be integers"
+
+    keys = tile_keys.deg2key(lat, lon, zoom)
+    order = np.argsort(keys, kind="stable")
+    return Segment(keys[order], lat[order], lon[order], poi_id[order].astype(np.int64))
+
+
+def _write_segment(path: str, number: int, segment: Segment) -> str:
+    """Write arrays of the segment into a new directory, return its name."""
+    name = f"segment-{number:06d}"
+    tmp_dir = os.path.join(path, f".{name}.tmp")
+    os.makedirs(tmp_dir)
+    for col, values in zip(SEGMENT_COLUMNS, segment):
+        np.save(os.path.join(tmp_dir, f"{col}.npy"), np.ascontiguousarray(values))
+    os.replace(tmp_dir, os.path.join(path, name))
+    return name
+
+
+def _read_meta(path: str) -> Dict:
+    """Read description of the index."""
+    with open(os.path.join(path, META_FILE), encoding="utf-8") as file:
+        meta: Dict = json.load(file)
+    return meta
+
+
+def _write_meta(path: str, meta: Dict) -> None:
+    """Replace description of the index atomically."""
+    tmp_path = os.path.join(path, f".{META_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(meta, file)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
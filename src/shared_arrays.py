@@ -0,0 +1,86 @@
+"""Numpy arrays in shared memory, passed to worker processes by name.
+
+Large inputs and outputs of parallel functions are never pickled: the parent
+process allocates shared memory blocks and sends only their descriptions
+(SharedArray) to the workers, which attach to the blocks and read or write
+the arrays in place.
+
+Example:
+    with shared_arrays.allocate([((n_rows,), np.int64)]) as specs:
+        with shared_arrays.attach(specs) as arrays:
+            arrays[0][:] = ...
+        pool.map(worker, [specs] * n_tasks)
+"""
+import contextlib
+from multiprocessing import shared_memory
+from typing import Iterator, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import DTypeLike
+
+
+class SharedArray(NamedTuple):
+    """Description of the array stored in a shared memory block.
+
+    name - name of the shared memory block
+    shape - shape of the array
+    dtype - numpy dtype string
+    """
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+@contextlib.contextmanager
+def allocate(
+    arrays: Sequence[Tuple[Tuple[int, ...], DTypeLike]]
+) -> Iterator[List[SharedArray]]:
+    """Create shared memory blocks for arrays, blocks are removed on exit.
+
+    Arguments:
+        arrays - list of (shape, dtype) of the arrays
+
+    Yields:
+        list of SharedArray, use 'attach' to access the arrays
+    """
+    with contextlib.ExitStack() as stack:
+        specs = []
+        for shape, dtype in arrays:
+            dtype = np.dtype(dtype)
+            # blocks of zero size are not allowed
+            size = max(1, int(np.prod(shape)) * dtype.itemsize)
+            block = shared_memory.SharedMemory(create=True, size=size)
+            stack.callback(block.unlink)
+            stack.callback(block.close)
+            specs.append(SharedArray(block.name, tuple(shape), dtype.str))
+        yield specs
+
+
+def nbytes(specs: Sequence[SharedArray]) -> int:
+    """Return total size of the arrays in bytes."""
+    return sum(
+        int(np.prod(spec.shape)) * np.dtype(spec.dtype).itemsize for spec in specs
+    )
+
+
+@contextlib.contextmanager
+def attach(specs: Sequence[SharedArray]) -> Iterator[List[np.ndarray]]:
+    """Map shared arrays into the current process.
+
+    Arrays are views of the shared memory and must not be used after exit,
+    the list is cleared on exit. Functions called inside the block should
+    not keep references to the arrays (e.g. slices) after they return.
+    """
+    blocks = [shared_memory.SharedMemory(name=spec.name) for spec in specs]
+    arrays = [
+        np.ndarray(spec.shape, dtype=spec.dtype, buffer=block.buf)
+        for spec, block in zip(specs, blocks)
+    ]
+    try:
+        yield arrays
+    finally:
+        # views must be released before the blocks are closed
+        arrays.clear()
+        for block in blocks:
+            block.close()
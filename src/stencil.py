@@ -0,0 +1,211 @@
+"""Radius stencils: tile shifts which fall into given distance from a tile."""
+import functools
+from typing import Tuple
+
+import numpy as np
+
+from src import np_tiles_converter
+
+# Stencils are shared by all rows of a band: ytile quantized to this zoom level.
+# Band at zoom 13 is 5 km high at the equator and less than 3 km in London.
+BAND_ZOOM = 13
+
+# Shifts closer than this to the radius at the band edges are checked per point.
+BAND_TOLERANCE = 1.0
+
+
+def _xy_combinations(x_arr: np.ndarray, y_arr: np.ndarray) -> np.ndarray:
+    """Fast cartesian product of two arrays.
+
+    Given two arrays returns all combinations of their members.
+    any x <-> any y
+    """
+    return np.dstack(np.meshgrid(x_arr, y_arr)).reshape(-1, 2)
+
+
+@functools.lru_cache(maxsize=1024)
+def quarter_stencil(ytile: int, zoom: int, radius: float) -> np.ndarray:
+    """Return Q1 tile shifts within radius from tiles in row 'ytile'.
+
+    Distance between two tile centers depends only on the rows of the tiles and
+    on the x shift between them, so all tiles of a single row share one stencil.
+    Filter is the same as in 'nearby_tiles.get_nearby_tiles': tiles are
+    compared by the haversine distance between their centers.
+    Stencils are cached (LRU), returned array is read-only.
+
+    Arguments:
+        ytile - integer, tile y coordinate of the stencil row
+        zoom - integer, zoom level of the tiles
+        radius - radius in meters
+
+    Returns:
+        shifts - array of integers, shape = [n,2], (dx, dy) pairs with dx, dy >= 0
+    """
+    shifts_xy = _candidate_shifts([ytile], zoom, radius)
+    dist = _shift_distances(ytile, shifts_xy, zoom)
+
+    shifts: np.ndarray = shifts_xy[dist <= radius]
+    shifts.setflags(write=False)
+    return shifts
+
+
+def tile_band(ytile: np.ndarray, zoom: int) -> np.ndarray:
+    """Return band of the tile rows, band is a row at zoom level BAND_ZOOM."""
+    band: np.ndarray = np.asarray(ytile) >> max(zoom - BAND_ZOOM, 0)
+    return band
+
+
+def band_rows(band: int, zoom: int) -> Tuple[int, int]:
+    """Return first and last tile rows of the band."""
+    shift = max(zoom - BAND_ZOOM, 0)
+    return band << shift, ((band + 1) << shift) - 1
+
+
+@functools.lru_cache(maxsize=256)
+def band_stencil(band: int, zoom: int, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Return Q1 shifts within radius for all tile rows of the band.
+
+    For a fixed shift distance between tile centers changes monotonically with
+    latitude, so it is enough to measure it at the first and the last rows
+    of the band. Shifts which are within radius (minus BAND_TOLERANCE) at both
+    edges are within radius for every row of the band. Shifts which are out of
+    radius (plus BAND_TOLERANCE) at both edges are never within radius.
+    Remaining shifts are near the circle boundary and have to be checked
+    for each point separately, which keeps results exact.
+
+    Stencils are cached (LRU) by band, zoom and radius, arrays are read-only.
+
+    Returns:
+        certain - array of integers, shape = [n,2], shifts valid for all band rows
+        uncertain - array of integers, shape = [m,2], shifts to check per point
+    """
+    first_row, last_row = band_rows(band, zoom)
+    shifts_xy = _candidate_shifts([first_row, last_row], zoom, radius)
+    dist_first = _shift_distances(first_row, shifts_xy, zoom)
+    dist_last = _shift_distances(last_row, shifts_xy, zoom)
+
+    dist_min = np.minimum(dist_first, dist_last)
+    dist_max = np.maximum(dist_first, dist_last)
+    filt_certain = dist_max <= radius - BAND_TOLERANCE
+    filt_uncertain = ~filt_certain & (dist_min <= radius + BAND_TOLERANCE)
+
+    certain = shifts_xy[filt_certain]
+    uncertain = shifts_xy[filt_uncertain]
+    certain.setflags(write=False)
+    uncertain.setflags(write=False)
+    return certain, uncertain
+
+
+@functools.lru_cache(maxsize=256)
+def band_ring_stencil(
+    band: int, zoom: int, radii: Tuple[float, ...]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Return Q1 shifts within the largest radius labelled with distance rings.
+
+    Ring of a shift is the position of the smallest radius the shift is
+    within. Distances at the edges of the band are measured once for the
+    candidates of the largest radius and classified for every radius the same
+    way as in 'band_stencil'. If for every radius a shift is either certain
+    or out of radius, its ring is the same for all band rows. Otherwise
+    the shift is near the boundary of one of the rings and has to be checked
+    for each point.
+
+    Arguments:
+        band - integer, band of the tile rows
+        zoom - integer, zoom level of the tiles
+        radii - tuple of radii in meters sorted ascending
+
+    Returns:
+        certain - array of integers, shape = [n,2], shifts with known ring
+        certain_ring - array of int8, shape = [n], ring of certain shifts
+        uncertain - array of integers, shape = [m,2], shifts to check per point
+        uncertain_status - array of int8, shape = [m,len(radii)], for every
+            radius 2 - shift is within radius for all band rows,
+            1 - distance has to be checked, 0 - shift is out of radius
+    """
+    # pylint: disable=too-many-locals
+    assert list(radii) == sorted(radii)
+    first_row, last_row = band_rows(band, zoom)
+    shifts_xy = _candidate_shifts([first_row, last_row], zoom, radii[-1])
+    dist_first = _shift_distances(first_row, shifts_xy, zoom)
+    dist_last = _shift_distances(last_row, shifts_xy, zoom)
+
+    dist_min = np.minimum(dist_first, dist_last)[:, None]
+    dist_max = np.maximum(dist_first, dist_last)[:, None]
+    radii_arr = np.array(radii)
+    status = np.where(
+        dist_max <= radii_arr - BAND_TOLERANCE,
+        2,
+        np.where(dist_min <= radii_arr + BAND_TOLERANCE, 1, 0),
+    ).astype(np.int8)
+
+    # shifts out of the largest radius are dropped
+    filt_uncertain = (status == 1).any(axis=1)
+    filt_certain = ~filt_uncertain & (status[:, -1] == 2)
+    certain = shifts_xy[filt_certain]
+    certain_ring = (status[filt_certain] == 2).argmax(axis=1).astype(np.int8)
+    uncertain = shifts_xy[filt_uncertain]
+    uncertain_status = status[filt_uncertain]
+    for arr in (certain, certain_ring, uncertain, uncertain_status):
+        arr.setflags(write=False)
+    return certain, certain_ring, uncertain, uncertain_status
+
+
+def _candidate_shifts(rows: list, zoom: int, radius: float) -> np.ndarray:
+    """Return Q1 shifts which may be within radius from any of given rows."""
+    max_idx = int(np_tiles_converter.zoom_power(zoom)) - 1
+    x_tiles_lim = 0.0
+    y_tiles_lim = 0.0
+    for ytile in rows:
+        ytile = int(np.clip(ytile, 0, max_idx))
+
+        # distance to adjacent tile, last row uses previous row for the measurement
+        y_adj = ytile + 1 if ytile < max_idx else ytile - 1
+        x_tile_dist, y_tile_dist = np_tiles_converter.np_tile_haversin(
+            np.array([0, 0]),
+            np.array([ytile, ytile]),
+            np.array([1, 0]),
+            np.array([ytile, y_adj]),
+            zoom,
+        )
+
+        # same limits as in get_nearby_tiles
+        x_tiles_lim = max(x_tiles_lim, np.ceil(radius / x_tile_dist + 0.0001) + 1)
+        y_tiles_lim = max(y_tiles_lim, np.ceil(radius / (y_tile_dist + 0.0001)) + 1)
+
+    shifts_xy = _xy_combinations(
+        np.arange(0, x_tiles_lim + 1),
+        np.arange(0, y_tiles_lim + 1),
+    ).astype(np.int32)
+
+    # rough filter by delta tiles, given diagonal in the triangle
+    lim = max(x_tiles_lim, y_tiles_lim) * np.sqrt(2)
+    shifts: np.ndarray = shifts_xy[shifts_xy[:, 0] + shifts_xy[:, 1] <= lim]
+    return shifts
+
+
+def _shift_distances(ytile: int, shifts_xy: np.ndarray, zoom: int) -> np.ndarray:
+    """Haversine distance from tile center in row 'ytile' to shifted tiles centers."""
+    n_shifts = shifts_xy.shape[0]
+    return np_tiles_converter.np_tile_haversin(
+        np.zeros(n_shifts, dtype=np.int64),
+        np.full(n_shifts, ytile, dtype=np.int64),
+        shifts_xy[:, 0],
+        ytile + shifts_xy[:, 1].astype(np.int64),
+        zoom,
+    )
+
+
+def stencil_row_widths(shifts: np.ndarray) -> np.ndarray:
+    """Compress Q1 stencil into maximum x shift for every y shift.
+
+    For a fixed y shift distance grows with x shift, so Q1 stencil row
+    is always a run [0, width]. Rows without any tiles have width -1.
+
+    Returns:
+        widths - array of integers, widths[dy] is the largest dx in stencil row dy
+    """
+    n_rows = int(shifts[:, 1].max()) + 1 if shifts.shape[0] > 0 else 0
+    widths = np.full(n_rows, -1, dtype=np.int64)
+    np.maximum.at(widths, shifts[:, 1], shifts[:, 0])
+    return widths
@@ -0,0 +1,190 @@
+"""Compact mixed-zoom cover of an area with quadtree tiles."""
+from typing import Tuple, Union
+
+import numpy as np
+
+from src import np_tiles_converter, tile_keys
+
+
+def _coverage_segments(
+    group: np.ndarray, start: np.ndarray, end: np.ndarray, weight: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Sum weighted intervals [start, end) inside each group.
+
+    Sweep over interval boundaries: every boundary changes coverage
+    by +weight (start) or -weight (end).
+
+    Returns:
+        seg_group, seg_start, seg_end, seg_coverage - segments with constant
+        non-zero coverage, sorted by group and position
+    """
+    ev_group = np.concatenate([group, group])
+    ev_pos = np.concatenate([start, end])
+    ev_weight = np.concatenate([weight, -weight])
+
+    order = np.lexsort((ev_pos, ev_group))
+    ev_group = ev_group[order]
+    ev_pos = ev_pos[order]
+    coverage = np.cumsum(ev_weight[order])
+
+    # segment between two consecutive boundaries of the same group
+    filt = (ev_group[:-1] == ev_group[1:]) & (ev_pos[:-1] < ev_pos[1:])
+    filt &= coverage[:-1] != 0
+    return ev_group[:-1][filt], ev_pos[:-1][filt], ev_pos[1:][filt], coverage[:-1][filt]
+
+
+def _merge_runs(
+    run_y: np.ndarray, run_start: np.ndarray, run_end: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge touching runs [start, end) of the same row, runs must be sorted."""
+    if run_y.shape[0] == 0:
+        return run_y, run_start, run_end
+
+    new_run = np.ones(run_y.shape[0], dtype=bool)
+    new_run[1:] = (run_y[1:] != run_y[:-1]) | (run_start[1:] != run_end[:-1])
+    first = np.flatnonzero(new_run)
+    last = np.append(first[1:], run_y.shape[0]) - 1
+    return run_y[first], run_start[first], run_end[last]
+
+
+def _runs_to_keys(
+    run_y: np.ndarray, run_start: np.ndarray, run_end: np.ndarray, zoom: int
+) -> np.ndarray:
+    """Convert runs [start, end) to keys of every tile."""
+    run_length = run_end - run_start
+    y_tiles = np.repeat(run_y, run_length)
+    x_tiles = np.arange(y_tiles.shape[0]) - np.repeat(
+        np.cumsum(run_length) - run_length - run_start, run_length
+    )
+    return tile_keys.encode_tile_keys(x_tiles, y_tiles, zoom)
+
+
+def runs_to_cover(
+    run_y: np.ndarray,
+    run_x_start: np.ndarray,
+    run_x_end: np.ndarray,
+    zoom: int,
+    min_zoom: int = 0,
+) -> np.ndarray:
+    """Build minimal mixed-zoom cover of the area given by runs of tiles.
+
+    Four sibling tiles which all belong to the area are replaced by their parent,
+    level by level up to 'min_zoom'. Interior of the area ends up covered by
+    a few coarse tiles, only tiles along the boundary stay at 'zoom'.
+    All levels are processed as runs of tiles, interior tiles are never
+    listed one by one.
+
+    Arguments:
+        run_y - tile row of the run
+        run_x_start - first tile of the run
+        run_x_end - last tile of the run (inclusive)
+        zoom - integer, zoom level of the runs
+        min_zoom - integer, the coarsest zoom level of the cover
+
+    Returns:
+        cover - sorted numpy array of tile keys (see 'tile_keys') of mixed zoom
+    """
+    # pylint: disable=too-many-locals
+    assert 0 <= min_zoom <= zoom
+
+    order = np.lexsort((run_x_start, run_y))
+    run_y, run_start, run_end = _merge_runs(
+        run_y[order].astype(np.int64),
+        run_x_start[order].astype(np.int64),
+        run_x_end[order].astype(np.int64) + 1,
+    )
+
+    cover_parts = []
+    for level in range(zoom, min_zoom, -1):
+        # parents fully covered by a single row of children
+        par_start = (run_start + 1) // 2
+        par_end = run_end // 2
+        filt = par_start < par_end
+
+        # parent is fully covered if it is covered by both rows of children
+        par_y, par_start, par_end, coverage = _coverage_segments(
+            run_y[filt] // 2,
+            par_start[filt],
+            par_end[filt],
+            np.ones(filt.sum(), dtype=np.int64),
+        )
+        filt = coverage == 2
+        par_y, par_start, par_end = _merge_runs(
+            par_y[filt], par_start[filt], par_end[filt]
+        )
+
+        # children which are not replaced by parents stay at this level
+        leaf_y, leaf_start, leaf_end, coverage = _coverage_segments(
+            np.concatenate([run_y, par_y * 2, par_y * 2 + 1]),
+            np.concatenate([run_start, par_start * 2, par_start * 2]),
+            np.concatenate([run_end, par_end * 2, par_end * 2]),
+            np.concatenate(
+                [
+                    np.ones(run_y.shape[0], dtype=np.int64),
+                    -np.ones(par_y.shape[0] * 2, dtype=np.int64),
+                ]
+            ),
+        )
+        filt = coverage == 1
+        cover_parts.append(
+            _runs_to_keys(leaf_y[filt], leaf_start[filt], leaf_end[filt], level)
+        )
+
+        run_y, run_start, run_end = par_y, par_start, par_end
+
+    cover_parts.append(_runs_to_keys(run_y, run_start, run_end, min_zoom))
+
+    cover: np.ndarray = np.sort(np.concatenate(cover_parts))
+    return cover
+
+
+def cover_contains(
+    cover: np.ndarray,
+    xtile: Union[np.ndarray, int],
+    ytile: Union[np.ndarray, int],
+    zoom: int,
+) -> np.ndarray:
+    """Check if tiles are inside the mixed-zoom cover.
+
+    Tile is inside if it or any of its ancestors is a tile of the cover.
+    Ancestors are found with bit shifts of the tile key, one binary search
+    per zoom level present in the cover.
+
+    Arguments:
+        cover - sorted numpy array of tile keys, output of 'runs_to_cover'
+        xtile - integer or numpy array of integers, tile x coordinate
+        ytile - integer or numpy array of integers, tile y coordinate
+        zoom - integer, zoom level of the tiles
+
+    Returns:
+        numpy array of booleans
+    """
+    keys = tile_keys.encode_tile_keys(xtile, ytile, zoom)
+    inside = np.zeros(keys.shape[0], dtype=bool)
+    if cover.shape[0] == 0:
+        return inside
+
+    for level in np.unique(tile_keys.key_zoom(cover)):
+        if level > zoom:
+            break
+        ancestors = tile_keys.parent_keys(keys, zoom - int(level))
+        pos = np.searchsorted(cover, ancestors)
+        pos = np.minimum(pos, cover.shape[0] - 1)
+        inside |= cover[pos] == ancestors
+
+    return inside
+
+
+def cover_contains_points(
+    cover: np.ndarray,
+    lat_deg: Union[np.ndarray, float],
+    lon_deg: Union[np.ndarray, float],
+) -> np.ndarray:
+    """Check if points are inside tiles of the mixed-zoom cover.
+
+    Returns:
+        numpy array of booleans
+    """
+    zoom = int(tile_keys.key_zoom(cover).max()) if cover.shape[0] > 0 else 0
+    xtile, ytile = np_tiles_converter.np_deg2idx(lat_deg, lon_deg, zoom=zoom)
+    return cover_contains(cover, xtile, ytile, zoom)
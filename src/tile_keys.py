@@ -0,0 +1,162 @@
+"""Pack tile x,y indexes and zoom into a single int64 key.
+
+Key is a quadkey stored as integer: bits of x and y are interleaved
+(Morton / Z-order, same digits as Bing quadkey) and prefixed with a single
+sentinel bit which encodes zoom. Tile (x, y) at zoom z has the key:
+
+    key = 4**z + morton(x, y)
+
+Properties of the keys:
+    -- keys of the same zoom sorted ascending follow Z-order curve,
+       close tiles usually have close keys (range scans are possible)
+    -- zoom is encoded into the key, keys of different zooms never collide
+    -- parent tile is 'key >> 2', children are 'key << 2 | 0..3'
+    -- all descendants of a tile at given zoom form a continuous range of keys
+
+Sources:
+    -- https://learn.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+"""
+from typing import Tuple, Union
+
+import numpy as np
+
+from src import np_tiles_converter
+
+# 2 bits per zoom level plus sentinel bit must fit into int64
+MAX_KEY_ZOOM = 30
+
+# key of any tile at zoom z is in range [4**z, 4**(z+1))
+_ZOOM_THRESHOLDS = np.left_shift(np.int64(1), 2 * np.arange(MAX_KEY_ZOOM + 1))
+
+
+def _spread_bits(val: np.ndarray) -> np.ndarray:
+    """Insert zero bit after each of the lower 32 bits: 0b111 -> 0b10101."""
+    val = val.astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+    val = (val | (val << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    val = (val | (val << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    val = (val | (val << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    val = (val | (val << np.uint64(2))) & np.uint64(0x3333333333333333)
+    val = (val | (val << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return val
+
+
+def _compact_bits(val: np.ndarray) -> np.ndarray:
+    """Drop every odd bit, reverse of '_spread_bits': 0b10101 -> 0b111."""
+    val = val.astype(np.uint64) & np.uint64(0x5555555555555555)
+    val = (val | (val >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    val = (val | (val >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    val = (val | (val >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    val = (val | (val >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    val = (val | (val >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return val
+
+
+def encode_tile_keys(
+    xtile: Union[np.ndarray, int],
+    ytile: Union[np.ndarray, int],
+    zoom: Union[np.ndarray, int],
+) -> np.ndarray:
+    """Convert tile x,y indexes and zoom to int64 keys.
+
+    Arguments:
+        xtile - integer or numpy array of integers, tile 'x' coordinate
+        ytile - integer or numpy array of integers, tile 'y' coordinate
+        zoom - integer or numpy array of integers, zoom level of the tiles
+
+    Returns:
+        keys - numpy array of int64
+    """
+    xtile = np.atleast_1d(xtile)
+    ytile = np.atleast_1d(ytile)
+    zoom = np.atleast_1d(zoom).astype(np.int64)
+
+    assert xtile.ndim == 1
+    assert ytile.ndim == 1
+    assert xtile.shape[0] == ytile.shape[0]
+    assert np.all((zoom >= 0) & (zoom <= MAX_KEY_ZOOM))
+
+    n_tiles = np.left_shift(np.int64(1), zoom)
+    assert np.all((xtile >= 0) & (xtile < n_tiles))
+    assert np.all((ytile >= 0) & (ytile < n_tiles))
+
+    morton = _spread_bits(xtile) | (_spread_bits(ytile) << np.uint64(1))
+    keys: np.ndarray = morton.astype(np.int64) | _ZOOM_THRESHOLDS[zoom]
+    return keys
+
+
+def decode_tile_keys(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Convert int64 keys back to tile x,y indexes and zoom.
+
+    Returns:
+        xtile - numpy array of integers, tile x coordinate
+        ytile - numpy array of integers, tile y coordinate
+        zoom - numpy array of integers, zoom level of the tile
+    """
+    keys = np.atleast_1d(keys).astype(np.int64)
+    zoom = key_zoom(keys)
+
+    morton = keys ^ _ZOOM_THRESHOLDS[zoom]
+    xtile = _compact_bits(morton).astype(np.int32)
+    ytile = _compact_bits(morton >> 1).astype(np.int32)
+
+    return xtile, ytile, zoom
+
+
+def key_zoom(keys: np.ndarray) -> np.ndarray:
+    """Return zoom level encoded into the keys."""
+    keys = np.atleast_1d(keys)
+    assert np.all(keys > 0), "Not a tile key"
+
+    zoom: np.ndarray = np.searchsorted(_ZOOM_THRESHOLDS, keys, side="right") - 1
+    return zoom.astype(np.int32)
+
+
+def deg2key(
+    lat_deg: Union[np.ndarray, float], lon_deg: Union[np.ndarray, float], zoom: int
+) -> np.ndarray:
+    """Convert degrees of latitude and longitude to int64 tile keys."""
+    xtile, ytile = np_tiles_converter.np_deg2idx(lat_deg, lon_deg, zoom=zoom)
+    return encode_tile_keys(xtile, ytile, zoom)
+
+
+def parent_keys(keys: np.ndarray, levels: int = 1) -> np.ndarray:
+    """Return keys of the parent tiles 'levels' zoom levels up."""
+    keys = np.atleast_1d(keys).astype(np.int64)
+    assert levels >= 0
+    assert np.all(keys >= _ZOOM_THRESHOLDS[levels]), "Zoom of the key is too small"
+
+    parents: np.ndarray = keys >> (2 * levels)
+    return parents
+
+
+def children_keys(keys: np.ndarray) -> np.ndarray:
+    """Return keys of four children tiles, array shape = [n,4].
+
+    Children are ordered by quadkey digit: top left, top right,
+    bottom left, bottom right.
+    """
+    keys = np.atleast_1d(keys).astype(np.int64)
+    assert np.all(keys < _ZOOM_THRESHOLDS[MAX_KEY_ZOOM]), "Zoom of the key is too big"
+
+    children: np.ndarray = (keys << 2)[:, None] | np.arange(4, dtype=np.int64)
+    return children
+
+
+def descendant_range(keys: np.ndarray, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return range of keys of all descendants at given zoom level.
+
+    Descendant of a key at 'zoom' is any key 'k' such that lower <= k < upper.
+    Tile itself is returned if 'zoom' equals zoom of the key.
+
+    Returns:
+        lower - numpy array of int64, first descendant key
+        upper - numpy array of int64, key after the last descendant
+    """
+    keys = np.atleast_1d(keys).astype(np.int64)
+    assert zoom <= MAX_KEY_ZOOM
+    levels = zoom - key_zoom(keys)
+    assert np.all(levels >= 0), "Keys must have zoom smaller than 'zoom'"
+
+    lower: np.ndarray = keys << (2 * levels)
+    upper: np.ndarray = (keys + 1) << (2 * levels)
+    return lower, upper
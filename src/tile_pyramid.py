@@ -0,0 +1,165 @@
+"""Aggregate tile values at all zoom levels (tile pyramid)."""
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src import np_tiles_converter, tile_keys
+
+
+def _segment_sum(
+    keys: np.ndarray, values: List[np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray, List[np.ndarray]]:
+    """Sum values over runs of equal keys, keys must be sorted.
+
+    Returns:
+        uniq_keys - numpy array of unique keys
+        starts - position of the first element of each run
+        sums - list of arrays, sums of each value array over the runs
+    """
+    if keys.shape[0] == 0:
+        return keys, np.array([], dtype=np.int64), [val[:0] for val in values]
+
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    sums = [np.add.reduceat(val, starts) for val in values]
+    return keys[starts], starts, sums
+
+
+def rollup_keys(
+    keys: np.ndarray, values: List[np.ndarray], levels: int = 1
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """Sum values of sorted tile keys into their parents 'levels' zoom levels up.
+
+    Parent keys of sorted keys are sorted too, so no sorting is needed:
+    rollup is a bit shift followed by a sum over runs of equal parents.
+
+    Returns:
+        parents - numpy array of sorted unique parent keys
+        sums - list of arrays, sums of each value array per parent
+    """
+    parents, _, sums = _segment_sum(tile_keys.parent_keys(keys, levels), values)
+    return parents, sums
+
+
+def tile_counts(
+    lat_deg: Union[np.ndarray, float], lon_deg: Union[np.ndarray, float], zoom: int
+) -> pd.DataFrame:
+    """Count points in each tile.
+
+    Returns:
+        DataFrame with columns "tile_idx_x", "tile_idx_y", "count"
+    """
+    xtile, ytile = np_tiles_converter.np_deg2idx(lat_deg, lon_deg, zoom=zoom)
+    keys, counts = np.unique(
+        tile_keys.encode_tile_keys(xtile, ytile, zoom), return_counts=True
+    )
+    xtile, ytile, _ = tile_keys.decode_tile_keys(keys)
+
+    return pd.DataFrame({"tile_idx_x": xtile, "tile_idx_y": ytile, "count": counts})
+
+
+def build_pyramid(
+    df_tiles: pd.DataFrame,
+    zoom: int,
+    min_zoom: int = 0,
+    value_cols: Optional[List[str]] = None,
+) -> Dict[int, pd.DataFrame]:
+    """Roll up per-tile counts or sums from base zoom to all coarser zooms.
+
+    Tiles are sorted by their keys once, every coarser level is computed
+    from the previous one with a bit shift and a sorted-segment sum.
+
+    Arguments:
+        df_tiles - have columns "tile_idx_x", "tile_idx_y" (tiles at 'zoom')
+            and value columns, tiles may repeat
+        zoom - integer, zoom level of the tiles in 'df_tiles'
+        min_zoom - integer, the coarsest zoom level of the pyramid
+        value_cols - columns to sum, all columns except tile indexes by default
+
+    Returns:
+        dictionary zoom -> DataFrame with columns "tile_key", "tile_idx_x",
+        "tile_idx_y" and value columns, rows are sorted by "tile_key"
+    """
+    assert "tile_idx_x" in df_tiles.columns
+    assert "tile_idx_y" in df_tiles.columns
+    assert 0 <= min_zoom <= zoom <= tile_keys.MAX_KEY_ZOOM
+
+    if value_cols is None:
+        value_cols = [
+            col for col in df_tiles.columns if col not in ("tile_idx_x", "tile_idx_y")
+        ]
+
+    keys = tile_keys.encode_tile_keys(
+        df_tiles["tile_idx_x"].values, df_tiles["tile_idx_y"].values, zoom
+    )
+    order = np.argsort(keys, kind="stable")
+    keys, _, values = _segment_sum(
+        keys[order], [df_tiles[col].values[order] for col in value_cols]
+    )
+
+    pyramid = {zoom: _level_frame(keys, values, value_cols)}
+    for level in range(zoom - 1, min_zoom - 1, -1):
+        keys, values = rollup_keys(keys, values)
+        pyramid[level] = _level_frame(keys, values, value_cols)
+
+    return pyramid
+
+
+def drill_down(
+    pyramid: Dict[int, pd.DataFrame],
+    xtile: Union[np.ndarray, int],
+    ytile: Union[np.ndarray, int],
+    zoom: int,
+    target_zoom: int,
+) -> pd.DataFrame:
+    """Return non-empty descendants of given tiles from finer pyramid level.
+
+    Descendants of a tile are a continuous range of keys,
+    so they are found with binary search in the sorted pyramid level.
+
+    Arguments:
+        pyramid - output of 'build_pyramid'
+        xtile - integer or numpy array of integers, tile x coordinate at 'zoom'
+        ytile - integer or numpy array of integers, tile y coordinate at 'zoom'
+        zoom - integer, zoom level of the input tiles
+        target_zoom - integer, pyramid level to take descendants from
+
+    Returns:
+        rows of pyramid[target_zoom] with extra column "parent_id"
+        which is the position of the parent tile in the input arrays
+    """
+    # pylint: disable=too-many-locals
+    assert target_zoom >= zoom
+    assert target_zoom in pyramid
+
+    level = pyramid[target_zoom]
+    level_keys = level["tile_key"].values
+
+    lower, upper = tile_keys.descendant_range(
+        tile_keys.encode_tile_keys(xtile, ytile, zoom), target_zoom
+    )
+    pos_lower = np.searchsorted(level_keys, lower, side="left")
+    pos_upper = np.searchsorted(level_keys, upper, side="left")
+
+    # expand [pos_lower, pos_upper) ranges into positions of the rows
+    n_children = pos_upper - pos_lower
+    parent_id = np.repeat(np.arange(lower.shape[0]), n_children)
+    run_start = np.cumsum(n_children) - n_children
+    rows = np.arange(n_children.sum()) - np.repeat(run_start - pos_lower, n_children)
+
+    children = level.iloc[rows].reset_index(drop=True)
+    children["parent_id"] = parent_id
+    return children
+
+
+def _level_frame(
+    keys: np.ndarray, values: List[np.ndarray], value_cols: List[str]
+) -> pd.DataFrame:
+    """Create DataFrame of single pyramid level."""
+    xtile, ytile, _ = tile_keys.decode_tile_keys(keys)
+    df_level = pd.DataFrame(
+        {"tile_key": keys, "tile_idx_x": xtile, "tile_idx_y": ytile}
+    )
+    for col, val in zip(value_cols, values):
+        df_level[col] = val
+    return df_level
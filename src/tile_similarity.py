@@ -0,0 +1,237 @@
+"""Find customers with similar sets of visited tiles (MinHash and LSH).
+
+Jaccard similarity of two tile sets is the share of common tiles.
+MinHash signature of a set is a vector of minimums of random hash functions
+over its tiles: two signatures have equal values at a position with
+probability equal to Jaccard similarity of the sets. Signatures are split
+into bands and customers with identical band are candidate pairs,
+so pairs are found without comparing every customer with every other.
+
+Sources:
+    -- Leskovec, Rajaraman, Ullman, "Mining of Massive Datasets", chapter 3
+"""
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Number of hash functions computed at once, limits temporary memory
+_HASH_BLOCK = 8
+
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+class MinHashSignatures(NamedTuple):
+    """MinHash signatures of tile sets.
+
+    ids - numpy array, id of the customer (set) of every signature
+    signatures - numpy array of uint64, shape = [n_ids, num_perm]
+    seed - integer, seed of hash functions, only signatures with
+        the same seed and number of hash functions can be compared
+    """
+
+    ids: np.ndarray
+    signatures: np.ndarray
+    seed: int
+
+
+def _mix64(val: np.ndarray) -> np.ndarray:
+    """Scramble bits of uint64 values (splitmix64 finalizer), wraps on overflow."""
+    val = val ^ (val >> np.uint64(30))
+    val = val * np.uint64(0xBF58476D1CE4E5B9)
+    val = val ^ (val >> np.uint64(27))
+    val = val * np.uint64(0x94D049BB133111EB)
+    val = val ^ (val >> np.uint64(31))
+    return val
+
+
+def _hash_seeds(seed: int, num_perm: int) -> np.ndarray:
+    """Return seeds of 'num_perm' hash functions."""
+    rng = np.random.default_rng(seed)
+    seeds: np.ndarray = rng.integers(0, _MASK64, size=num_perm, dtype=np.uint64)
+    return seeds
+
+
+def minhash_signatures(
+    ids: np.ndarray, keys: np.ndarray, num_perm: int = 128, seed: int = 0
+) -> MinHashSignatures:
+    """Compute MinHash signature of the tile set of every id.
+
+    Arguments:
+        ids - numpy array, customer id of every visited tile
+        keys - numpy array of integers, tile keys (see 'tile_keys'),
+            same length as ids, duplicates are allowed
+        num_perm - integer, number of hash functions (signature length)
+        seed - integer, seed of hash functions
+
+    Returns:
+        MinHashSignatures with one row per unique id
+    """
+    ids = np.asarray(ids)
+    keys = np.asarray(keys)
+    assert ids.shape[0] == keys.shape[0]
+
+    id_codes, uniq_ids = pd.factorize(ids, sort=True)
+    order = np.argsort(id_codes, kind="stable")
+    keys_sorted = keys[order].astype(np.uint64)
+    id_sorted = id_codes[order]
+    starts = np.flatnonzero(np.diff(id_sorted, prepend=-1))
+
+    hash_seeds = _hash_seeds(seed, num_perm)
+    signatures = np.empty((uniq_ids.shape[0], num_perm), dtype=np.uint64)
+    for start in range(0, num_perm, _HASH_BLOCK):
+        block = hash_seeds[start : start + _HASH_BLOCK]
+        hashes = _mix64(keys_sorted[:, None] ^ block[None, :])
+        signatures[:, start : start + block.shape[0]] = np.minimum.reduceat(
+            hashes, starts, axis=0
+        )
+
+    return MinHashSignatures(np.asarray(uniq_ids), signatures, seed)
+
+
+def merge_signatures(
+    sig_a: MinHashSignatures, sig_b: MinHashSignatures
+) -> MinHashSignatures:
+    """Merge signatures computed on different parts of the data.
+
+    Signature of union of two sets is the element-wise minimum of their
+    signatures, so new days of data are added without full rebuild:
+    compute signatures for the new data only and merge them with old ones.
+    """
+    assert sig_a.seed == sig_b.seed
+    assert sig_a.signatures.shape[1] == sig_b.signatures.shape[1]
+
+    all_ids = np.concatenate([sig_a.ids, sig_b.ids])
+    id_codes, uniq_ids = pd.factorize(all_ids, sort=True)
+
+    signatures = np.full(
+        (uniq_ids.shape[0], sig_a.signatures.shape[1]), _MASK64, dtype=np.uint64
+    )
+    np.minimum.at(
+        signatures, id_codes, np.concatenate([sig_a.signatures, sig_b.signatures])
+    )
+
+    return MinHashSignatures(np.asarray(uniq_ids), signatures, sig_a.seed)
+
+
+def save_signatures(path: str, sig: MinHashSignatures) -> None:
+    """Save signatures to .npz file."""
+    ids = sig.ids.astype(str) if sig.ids.dtype == object else sig.ids
+    np.savez(path, ids=ids, signatures=sig.signatures, seed=sig.seed)
+
+
+def load_signatures(path: str) -> MinHashSignatures:
+    """Load signatures saved with 'save_signatures'."""
+    with np.load(path, allow_pickle=False) as data:
+        return MinHashSignatures(data["ids"], data["signatures"], int(data["seed"]))
+
+
+def optimal_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """Choose number of bands and rows per band for Jaccard threshold.
+
+    Pairs with similarity 's' become candidates with probability
+    1 - (1 - s**rows)**bands, which jumps from 0 to 1 near (1/bands)**(1/rows).
+
+    Returns:
+        bands, rows - integers, bands * rows <= num_perm
+    """
+    best = (num_perm, 1)
+    best_err = np.inf
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        err = abs((1 / bands) ** (1 / rows) - threshold)
+        if err < best_err:
+            best, best_err = (bands, rows), err
+    return best
+
+
+def candidate_pairs(
+    sig: MinHashSignatures,
+    threshold: float = 0.5,
+    bands: Optional[int] = None,
+    max_bucket_size: int = 1000,
+) -> pd.DataFrame:
+    """Find pairs of ids with estimated Jaccard similarity above threshold.
+
+    Signatures are split into bands, every band is hashed and ids with the same
+    band hash fall into one bucket. Only pairs sharing at least one bucket are
+    compared.
+
+    Arguments:
+        sig - output of 'minhash_signatures' or 'merge_signatures'
+        threshold - float, minimal estimated Jaccard similarity of a pair
+        bands - integer, number of bands, chosen from threshold by default
+        max_bucket_size - integer, larger buckets (e.g. customers who visited
+            only one very popular tile) are skipped to avoid quadratic blow up
+
+    Returns:
+        DataFrame with columns "id_a", "id_b", "jaccard"
+    """
+    # pylint: disable=too-many-locals
+    n_ids, num_perm = sig.signatures.shape
+    if bands is None:
+        bands, rows = optimal_bands(num_perm, threshold)
+    else:
+        rows = num_perm // bands
+
+    pair_parts = [np.array([], dtype=np.int64)]
+    for band in range(bands):
+        band_hash = np.zeros(n_ids, dtype=np.uint64)
+        for col in range(band * rows, (band + 1) * rows):
+            band_hash = _mix64(band_hash ^ sig.signatures[:, col])
+
+        order = np.argsort(band_hash, kind="stable")
+        first, second = _bucket_pairs(band_hash[order], max_bucket_size)
+        id_a = np.minimum(order[first], order[second]).astype(np.int64)
+        id_b = np.maximum(order[first], order[second]).astype(np.int64)
+        pair_parts.append(id_a * n_ids + id_b)
+
+    pairs = np.unique(np.concatenate(pair_parts))
+    id_a = pairs // max(n_ids, 1)
+    id_b = pairs % max(n_ids, 1)
+
+    jaccard = np.empty(pairs.shape[0])
+    step = max(1, 2**22 // max(num_perm, 1))
+    for start in range(0, pairs.shape[0], step):
+        sig_a = sig.signatures[id_a[start : start + step]]
+        sig_b = sig.signatures[id_b[start : start + step]]
+        jaccard[start : start + step] = (sig_a == sig_b).mean(axis=1)
+
+    filt = jaccard >= threshold
+    return pd.DataFrame(
+        {
+            "id_a": sig.ids[id_a[filt]],
+            "id_b": sig.ids[id_b[filt]],
+            "jaccard": jaccard[filt],
+        }
+    )
+
+
+def _bucket_pairs(
+    sorted_hash: np.ndarray, max_bucket_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """List all pairs of positions inside runs of equal values.
+
+    Returns:
+        first, second - positions of pair members, first < second
+    """
+    starts = np.flatnonzero(np.diff(sorted_hash, prepend=sorted_hash[:1] + 1))
+    sizes = np.diff(np.append(starts, sorted_hash.shape[0]))
+    filt = (sizes > 1) & (sizes <= max_bucket_size)
+    starts = starts[filt]
+    sizes = sizes[filt]
+
+    # every member of the bucket is paired with all members after it
+    members = np.repeat(starts, sizes) + (
+        np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    )
+    bucket_end = np.repeat(starts + sizes, sizes)
+    n_after = bucket_end - members - 1
+
+    first = np.repeat(members, n_after)
+    second = (
+        first
+        + 1
+        + (np.arange(n_after.sum()) - np.repeat(np.cumsum(n_after) - n_after, n_after))
+    )
+    return first, second
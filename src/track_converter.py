@@ -0,0 +1,196 @@
+"""Convert GPS tracks to continuous sequences of tiles."""
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import np_tiles_converter
+
+
+def _grid_crossings(
+    frac_x0: np.ndarray, frac_x1: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """List tile boundaries crossed by segments along one axis.
+
+    Arguments:
+        frac_x0 - fractional tile coordinate of the segment start
+        frac_x1 - fractional tile coordinate of the segment end
+
+    Returns:
+        seg_id - segment of the crossing
+        share - position of the crossing on the segment, from 0 to 1
+        step - +1 or -1, change of the tile index after the crossing
+    """
+    idx_x0 = np.floor(frac_x0)
+    idx_x1 = np.floor(frac_x1)
+    n_cross = np.abs(idx_x1 - idx_x0).astype(np.int64)
+    step = np.sign(idx_x1 - idx_x0)
+
+    seg_id = np.repeat(np.arange(n_cross.shape[0]), n_cross)
+    # k-th crossing of the segment, k = 1..n_cross
+    k_cross = (
+        np.arange(seg_id.shape[0])
+        - np.repeat(np.cumsum(n_cross) - n_cross, n_cross)
+        + 1
+    )
+
+    # moving right crosses boundaries x0+1, x0+2...; moving left x0, x0-1, ...
+    seg_step = step[seg_id]
+    boundary = idx_x0[seg_id] + k_cross * seg_step + (seg_step < 0)
+    share = (boundary - frac_x0[seg_id]) / (frac_x1[seg_id] - frac_x0[seg_id])
+
+    return seg_id, share, seg_step.astype(np.int64)
+
+
+def tracks_to_tiles(
+    df_tracks: pd.DataFrame,
+    zoom: int,
+    track_col: str = "track_id",
+    time_col: str = "timestamp",
+) -> pd.DataFrame:
+    """Convert GPS tracks to continuous sequences of visited tiles.
+
+    Consecutive pings of a track are connected with a straight line
+    (in tile space) and all tiles crossed by the line are listed (supercover
+    of the line, grid traversal). Each step moves to an adjacent tile, so
+    the path has no gaps even if pings are far from each other. Time when
+    the track enters each tile is interpolated along the line.
+    Consecutive visits of the same tile are collapsed into one row.
+
+    All tracks are processed together: tile boundaries crossed by every
+    segment are listed, sorted by segment and position, and accumulated
+    into tile indexes, there are no python loops over tracks or pings.
+
+    Arguments:
+        df_tracks - have columns with track id, timestamp, "lat" and "lon",
+            timestamp is datetime or number of seconds
+        zoom - integer, zoom level of the tiles
+        track_col - column with track (customer) id
+        time_col - column with ping time
+
+    Returns:
+        DataFrame with columns track id, "tile_idx_x", "tile_idx_y",
+        "enter_time" (same type as timestamps) and "dwell_seconds"
+        (time until the track left the tile), ordered by track and time
+    """
+    # pylint: disable=too-many-locals,too-many-statements
+    assert track_col in df_tracks.columns
+    assert time_col in df_tracks.columns
+    assert "lat" in df_tracks.columns
+    assert "lon" in df_tracks.columns
+
+    track_codes, track_ids = pd.factorize(df_tracks[track_col])
+    timestamps = df_tracks[time_col].values
+    is_datetime = np.issubdtype(timestamps.dtype, np.datetime64)
+    if is_datetime:
+        ping_time = timestamps.astype("datetime64[ns]").astype(np.int64) / 1e9
+    else:
+        ping_time = timestamps.astype(np.float64)
+
+    if track_codes.shape[0] == 0:
+        no_visits = np.array([], dtype=np.int64)
+        df_empty = pd.DataFrame(
+            {
+                track_col: track_ids[no_visits],
+                "tile_idx_x": no_visits.astype(np.int32),
+                "tile_idx_y": no_visits.astype(np.int32),
+                "enter_time": no_visits.astype(np.float64),
+                "dwell_seconds": no_visits.astype(np.float64),
+            }
+        )
+        if is_datetime:
+            df_empty["enter_time"] = no_visits.astype("datetime64[ns]")
+        return df_empty
+
+    order = np.lexsort((ping_time, track_codes))
+    track_codes = track_codes[order]
+    ping_time = ping_time[order]
+    frac_x, frac_y = np_tiles_converter.np_deg2frac(
+        df_tracks["lat"].values[order], df_tracks["lon"].values[order], zoom
+    )
+
+    # segments between consecutive pings of the same track
+    first_ping = np.ones(track_codes.shape[0], dtype=bool)
+    first_ping[1:] = track_codes[1:] != track_codes[:-1]
+    seg_start = np.flatnonzero(~first_ping) - 1
+
+    # tile boundaries crossed by segments, sorted along each segment
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross_x = _grid_crossings(frac_x[seg_start], frac_x[seg_start + 1])
+        cross_y = _grid_crossings(frac_y[seg_start], frac_y[seg_start + 1])
+    cross_seg = np.concatenate([cross_x[0], cross_y[0]])
+    cross_share = np.concatenate([cross_x[1], cross_y[1]])
+    step_x = np.concatenate([cross_x[2], np.zeros_like(cross_y[2])])
+    step_y = np.concatenate([np.zeros_like(cross_x[2]), cross_y[2]])
+
+    # visits: first ping of every track, then every crossing in time order
+    first_idx = np.flatnonzero(first_ping)
+    visit_ping = np.concatenate([first_idx, seg_start[cross_seg]])
+    visit_share = np.concatenate([np.full(first_idx.shape[0], -1.0), cross_share])
+    visit_order = np.lexsort((visit_share, visit_ping))
+    visit_ping = visit_ping[visit_order]
+    visit_share = np.maximum(visit_share[visit_order], 0)
+    step_x = np.concatenate([np.zeros_like(first_idx), step_x])[visit_order]
+    step_y = np.concatenate([np.zeros_like(first_idx), step_y])[visit_order]
+
+    # tile index of the visit: first ping tile plus accumulated steps of the track
+    visit_track = track_codes[visit_ping]
+    track_first = first_idx[visit_track]
+    tile_x = np.floor(frac_x[track_first]).astype(np.int64)
+    tile_y = np.floor(frac_y[track_first]).astype(np.int64)
+    tile_x += _cumsum_by_group(step_x, visit_track)
+    tile_y += _cumsum_by_group(step_y, visit_track)
+
+    next_ping = np.minimum(visit_ping + 1, ping_time.shape[0] - 1)
+    enter_time = ping_time[visit_ping] + visit_share * (
+        ping_time[next_ping] - ping_time[visit_ping]
+    )
+
+    # collapse consecutive visits of the same tile
+    new_visit = np.ones(visit_track.shape[0], dtype=bool)
+    new_visit[1:] = (
+        (visit_track[1:] != visit_track[:-1])
+        | (tile_x[1:] != tile_x[:-1])
+        | (tile_y[1:] != tile_y[:-1])
+    )
+    keep = np.flatnonzero(new_visit)
+    visit_track = visit_track[keep]
+    tile_x = tile_x[keep]
+    tile_y = tile_y[keep]
+    enter_time = enter_time[keep]
+
+    # track stays in the tile until it enters the next one or the track ends
+    last_ping = np.append(np.flatnonzero(first_ping)[1:], track_codes.shape[0]) - 1
+    leave_time = np.append(enter_time[1:], 0.0)
+    last_visit = np.append(visit_track[1:] != visit_track[:-1], True)
+    leave_time[last_visit] = ping_time[last_ping[visit_track[last_visit]]]
+
+    df_tiles = pd.DataFrame(
+        {
+            track_col: track_ids[visit_track],
+            "tile_idx_x": tile_x.astype(np.int32),
+            "tile_idx_y": tile_y.astype(np.int32),
+            "enter_time": enter_time,
+            "dwell_seconds": leave_time - enter_time,
+        }
+    )
+    if is_datetime:
+        df_tiles["enter_time"] = pd.to_datetime(
+            np.round(enter_time * 1e9).astype(np.int64)
+        )
+
+    return df_tiles
+
+
+def _cumsum_by_group(values: np.ndarray, group: np.ndarray) -> np.ndarray:
+    """Cumulative sum restarting at every group, groups must be continuous."""
+    total = np.cumsum(values)
+    group_start = np.ones(group.shape[0], dtype=bool)
+    group_start[1:] = group[1:] != group[:-1]
+    start_idx = np.flatnonzero(group_start)
+
+    # total before the group start is subtracted from all group members
+    offset = (total - values)[start_idx]
+    group_pos = np.cumsum(group_start) - 1
+    result: np.ndarray = total - offset[group_pos]
+    return result
@@ -0,0 +1,46 @@
+"""Tests of anchor location detection."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import anchor_locations, np_tiles_converter
+
+
+@pytest.mark.parametrize("smooth", [False, True])
+def test_many_customers_at_high_zoom(smooth):
+    """Customer codes do not overflow keys of (customer, tile) at zoom 22."""
+    # codes from 2**18 do not fit into int64 with a tile key at zoom 22
+    zoom = 22
+    n_customers = 2**18 + 10_000
+    rng = np.random.default_rng(0)
+    # every customer sleeps in its own tile and visits a random tile once
+    home_x = rng.integers(0, 2**zoom, n_customers)
+    # rows near the poles are merged by latitude clipping
+    home_y = rng.integers(2**zoom // 4, 3 * 2**zoom // 4, n_customers)
+    home_lat, home_lon = np_tiles_converter.np_idx2deg(home_x, home_y, zoom)
+    visit_lat, visit_lon = np_tiles_converter.np_idx2deg(
+        rng.integers(0, 2**zoom, n_customers),
+        rng.integers(0, 2**zoom, n_customers),
+        zoom,
+    )
+    df_pings = pd.DataFrame(
+        {
+            "customer_id": np.tile(np.arange(n_customers), 3),
+            "timestamp": pd.to_datetime(
+                ["2024-01-01 23:00"] * n_customers
+                + ["2024-01-02 01:00"] * n_customers
+                + ["2024-01-02 03:00"] * n_customers
+            ),
+            "lat": np.concatenate([home_lat, home_lat, visit_lat]),
+            "lon": np.concatenate([home_lon, home_lon, visit_lon]),
+        }
+    )
+
+    df_anchors = anchor_locations.detect_anchors(df_pings, zoom=zoom, smooth=smooth)
+
+    df_home = df_anchors[df_anchors["anchor"] == "home"]
+    assert len(df_home) == n_customers
+    np.testing.assert_array_equal(df_home["customer_id"], np.arange(n_customers))
+    np.testing.assert_array_equal(df_home["tile_idx_x"], home_x)
+    np.testing.assert_array_equal(df_home["tile_idx_y"], home_y)
+    np.testing.assert_array_equal(df_home["n_pings"], 2)
@@ -0,0 +1,16 @@
+"""Tests that the core imports no heavy optional dependencies."""
+import pytest
+
+from benchmarks import import_time
+
+
+@pytest.mark.parametrize(
+    "case",
+    [case for case in import_time.all_cases() if not case.allowed],
+    ids=lambda case: case.module,
+)
+def test_core_imports_no_heavy_modules(case):
+    """Package and numpy-only modules do not load optional dependencies."""
+    res = import_time.measure(case, repeat=1)
+
+    assert res.heavy == []
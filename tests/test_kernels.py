@@ -0,0 +1,56 @@
+"""Tests of parity of the kernel backends with np_tiles_converter."""
+import importlib.util
+
+import numpy as np
+import pytest
+
+from src import kernels, np_tiles_converter
+
+BACKENDS = [
+    pytest.param("numpy"),
+    pytest.param(
+        "numexpr",
+        marks=pytest.mark.skipif(
+            importlib.util.find_spec("numexpr") is None, reason="needs numexpr"
+        ),
+    ),
+    pytest.param(
+        "numba",
+        marks=pytest.mark.skipif(
+            importlib.util.find_spec("numba") is None, reason="needs numba"
+        ),
+    ),
+]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_float64_parity(backend):
+    """Float64 results are the same as np_deg2idx and np_haversin."""
+    parity = kernels.check_parity(n_points=20_000, seed=1)
+    parity = parity[(parity["backend"] == backend) & (parity["dtype"] == "float64")]
+
+    assert len(parity) == 5
+    assert (parity["tile_mismatches"] == 0).all()
+    assert (parity["distance_mismatches"] == 0).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_parity_at_rounding_boundaries(backend):
+    """Tile corners and half decimeter distances match numpy exactly."""
+    zoom = 19
+    rng = np.random.default_rng(2)
+    corner_x = rng.integers(0, 2**zoom, 10_000)
+    corner_y = rng.integers(0, 2**zoom, 10_000)
+    lat_deg, lon_deg = np_tiles_converter.np_idx2deg(corner_x, corner_y, zoom, offset=0)
+
+    xtile, ytile = kernels.deg2idx(lat_deg, lon_deg, zoom, backend=backend)
+    ref_x, ref_y = np_tiles_converter.np_deg2idx(lat_deg, lon_deg, zoom)
+    np.testing.assert_array_equal(xtile, ref_x)
+    np.testing.assert_array_equal(ytile, ref_y)
+
+    # points along the meridian at distances of k + 0.05 meters
+    lat_step = np.degrees((np.arange(10_000) + 0.05) / kernels.EARTH_RADIUS)
+    zeros = np.zeros(lat_step.shape[0])
+    dist = kernels.haversin(zeros, zeros, lat_step, zeros, backend=backend)
+    ref_dist = np_tiles_converter.np_haversin(zeros, zeros, lat_step, zeros)
+    np.testing.assert_array_equal(dist, ref_dist)
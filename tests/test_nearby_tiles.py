@@ -0,0 +1,23 @@
+"""Tests of nearby tiles search."""
+import numpy as np
+
+from src import instrumentation, nearby_tiles
+
+
+def test_parallel_instrumentation_includes_worker_stages():
+    """Stages run in worker processes are reported with the serial counts."""
+    rng = np.random.default_rng(0)
+    lat_deg = rng.uniform(51.3, 51.7, 2000)
+    lon_deg = rng.uniform(-0.5, 0.2, 2000)
+
+    totals = []
+    for n_jobs in (1, 2):
+        with instrumentation.collect() as collector:
+            nearby_tiles.nearby_tile_arrays(lat_deg, lon_deg, 18, 300.0, n_jobs=n_jobs)
+        totals.append(collector.as_dict())
+
+    serial, parallel = totals
+    for stage_name in ("stencil build", "rough filter", "haversine filter"):
+        for name in ("points", "certain", "candidates", "kept", "nbytes"):
+            if name in serial[stage_name]:
+                assert parallel[stage_name][name] == serial[stage_name][name]
@@ -0,0 +1,57 @@
+"""Tests of GPS track conversion to tiles."""
+import numpy as np
+import pandas as pd
+
+from src import track_converter
+
+
+def _tracks() -> pd.DataFrame:
+    """Return two short tracks in London."""
+    return pd.DataFrame(
+        {
+            "track_id": ["a", "a", "a", "b", "b"],
+            "timestamp": pd.to_datetime(
+                [
+                    "2024-01-01 10:00",
+                    "2024-01-01 10:05",
+                    "2024-01-01 10:10",
+                    "2024-01-01 12:00",
+                    "2024-01-01 12:30",
+                ]
+            ),
+            "lat": [51.50, 51.51, 51.52, 51.45, 51.46],
+            "lon": [-0.12, -0.11, -0.10, -0.20, -0.18],
+        }
+    )
+
+
+def test_empty_tracks_keep_columns_and_dtypes():
+    """Empty input gives empty frame with the columns of non-empty output."""
+    df_tracks = _tracks()
+    expected = track_converter.tracks_to_tiles(df_tracks, zoom=15)
+
+    df_tiles = track_converter.tracks_to_tiles(df_tracks.iloc[:0], zoom=15)
+
+    assert df_tiles.shape[0] == 0
+    assert list(df_tiles.columns) == list(expected.columns)
+    assert list(df_tiles.dtypes[1:]) == list(expected.dtypes[1:])
+
+
+def test_empty_tracks_with_numeric_time():
+    """Empty input with seconds as timestamps has float enter time."""
+    df_tracks = _tracks().iloc[:0].assign(timestamp=np.array([], dtype=np.float64))
+
+    df_tiles = track_converter.tracks_to_tiles(df_tracks, zoom=15)
+
+    assert df_tiles.shape[0] == 0
+    assert df_tiles["enter_time"].dtype == np.float64
+
+
+def test_path_has_no_gaps():
+    """Consecutive tiles of a track are adjacent."""
+    df_tiles = track_converter.tracks_to_tiles(_tracks(), zoom=15)
+
+    for _, df_track in df_tiles.groupby("track_id"):
+        step_x = np.abs(np.diff(df_track["tile_idx_x"].values))
+        step_y = np.abs(np.diff(df_track["tile_idx_y"].values))
+        assert np.all(step_x + step_y == 1)